@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.core.urlresolvers import reverse
-from afkradio.models import Song, Setlist, Playlist, PlayHistory
+from afkradio.models import Song, Setlist, Playlist, PlayHistory, Station
 
 
 class SetlistAdmin(admin.ModelAdmin):
@@ -8,6 +8,10 @@ class SetlistAdmin(admin.ModelAdmin):
 	list_display = ('setlist', 'active',)
 	exclude = ('associated_songs',)
 
+class StationAdmin(admin.ModelAdmin):
+	list_display = ('name', 'mpd_host', 'mpd_port', 'active',)
+	filter_horizontal = ('setlists',)
+
 class SetlistInline(admin.TabularInline):
 	model = Setlist.associated_songs.through
 
@@ -23,8 +27,14 @@ class PlayHistoryAdmin(admin.ModelAdmin):
 		title = object.song_title()
 		return u'<a href="%s">%s</a>' %(url, title)
 
+	def song_pk(self, object):
+		return object.song_id
+	song_pk.short_description = 'Song ID'
+
 	list_per_page = 30
-	list_display = ('song_id', 'song_title_edit', 'played_time')
+	list_display = ('song_pk', 'song_title_edit', 'played_time', 'station')
+	list_filter = ('station',)
+	list_select_related = ('song',)
 	song_title_edit.allow_tags=True
 
 class PlaylistAdmin(admin.ModelAdmin):
@@ -33,12 +43,19 @@ class PlaylistAdmin(admin.ModelAdmin):
 		title = object.song_title()
 		return u'<a href="%s">%s</a>' %(url, title)
 
+	def song_pk(self, object):
+		return object.song_id
+	song_pk.short_description = 'Song ID'
+
 	list_per_page = 30
-	list_display = ('song_id', 'song_title_edit', 'user_requested', 'add_time')
-	ordering = ['-user_requested', 'add_time']
+	list_display = ('song_pk', 'song_title_edit', 'user_requested', 'add_time', 'station')
+	list_filter = ('station',)
+	list_select_related = ('song',)
+	ordering = ['position']
 	song_title_edit.allow_tags = True
 
 admin.site.register(Song, SongAdmin)
 admin.site.register(Setlist, SetlistAdmin)
 admin.site.register(Playlist, PlaylistAdmin)
 admin.site.register(PlayHistory, PlayHistoryAdmin)
+admin.site.register(Station, StationAdmin)
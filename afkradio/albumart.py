@@ -0,0 +1,109 @@
+from Queue import Queue
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+with open(os.path.join(APP_ROOT,'config.json')) as config_file:
+	config_data = json.load(config_file)
+	STATIC_FILE_ROOT = config_data['Static file root']
+
+# Number of images that can wait to be written before ingest blocks
+ALBUM_ART_QUEUE_SIZE = 64
+
+# File suffixes for the embedded image types we save as album art
+IMAGE_SUFFIXES = {
+		'image/png' : 'png',
+		'image/jpeg' : 'jpg',
+		}
+
+
+# AlbumArtWriter
+# Writes album art to the static album_art folder from a background thread
+# so ingest doesn't wait on disk writes.  Images are named after the sha1 of
+# their contents, so every track of an album shares one file and an image
+# that is already on disk (or already queued) is never written twice.  The
+# queue is bounded; if the writer falls behind, store() blocks until there
+# is room.
+class AlbumArtWriter:
+	def __init__(self, static_root, queue_size=ALBUM_ART_QUEUE_SIZE):
+		self.dir_name = os.path.join(static_root, 'afkradio/album_art')
+		[static_path_head, static_path_tail] = os.path.split(static_root)
+		self.rel_dir_name = os.path.join('/', static_path_tail, 'afkradio/album_art')
+		self.queue = Queue(queue_size)
+		self.known_filenames = set()
+		self.lock = threading.Lock()
+		self.thread = threading.Thread(target=self.run, name='AlbumArtWriter')
+		self.thread.daemon = True
+		self.thread.start()
+
+	# store
+	# Queues image_data to be written and returns the static path it will
+	# be served from
+	def store(self, image_data, image_suffix):
+		filename = hashlib.sha1(image_data).hexdigest() + '.' + image_suffix
+		with self.lock:
+			is_new = filename not in self.known_filenames
+			self.known_filenames.add(filename)
+		if is_new:
+			self.queue.put((filename, image_data))
+		return os.path.join(self.rel_dir_name, filename)
+
+	def run(self):
+		while True:
+			filename, image_data = self.queue.get()
+			try:
+				self.write(filename, image_data)
+			except (IOError, OSError):
+				logging.error('Could not write album art ' + filename)
+				with self.lock:
+					self.known_filenames.discard(filename)
+			finally:
+				self.queue.task_done()
+
+	def write(self, filename, image_data):
+		image_path = os.path.join(self.dir_name, filename)
+		if os.path.exists(image_path):
+			return
+		if not os.path.isdir(self.dir_name):
+			os.makedirs(self.dir_name)
+		# Write to a temporary name first so a half written image is never served
+		temp_path = image_path + '.%d.tmp' % os.getpid()
+		with open(temp_path, 'wb') as image_out:
+			image_out.write(image_data)
+		os.rename(temp_path, image_path)
+
+	# flush
+	# Blocks until every queued image has been written
+	def flush(self):
+		self.queue.join()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+	global _writer
+	with _writer_lock:
+		if _writer is None:
+			_writer = AlbumArtWriter(STATIC_FILE_ROOT)
+		return _writer
+
+# store_album_art
+# Queues an embedded image of the given mime type to be written and returns
+# the static path to put in Song.artpath, or '' for unsupported images
+def store_album_art(image_data, mime_type):
+	image_suffix = IMAGE_SUFFIXES.get(mime_type)
+	if not image_data or not image_suffix:
+		return ''
+	return get_writer().store(image_data, image_suffix)
+
+def flush_album_art():
+	if _writer is not None:
+		_writer.flush()
+
+atexit.register(flush_album_art)
@@ -0,0 +1,159 @@
+from afkradio.models import Song
+from afkradio.errors import *
+from django.db import connection, transaction
+from django.db.models import F
+import atexit
+import logging
+import threading
+import time
+
+# Counter updates are written once this many are buffered...
+COUNTER_FLUSH_SIZE = 100
+# ...or by a timer this many seconds after the first one was buffered
+COUNTER_FLUSH_SECONDS = 10
+
+# Most song pks in one UPDATE
+COUNTER_UPDATE_BATCH_SIZE = 500
+
+COUNTER_FIELDS = ('playcount', 'favecount')
+
+
+# CounterBuffer
+# Collects increments of the Song counters in memory and writes them in one
+# transaction as UPDATE ... SET field = field + n, one statement per field
+# and amount (not per song), so bursts of plays, requests or favourites
+# don't turn into one write per event.  F() keeps the updates atomic with
+# other processes writing the same counters.  When timed, a timer thread
+# flushes flush_seconds after the first increment into an empty buffer, so
+# counts don't wait for the next increment (or exit) to be written.
+# pending_amount tells pages what hasn't been written yet
+class CounterBuffer:
+	def __init__(self, flush_size=COUNTER_FLUSH_SIZE, flush_seconds=COUNTER_FLUSH_SECONDS,
+			timed=True):
+		self.flush_size = flush_size
+		self.flush_seconds = flush_seconds
+		self.timed = timed
+		self.lock = threading.Lock()
+		# {(field, song pk): amount}
+		self.pending = {}
+		self.pending_count = 0
+		self.first_pending_time = None
+		self.flush_timer = None
+
+	def increment(self, song_id, field='playcount', amount=1):
+		if field not in COUNTER_FIELDS:
+			raise FieldNotFoundError('Song has no counter called ' + field)
+		with self.lock:
+			key = (field, int(song_id))
+			self.pending[key] = self.pending.get(key, 0) + amount
+			self.pending_count += 1
+			if self.first_pending_time is None:
+				self.first_pending_time = time.time()
+				self.start_timer()
+			due = self.pending_count >= self.flush_size
+		if due:
+			self.flush()
+
+	# pending_amount
+	# The increments of a song's counter that haven't been written yet
+	def pending_amount(self, song_id, field='playcount'):
+		with self.lock:
+			return self.pending.get((field, int(song_id)), 0)
+
+	# start_timer
+	# Schedules timed_flush, unless one is scheduled already.  Called with
+	# the lock held
+	def start_timer(self):
+		if not self.timed or self.flush_timer is not None:
+			return
+		self.flush_timer = threading.Timer(self.flush_seconds, self.timed_flush)
+		self.flush_timer.daemon = True
+		self.flush_timer.start()
+
+	# timed_flush
+	# flush() on the timer's thread, which then closes its own database
+	# connection.  A failed flush restores the increments and schedules
+	# another try
+	def timed_flush(self):
+		with self.lock:
+			self.flush_timer = None
+		try:
+			self.flush()
+		except Exception:
+			logging.exception('Could not write the buffered counters')
+		finally:
+			connection.close()
+
+	# flush
+	# Writes every buffered increment.  Returns the number of UPDATEs run.
+	# If the writes fail the increments go back in the buffer
+	def flush(self):
+		with self.lock:
+			pending = self.pending
+			self.pending = {}
+			self.pending_count = 0
+			self.first_pending_time = None
+			if self.flush_timer is not None:
+				self.flush_timer.cancel()
+				self.flush_timer = None
+		if not pending:
+			return 0
+		# {(field, amount): [song pks]}
+		updates = {}
+		for (field, song_pk), amount in pending.items():
+			if amount:
+				updates.setdefault((field, amount), []).append(song_pk)
+		update_count = 0
+		try:
+			with transaction.atomic():
+				for (field, amount), song_pks in updates.items():
+					for index in range(0, len(song_pks), COUNTER_UPDATE_BATCH_SIZE):
+						Song.objects.filter(pk__in=song_pks[index:index+COUNTER_UPDATE_BATCH_SIZE]) \
+								.update(**{field: F(field) + amount})
+						update_count += 1
+		except:
+			self.restore(pending)
+			raise
+		logging.info('Wrote %d counter changes in %d updates' % (len(pending), update_count))
+		return update_count
+
+	# restore
+	# Puts increments taken out by a failed flush back in the buffer
+	def restore(self, pending):
+		with self.lock:
+			for key, amount in pending.items():
+				self.pending[key] = self.pending.get(key, 0) + amount
+			self.pending_count += len(pending)
+			if self.first_pending_time is None:
+				self.first_pending_time = time.time()
+			self.start_timer()
+
+
+_counters = None
+_counters_lock = threading.Lock()
+
+def get_counters():
+	global _counters
+	with _counters_lock:
+		if _counters is None:
+			_counters = CounterBuffer()
+		return _counters
+
+def count_play(song_id):
+	get_counters().increment(song_id, 'playcount')
+
+def count_favourite(song_id):
+	get_counters().increment(song_id, 'favecount')
+
+# pending_amount
+# The increments of a song's counter this process hasn't written yet
+def pending_amount(song_id, field='playcount'):
+	if _counters is None:
+		return 0
+	return _counters.pending_amount(song_id, field)
+
+def flush_counters():
+	if _counters is not None:
+		_counters.flush()
+
+atexit.register(flush_counters)
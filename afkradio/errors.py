@@ -40,3 +40,38 @@ class MPDRootNotFound( Exception ):
 
 	def __str__(self):
 		return repr(self.message)
+
+class ExiftoolError( Exception ):
+	def __init__(self, message):
+		logging.error('ExiftoolError ' + message)
+	pass
+
+class TagReadError( Exception ):
+	def __init__(self, message):
+		logging.error('TagReadError ' + message)
+	pass
+
+class InotifyError( Exception ):
+	def __init__(self, message):
+		logging.error('InotifyError ' + message)
+	pass
+
+class SetlistRuleError( Exception ):
+	def __init__(self, message):
+		logging.error('SetlistRuleError ' + message)
+	pass
+
+class MPDConnectionError( Exception ):
+	def __init__(self, message):
+		logging.error('MPDConnectionError ' + message)
+	pass
+
+# MPDCommandError
+# An ACK from MPD: "[error@command_list_num] {command} message"
+class MPDCommandError( Exception ):
+	def __init__(self, message):
+		self.message = message
+		logging.error('MPDCommandError ' + message)
+
+	def __str__(self):
+		return repr(self.message)
@@ -0,0 +1,201 @@
+from afkradio.errors import *
+from django.utils.encoding import smart_str, smart_unicode
+from Queue import Queue
+import atexit
+import base64
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import subprocess
+import threading
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+EXIFTOOL_PATH = os.path.join(APP_ROOT, 'exiftool', 'exiftool')
+
+with open(os.path.join(APP_ROOT,'config.json')) as config_file:
+	config_data = json.load(config_file)
+	EXIFTOOL_WORKERS = config_data.get('Exiftool workers', '')
+
+# Tags requested by read_metadata.  A trailing # asks exiftool for the
+# numeric value instead of the print conversion (i.e. seconds for Duration).
+# Picture is the embedded art, which comes back base64 encoded
+METADATA_TAGS = ('FileType', 'Title', 'Artist', 'Album', 'Year', 'Genre',
+	'Track', 'Duration#', 'PictureMIMEType', 'Picture')
+
+# Start of the JSON array in exiftool -j output.  Anything around it are
+# messages such as 'File not found' or the count of files read.  Note that
+# -q can't be used to silence them since it also drops the {ready} sentinel
+JSON_START = re.compile(r'^\[', re.MULTILINE)
+
+
+# ExiftoolWorker
+# Wraps a single long-lived exiftool process started in -stay_open mode.
+# Arguments are written to its stdin as an argfile (one argument per line)
+# and each command is terminated with a numbered -execute so the matching
+# {readyN} sentinel marks the end of that command's output.  stderr is
+# merged into stdout so messages like 'File not found' come back in-band.
+class ExiftoolWorker:
+	def __init__(self):
+		self.proc = None
+		self.sequence = itertools.count(1)
+		self.start()
+
+	def start(self):
+		self.proc = subprocess.Popen(
+				[EXIFTOOL_PATH, '-stay_open', 'True', '-@', '-'],
+				stdin = subprocess.PIPE,
+				stdout = subprocess.PIPE,
+				stderr = subprocess.STDOUT)
+
+	def is_alive(self):
+		return self.proc is not None and self.proc.poll() is None
+
+	def restart(self):
+		self.kill()
+		logging.warning('Restarting exiftool worker')
+		self.start()
+
+	def kill(self):
+		if self.is_alive():
+			try:
+				self.proc.kill()
+				self.proc.wait()
+			except OSError:
+				pass
+		self.proc = None
+
+	# execute
+	# Runs exiftool with the given arguments and returns its raw output
+	# with the trailing {readyN} sentinel removed
+	def execute(self, *args):
+		if not self.is_alive():
+			self.restart()
+		sequence = next(self.sequence)
+		sentinel = '{ready%d}\n' % sequence
+		argfile = ''.join(smart_str(arg) + '\n' for arg in args)
+		argfile += '-execute%d\n' % sequence
+		try:
+			self.proc.stdin.write(argfile)
+			self.proc.stdin.flush()
+		except IOError:
+			self.kill()
+			raise ExiftoolError('Could not write to the exiftool worker')
+		output = ''
+		stdout_fd = self.proc.stdout.fileno()
+		while True:
+			chunk = os.read(stdout_fd, 65536)
+			if not chunk:
+				self.kill()
+				raise ExiftoolError('The exiftool worker exited unexpectedly')
+			output += chunk
+			sentinel_index = output.rfind(sentinel, max(0, len(output) - len(chunk) - len(sentinel)))
+			if sentinel_index != -1:
+				return output[:sentinel_index]
+
+	# close
+	# Asks exiftool to leave -stay_open mode and waits for it to exit
+	def close(self):
+		if not self.is_alive():
+			return
+		try:
+			self.proc.stdin.write('-stay_open\nFalse\n')
+			self.proc.stdin.flush()
+			self.proc.stdin.close()
+			self.proc.wait()
+		except (IOError, OSError):
+			self.kill()
+		self.proc = None
+
+
+# ExiftoolPool
+# A fixed size pool of ExiftoolWorkers shared by the ingest path.  Workers
+# are checked out for the length of a single command so the pool can be used
+# from several threads at once.  A worker that crashes is restarted and the
+# command is retried once before the error is passed on.
+class ExiftoolPool:
+	def __init__(self, size=None):
+		if not size:
+			size = multiprocessing.cpu_count()
+		self.size = int(size)
+		self.idle_workers = Queue()
+		self.workers = []
+		self.lock = threading.Lock()
+		self.closed = False
+		for worker_count in range(self.size):
+			worker = ExiftoolWorker()
+			self.workers.append(worker)
+			self.idle_workers.put(worker)
+
+	def execute(self, *args):
+		if self.closed:
+			raise ExiftoolError('The exiftool pool has been shut down')
+		worker = self.idle_workers.get()
+		try:
+			try:
+				return worker.execute(*args)
+			except ExiftoolError:
+				worker.restart()
+				return worker.execute(*args)
+		finally:
+			self.idle_workers.put(worker)
+
+	def close(self):
+		with self.lock:
+			if self.closed:
+				return
+			self.closed = True
+		for worker in self.workers:
+			worker.close()
+
+
+# read_metadata
+# Reads METADATA_TAGS from any number of files with a single exiftool
+# command.  Returns a dict of {absolute path: {tag: value}}.  Files that
+# could not be found are left out
+def read_metadata(abs_song_paths):
+	if not abs_song_paths:
+		return {}
+	args = ['-j', '-b'] + ['-' + tag for tag in METADATA_TAGS] + list(abs_song_paths)
+	output = get_pool().execute(*args)
+	json_start = JSON_START.search(output)
+	if json_start is None:
+		return {}
+	try:
+		file_tags, json_end = json.JSONDecoder().raw_decode(
+				output[json_start.start():].decode('utf-8', 'replace'))
+	except ValueError:
+		raise ExiftoolError('Could not parse the exiftool output')
+	metadata = {}
+	for tags in file_tags:
+		if unicode(tags.get('Picture', '')).startswith('base64:'):
+			tags['Picture'] = base64.b64decode(tags['Picture'][7:])
+		metadata[tags.pop('SourceFile')] = tags
+	return dict((abs_song_path, metadata[smart_unicode(abs_song_path)])
+			for abs_song_path in abs_song_paths
+			if smart_unicode(abs_song_path) in metadata)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# get_pool
+# Returns the process wide ExiftoolPool, starting it on first use.  The size
+# is read from 'Exiftool workers' in config.json and defaults to the number
+# of cores
+def get_pool():
+	global _pool
+	with _pool_lock:
+		if _pool is None or _pool.closed:
+			_pool = ExiftoolPool(EXIFTOOL_WORKERS)
+		return _pool
+
+def close_pool():
+	global _pool
+	with _pool_lock:
+		if _pool is not None:
+			_pool.close()
+			_pool = None
+
+atexit.register(close_pool)
@@ -0,0 +1,543 @@
+from afkradio import mpd
+from afkradio.mpd import MPDClient, MPDConnectionPool
+from contextlib import contextmanager
+import errno
+import fcntl
+import inspect
+import os
+import select
+import socket
+import SocketServer
+import threading
+import time
+
+# In-process stand-in for MPD, for tests and benchmarks.  It speaks enough
+# of the text protocol for Playback and the stream: the queue, play state,
+# idle and command lists.  Songs need not exist, any path can be queued.
+# With a speed set, songs play in accelerated time and MPD moves on to the
+# next song by itself; without one, advance() moves it on.
+
+PROTOCOL_VERSION = '0.19.0'
+DEFAULT_DURATION_SECONDS = 180.0
+SUBSYSTEMS = ('database', 'update', 'stored_playlist', 'playlist', 'player',
+	'mixer', 'output', 'options', 'sticker', 'subscription', 'message')
+
+ACK_ERROR_ARG = 2
+ACK_ERROR_PASSWORD = 3
+ACK_ERROR_UNKNOWN = 5
+ACK_ERROR_NO_EXIST = 50
+
+
+# AckError
+# A command failed, which the session answers with an ACK line
+class AckError(Exception):
+	def __init__(self, code, message):
+		Exception.__init__(self, message)
+		self.code = code
+		self.message = message
+
+# split_args
+# 'add "a \"b\".mp3"' -> ['add', u'a "b".mp3']
+def split_args(line):
+	args = []
+	index = 0
+	while index < len(line):
+		if line[index] == ' ':
+			index += 1
+		elif line[index] == '"':
+			index += 1
+			arg = []
+			while index < len(line) and line[index] != '"':
+				if line[index] == '\\':
+					index += 1
+				arg.append(line[index])
+				index += 1
+			index += 1
+			args.append(''.join(arg))
+		else:
+			end = line.find(' ', index)
+			if end < 0:
+				end = len(line)
+			args.append(line[index:end])
+			index = end
+	return [arg.decode('utf-8') for arg in args]
+
+def format_pairs(pairs):
+	return ''.join('%s: %s\n' % (key, value.encode('utf-8') if isinstance(value, unicode)
+			else value) for key, value in pairs)
+
+def parse_int(arg):
+	try:
+		return int(arg)
+	except ValueError:
+		raise AckError(ACK_ERROR_ARG, 'Integer expected: ' + arg)
+
+# takes_args
+# Whether the command handler can be called with arg_count arguments
+def takes_args(handler, arg_count):
+	args, varargs, keywords, defaults = inspect.getargspec(handler)
+	max_count = len(args) - (1 if inspect.ismethod(handler) else 0)
+	min_count = max_count - len(defaults or ())
+	return min_count <= arg_count and (varargs is not None or arg_count <= max_count)
+
+
+# FakeMPDServer
+# Listens on a free port of 127.0.0.1 once started.  durations and tags
+# map song paths to their length in seconds and to extra tags such as
+# Title and Artist.  speed is simulated seconds per real second.
+# command_counts counts the commands received by name, and track_changes
+# the times MPD moved on to another song.
+class FakeMPDServer:
+	def __init__(self, durations=None, tags=None, speed=None,
+			default_duration=DEFAULT_DURATION_SECONDS, password=''):
+		self.durations = durations or {}
+		self.tags = tags or {}
+		self.speed = speed
+		self.default_duration = default_duration
+		self.password = password
+		self.lock = threading.RLock()
+		# Notified on every change
+		self.changed = threading.Condition(self.lock)
+		# [(song id, path)]
+		self.queue = []
+		self.next_song_id = 1
+		self.playlist_version = 1
+		self.update_job = 0
+		self.state = 'stop'
+		self.current_id = None
+		# Simulated seconds played of the current song at clock_time
+		self.elapsed = 0.0
+		self.clock_time = time.time()
+		self.sessions = set()
+		self.command_counts = {}
+		self.track_changes = 0
+		self.closed = False
+		self.server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0), FakeMPDSession,
+				bind_and_activate=False)
+		self.server.daemon_threads = True
+		self.server.allow_reuse_address = True
+		self.server.fake = self
+		self.threads = []
+
+	def start(self):
+		self.server.server_bind()
+		self.server.server_activate()
+		self.threads.append(threading.Thread(target=self.server.serve_forever,
+			kwargs={'poll_interval': 0.05}))
+		if self.speed:
+			self.threads.append(threading.Thread(target=self.run_clock))
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+		return self
+
+	def close(self):
+		with self.lock:
+			self.closed = True
+			self.changed.notify_all()
+			for session in list(self.sessions):
+				session.disconnect()
+		self.server.shutdown()
+		self.server.server_close()
+		for thread in self.threads:
+			thread.join()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	@property
+	def port(self):
+		return self.server.server_address[1]
+
+	# client
+	# A new MPDClient for this server
+	def client(self):
+		return MPDClient('127.0.0.1', self.port, self.password)
+
+	# installed
+	# Points afkradio.mpd's connection pool, and so Playback, at this server
+	@contextmanager
+	def installed(self):
+		old_pool = mpd.pool
+		mpd.pool = MPDConnectionPool(client_factory=self.client)
+		try:
+			yield self
+		finally:
+			mpd.pool.close()
+			mpd.pool = old_pool
+
+	# queue_paths
+	# The paths in the queue, in order
+	def queue_paths(self):
+		with self.lock:
+			return [path for song_id, path in self.queue]
+
+	# wait_for
+	# Waits until predicate() is true, up to timeout seconds (None for no
+	# limit).  Returns whether it became true
+	def wait_for(self, predicate, timeout=10):
+		deadline = time.time() + timeout if timeout is not None else None
+		with self.lock:
+			while not predicate():
+				if deadline is None:
+					self.changed.wait()
+					continue
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return False
+				self.changed.wait(remaining)
+			return True
+
+	def emit(self, *subsystems):
+		for session in self.sessions:
+			session.notify(subsystems)
+		self.changed.notify_all()
+
+	def playlist_changed(self):
+		self.playlist_version += 1
+		self.emit('playlist')
+
+	def current_position(self):
+		for position, (song_id, path) in enumerate(self.queue):
+			if song_id == self.current_id:
+				return position
+		return None
+
+	def song_duration(self, path):
+		return float(self.durations.get(path, self.default_duration))
+
+	def song_elapsed(self):
+		if self.state == 'play' and self.speed:
+			return self.elapsed + (time.time() - self.clock_time) * self.speed
+		return self.elapsed
+
+	def set_current(self, position):
+		self.current_id = self.queue[position][0]
+		self.elapsed = 0.0
+		self.clock_time = time.time()
+
+	# advance
+	# Moves on to the next song as if the current one ended, stopping at
+	# the end of the queue.  Returns False when nothing was playing
+	def advance(self):
+		with self.lock:
+			position = self.current_position()
+			if self.state != 'play' or position is None:
+				return False
+			self.track_changes += 1
+			if position + 1 < len(self.queue):
+				self.set_current(position + 1)
+			else:
+				self.state = 'stop'
+				self.current_id = None
+				self.elapsed = 0.0
+			self.emit('player')
+			return True
+
+	# run_clock
+	# Moves on whenever the current song has played for its duration
+	def run_clock(self):
+		with self.lock:
+			while not self.closed:
+				position = self.current_position()
+				if self.state != 'play' or position is None:
+					self.changed.wait()
+					continue
+				remaining = (self.song_duration(self.queue[position][1]) - \
+						self.song_elapsed()) / self.speed
+				if remaining <= 0:
+					self.advance()
+				else:
+					self.changed.wait(remaining)
+
+	# execute
+	# Runs one command, returning its response as (key, value) pairs
+	def execute(self, name, args):
+		handler = getattr(self, 'command_' + name, None)
+		if handler is None:
+			raise AckError(ACK_ERROR_UNKNOWN, 'unknown command "%s"' % name)
+		if not takes_args(handler, len(args)):
+			raise AckError(ACK_ERROR_ARG, 'wrong number of arguments for "%s"' % name)
+		with self.lock:
+			self.command_counts[name] = self.command_counts.get(name, 0) + 1
+			return handler(*args) or []
+
+	def song_pairs(self, position):
+		song_id, path = self.queue[position]
+		pairs = [('file', path)]
+		pairs.extend(sorted(self.tags.get(path, {}).items()))
+		duration = self.song_duration(path)
+		pairs.extend([('Time', str(int(duration))), ('duration', '%.3f' % duration),
+				('Pos', str(position)), ('Id', str(song_id))])
+		return pairs
+
+	def position_arg(self, arg, allow_end=False):
+		position = parse_int(arg)
+		if position < 0 or position > len(self.queue) or \
+				(position == len(self.queue) and not allow_end):
+			raise AckError(ACK_ERROR_ARG, 'Bad song index')
+		return position
+
+	def command_ping(self):
+		pass
+
+	def command_password(self, password):
+		if password != self.password:
+			raise AckError(ACK_ERROR_PASSWORD, 'incorrect password')
+
+	def command_status(self):
+		pairs = [('volume', '100'), ('repeat', '0'), ('random', '0'), ('single', '0'),
+				('consume', '0'), ('playlist', str(self.playlist_version)),
+				('playlistlength', str(len(self.queue))), ('state', self.state)]
+		position = self.current_position()
+		if position is not None:
+			pairs.extend([('song', str(position)), ('songid', str(self.current_id))])
+			if self.state != 'stop':
+				duration = self.song_duration(self.queue[position][1])
+				elapsed = min(self.song_elapsed(), duration)
+				pairs.extend([('time', '%d:%d' % (elapsed, duration)),
+						('elapsed', '%.3f' % elapsed), ('duration', '%.3f' % duration)])
+			if position + 1 < len(self.queue):
+				pairs.extend([('nextsong', str(position + 1)),
+						('nextsongid', str(self.queue[position + 1][0]))])
+		if self.update_job:
+			pairs.append(('updating_db', str(self.update_job)))
+		return pairs
+
+	def command_currentsong(self):
+		position = self.current_position()
+		if position is None:
+			return []
+		return self.song_pairs(position)
+
+	def command_playlistinfo(self):
+		pairs = []
+		for position in range(len(self.queue)):
+			pairs.extend(self.song_pairs(position))
+		return pairs
+
+	def command_play(self, position=None):
+		if position is not None:
+			self.set_current(self.position_arg(position))
+		elif self.current_position() is None:
+			if not self.queue:
+				return
+			self.set_current(0)
+		elif self.state == 'pause':
+			self.clock_time = time.time()
+		else:
+			self.set_current(self.current_position())
+		self.state = 'play'
+		self.emit('player')
+
+	def command_pause(self, pause=None):
+		if self.state == 'stop':
+			return
+		if pause is None:
+			pause = '1' if self.state == 'play' else '0'
+		if pause == '1' and self.state == 'play':
+			self.elapsed = self.song_elapsed()
+			self.state = 'pause'
+		elif pause == '0' and self.state == 'pause':
+			self.clock_time = time.time()
+			self.state = 'play'
+		self.emit('player')
+
+	def command_stop(self):
+		self.state = 'stop'
+		self.elapsed = 0.0
+		self.emit('player')
+
+	def command_next(self):
+		self.advance()
+
+	def command_clear(self):
+		self.queue = []
+		self.current_id = None
+		self.state = 'stop'
+		self.playlist_changed()
+		self.emit('player')
+
+	def command_add(self, path):
+		self.queue.append((self.next_song_id, path))
+		self.next_song_id += 1
+		self.playlist_changed()
+
+	def command_addid(self, path, position=None):
+		song_id = self.next_song_id
+		self.next_song_id += 1
+		if position is None:
+			self.queue.append((song_id, path))
+		else:
+			self.queue.insert(self.position_arg(position, allow_end=True), (song_id, path))
+		self.playlist_changed()
+		return [('Id', str(song_id))]
+
+	# delete takes a position or a start:end range.  Deleting the song that
+	# is playing moves on to the song after it
+	def command_delete(self, positions):
+		if ':' in positions:
+			start, end = positions.split(':', 1)
+			start = self.position_arg(start)
+			end = self.position_arg(end, allow_end=True) if end else len(self.queue)
+			if end <= start:
+				raise AckError(ACK_ERROR_ARG, 'Bad song index')
+		else:
+			start = self.position_arg(positions)
+			end = start + 1
+		current_position = self.current_position()
+		del self.queue[start:end]
+		if current_position is not None and start <= current_position < end:
+			if self.state != 'stop' and start < len(self.queue):
+				self.set_current(start)
+			else:
+				self.state = 'stop'
+				self.current_id = None
+			self.emit('player')
+		self.playlist_changed()
+
+	def command_move(self, from_position, to_position):
+		song = self.queue.pop(self.position_arg(from_position))
+		to_position = parse_int(to_position)
+		if to_position < 0 or to_position > len(self.queue):
+			self.queue.insert(parse_int(from_position), song)
+			raise AckError(ACK_ERROR_ARG, 'Bad song index')
+		self.queue.insert(to_position, song)
+		self.playlist_changed()
+
+	def command_update(self, path=None):
+		self.update_job += 1
+		self.emit('update', 'database')
+		return [('updating_db', str(self.update_job))]
+
+
+# FakeMPDSession
+# One client connection
+class FakeMPDSession(SocketServer.BaseRequestHandler):
+	def setup(self):
+		self.fake = self.server.fake
+		self.buffer = ''
+		self.pending = set()
+		self.wake_read, self.wake_write = os.pipe()
+		fcntl.fcntl(self.wake_write, fcntl.F_SETFL, os.O_NONBLOCK)
+		with self.fake.lock:
+			self.fake.sessions.add(self)
+
+	def finish(self):
+		with self.fake.lock:
+			self.fake.sessions.discard(self)
+		os.close(self.wake_read)
+		os.close(self.wake_write)
+
+	# notify
+	# Called with the server locked when subsystems changed
+	def notify(self, subsystems):
+		self.pending.update(subsystems)
+		try:
+			os.write(self.wake_write, 'x')
+		except OSError as error:
+			if error.errno != errno.EAGAIN:
+				raise
+
+	def disconnect(self):
+		try:
+			self.request.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+
+	# read_line
+	# The next line from the client, or None once it is gone
+	def read_line(self):
+		while '\n' not in self.buffer:
+			try:
+				data = self.request.recv(65536)
+			except socket.error:
+				return None
+			if not data:
+				return None
+			self.buffer += data
+		line, self.buffer = self.buffer.split('\n', 1)
+		return line
+
+	def send(self, data):
+		try:
+			self.request.sendall(data)
+			return True
+		except socket.error:
+			return False
+
+	def handle(self):
+		if not self.send('OK MPD %s\n' % PROTOCOL_VERSION):
+			return
+		while not self.fake.closed:
+			line = self.read_line()
+			if line is None or line == 'close':
+				return
+			if line in ('command_list_begin', 'command_list_ok_begin'):
+				lines = []
+				while True:
+					list_line = self.read_line()
+					if list_line is None:
+						return
+					if list_line == 'command_list_end':
+						break
+					lines.append(list_line)
+				response = self.run_list(lines, line == 'command_list_ok_begin')
+			elif line.split(' ', 1)[0] == 'idle':
+				response = self.idle(split_args(line)[1:])
+				if response is None:
+					return
+			elif line == 'noidle':
+				continue
+			else:
+				response = self.run_list([line], False)
+			if not self.send(response):
+				return
+
+	def run_list(self, lines, list_ok):
+		response = []
+		for index, line in enumerate(lines):
+			args = split_args(line)
+			name = args[0] if args else ''
+			try:
+				response.append(format_pairs(self.fake.execute(name, args[1:])))
+			except AckError as error:
+				response.append('ACK [%d@%d] {%s} %s\n' % (error.code, index, name,
+						error.message))
+				return ''.join(response)
+			if list_ok:
+				response.append('list_OK\n')
+		response.append('OK\n')
+		return ''.join(response)
+
+	# idle
+	# Waits for a change to subsystems (any when none are given) or for
+	# noidle.  Returns the response, or None once the client is gone
+	def idle(self, subsystems):
+		subsystems = set(subsystems or SUBSYSTEMS)
+		while True:
+			with self.fake.lock:
+				if self.fake.closed:
+					return None
+				changed = self.pending & subsystems
+				if changed:
+					self.pending -= changed
+					return ''.join('changed: %s\n' % subsystem
+							for subsystem in sorted(changed)) + 'OK\n'
+			if '\n' in self.buffer:
+				line = self.read_line()
+				return 'OK\n' if line == 'noidle' else None
+			readable = select.select([self.request, self.wake_read], [], [])[0]
+			if self.wake_read in readable:
+				os.read(self.wake_read, 4096)
+			if self.request in readable:
+				try:
+					data = self.request.recv(65536)
+				except socket.error:
+					return None
+				if not data:
+					return None
+				self.buffer += data
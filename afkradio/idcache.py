@@ -0,0 +1,76 @@
+from array import array
+import random
+import threading
+import time
+
+# Seconds a loaded id array is trusted before it is loaded again.  Signals
+# invalidate it straight away within a process, this bounds how long other
+# processes (the timer, other web workers) can miss new songs
+ID_CACHE_SECONDS = 300
+
+
+# IdArrayCache
+# Keeps the result of load_ids (an iterable of integer ids) in a compact
+# array('l') so a random id can be picked without COUNT or OFFSET queries.
+# The array is loaded on first use and again after invalidate() or once it
+# is older than ttl seconds.  version goes up on every invalidation
+class IdArrayCache:
+	def __init__(self, load_ids, ttl=ID_CACHE_SECONDS):
+		self.load_ids = load_ids
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		self.ids = None
+		self.loaded_time = 0
+		self.version = 0
+
+	def invalidate(self, *args, **kwargs):
+		with self.lock:
+			self.ids = None
+			self.version += 1
+
+	def get_ids(self):
+		with self.lock:
+			if self.ids is None or time.time() - self.loaded_time > self.ttl:
+				self.ids = array('l', self.load_ids())
+				self.loaded_time = time.time()
+			return self.ids
+
+	# random_id
+	# Returns a random id from the array, or None if it is empty
+	def random_id(self):
+		ids = self.get_ids()
+		if not ids:
+			return None
+		return ids[random.randrange(len(ids))]
+
+
+# KeyedIdArrayCache
+# An IdArrayCache per key, where load_ids(key) loads the ids for that key.
+# invalidate() drops every array, or only those whose key matches key_filter
+class KeyedIdArrayCache:
+	def __init__(self, load_ids, ttl=ID_CACHE_SECONDS):
+		self.load_ids = load_ids
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		# {key: IdArrayCache}
+		self.caches = {}
+
+	def invalidate(self, key_filter=None):
+		with self.lock:
+			if key_filter is None:
+				self.caches = {}
+			else:
+				for key in [key for key in self.caches if key_filter(key)]:
+					del self.caches[key]
+
+	def get_cache(self, key):
+		with self.lock:
+			if key not in self.caches:
+				self.caches[key] = IdArrayCache(lambda: self.load_ids(key), self.ttl)
+			return self.caches[key]
+
+	def get_ids(self, key):
+		return self.get_cache(key).get_ids()
+
+	def random_id(self, key):
+		return self.get_cache(key).random_id()
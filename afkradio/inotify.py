@@ -0,0 +1,153 @@
+from afkradio.errors import *
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+# Minimal ctypes binding to the Linux inotify API, enough for the library
+# watcher to follow a directory tree without polling it
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# Events that mean a file under the library changed.  IN_CLOSE_WRITE is
+# used rather than IN_MODIFY so files are only looked at once fully written
+LIBRARY_EVENTS = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+	IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+def get_libc():
+	global _libc
+	if _libc is None:
+		libc_name = ctypes.util.find_library('c')
+		if libc_name is None:
+			raise InotifyError('Could not find the C library')
+		_libc = ctypes.CDLL(libc_name, use_errno=True)
+		if not hasattr(_libc, 'inotify_init1'):
+			raise InotifyError('inotify is not available on this system')
+	return _libc
+
+
+# Inotify
+# Watches a directory tree.  Every directory gets its own watch, and
+# directories created (or moved in) later are added as their events come in.
+# A watch follows its directory when it is renamed, so the paths of a
+# renamed directory's watches are changed to the new name, and directories
+# moved out of the tree stop being watched.
+# read_events yields (absolute path, mask) pairs.
+class Inotify:
+	def __init__(self):
+		self.libc = get_libc()
+		self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			raise InotifyError('inotify_init1 failed: ' + os.strerror(ctypes.get_errno()))
+		self.watch_paths = {}
+		# {cookie: old path} of directories moved away whose IN_MOVED_TO
+		# hasn't come yet
+		self.moved_from = {}
+
+	def add_watch(self, path, mask=LIBRARY_EVENTS):
+		watch = self.libc.inotify_add_watch(self.fd, path.encode('utf-8')
+				if isinstance(path, unicode) else path, mask)
+		if watch < 0:
+			error = ctypes.get_errno()
+			# The directory may be gone again already
+			if error in (errno.ENOENT, errno.ENOTDIR):
+				return None
+			raise InotifyError('inotify_add_watch failed for ' + path + ': ' + \
+					os.strerror(error))
+		self.watch_paths[watch] = path
+		return watch
+
+	# add_tree
+	# Watches path and every directory under it
+	def add_tree(self, path, mask=LIBRARY_EVENTS):
+		for root, dirs, files in os.walk(path):
+			self.add_watch(root, mask | IN_ONLYDIR)
+
+	# tree_watches
+	# The watches of path and the directories under it
+	def tree_watches(self, path):
+		return [watch for watch, watch_path in self.watch_paths.items()
+				if watch_path == path or watch_path.startswith(path + os.sep)]
+
+	# rename_tree
+	# Moves the watches of old_path and the directories under it to new_path
+	def rename_tree(self, old_path, new_path):
+		for watch in self.tree_watches(old_path):
+			self.watch_paths[watch] = new_path + self.watch_paths[watch][len(old_path):]
+
+	# remove_tree
+	# Stops watching path and the directories under it
+	def remove_tree(self, path):
+		for watch in self.tree_watches(path):
+			self.libc.inotify_rm_watch(self.fd, watch)
+			del self.watch_paths[watch]
+
+	# read_events
+	# Waits up to timeout seconds for events and yields (path, mask) for
+	# each.  Directories that appear are watched automatically.  A
+	# (None, IN_Q_OVERFLOW) pair means events were lost
+	def read_events(self, timeout=None):
+		readable, writable, errored = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return
+		try:
+			data = os.read(self.fd, 65536)
+		except OSError as error:
+			if error.errno == errno.EAGAIN:
+				return
+			raise
+		position = 0
+		while position + EVENT_HEADER.size <= len(data):
+			watch, mask, cookie, name_length = EVENT_HEADER.unpack_from(data, position)
+			position += EVENT_HEADER.size
+			name = data[position:position+name_length].rstrip('\0')
+			position += name_length
+			if mask & IN_Q_OVERFLOW:
+				yield (None, mask)
+				continue
+			directory = self.watch_paths.get(watch)
+			if mask & IN_IGNORED:
+				self.watch_paths.pop(watch, None)
+				continue
+			if directory is None:
+				continue
+			path = os.path.join(directory, name) if name else directory
+			if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+				self.moved_from[cookie] = path
+			if mask & IN_ISDIR and mask & IN_MOVED_TO and cookie in self.moved_from:
+				self.rename_tree(self.moved_from.pop(cookie), path)
+			if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+				self.add_tree(path)
+			if mask & IN_MOVE_SELF and path in self.moved_from.values():
+				# Moved out of the tree, there was no IN_MOVED_TO for it
+				for moved_cookie, moved_path in self.moved_from.items():
+					if moved_path == path:
+						del self.moved_from[moved_cookie]
+				self.remove_tree(path)
+			yield (path, mask)
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from afkradio.models import Song
+from afkradio.fakempd import FakeMPDServer
+from afkradio import counters
+from afkradio import rollups
+from afkradio.stream import StreamDaemon, PLAYLIST_SIZE
+from optparse import make_option
+import threading
+import time
+
+# Raised to roll back what the benchmark wrote to the database
+class Rollback(Exception):
+	pass
+
+class Command(BaseCommand):
+	help = 'Runs the stream against an in-process fake MPD playing songs in ' + \
+		'accelerated time and reports the track change throughput and refill ' + \
+		'latency.  Uses the songs in the database and rolls back what it writes'
+	option_list = BaseCommand.option_list + (
+		make_option('--tracks', type='int', default=1000,
+			help='Number of track changes to run for (default 1000)'),
+		make_option('--speed', type='float', default=10000,
+			help='Simulated seconds played per second (default 10000)'),
+		)
+
+	def handle(self, *args, **options):
+		durations = dict((song_path, duration_secs or 180) for song_path, duration_secs in
+				Song.objects.available().values_list('filepath', 'duration_secs'))
+		if len(durations) < PLAYLIST_SIZE:
+			raise CommandError('At least %d songs are needed, the database has %d' % \
+					(PLAYLIST_SIZE, len(durations)))
+		track_count = options['tracks']
+		with FakeMPDServer(durations=durations, speed=options['speed']) as fake, \
+				fake.installed():
+			daemon = StreamDaemon(client=fake.client(), metrics_file='')
+			def stop_after_track_changes():
+				fake.wait_for(lambda: fake.track_changes >= track_count, timeout=None)
+				client = fake.client()
+				client.execute('stop')
+				client.close()
+			stopper = threading.Thread(target=stop_after_track_changes)
+			stopper.daemon = True
+			stopper.start()
+			# The plays are counted in a buffer of their own, without a timer,
+			# so none are written after the roll back (or at exit), and the
+			# process' hourly roll up is left as it was
+			with counters._counters_lock:
+				process_counters = counters._counters
+				counters._counters = counters.CounterBuffer(timed=False)
+			last_rollup_hour = rollups._last_rollup_hour
+			start_time = time.time()
+			try:
+				with transaction.atomic():
+					daemon.run_inline()
+					raise Rollback()
+			except Rollback:
+				pass
+			finally:
+				with counters._counters_lock:
+					counters._counters = process_counters
+				rollups._last_rollup_hour = last_rollup_hour
+			elapsed = max(time.time() - start_time, 1e-6)
+			command_count = sum(fake.command_counts.values())
+		latency = daemon.refill_latency.snapshot()
+		self.stdout.write('%d track changes in %.2fs: %.1f/s, %.1f MPD commands each' % (
+			fake.track_changes, elapsed, fake.track_changes / elapsed,
+			command_count / float(max(fake.track_changes, 1))))
+		if latency['count']:
+			self.stdout.write('Refill latency over %d refills: mean %.1fms, p50 %.1fms, ' \
+				'p95 %.1fms, p99 %.1fms, max %.1fms' % (latency['count'],
+				latency['mean'] * 1000, latency['p50'] * 1000, latency['p95'] * 1000,
+				latency['p99'] * 1000, latency['max'] * 1000))
@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand, CommandError
+from afkradio.models import MPD_DB_ROOT
+from afkradio.scanner import LibraryScanner, EXTRACT_BATCH_SIZE
+from afkradio.exifpool import read_metadata as read_exiftool_metadata
+from afkradio.tagreader import read_tags
+from afkradio.errors import *
+from optparse import make_option
+import itertools
+import os
+import time
+
+class Command(BaseCommand):
+	args = '[music directory]'
+	help = 'Compares the ingest throughput of the in-process tag reader with exiftool. ' + \
+		'Reads files under the MPD root unless a directory is given'
+	option_list = BaseCommand.option_list + (
+		make_option('--limit', type='int', default=1000,
+			help='Number of files to read (default 1000)'),
+		make_option('--runs', type='int', default=3,
+			help='Timed runs of each reader, the fastest is reported (default 3)'),
+		)
+
+	def handle(self, *args, **options):
+		root = args[0] if args else MPD_DB_ROOT
+		if not root or not os.path.isdir(root):
+			raise CommandError('Music directory not found: ' + root)
+		rel_song_paths = list(itertools.islice(LibraryScanner(root).walk(), options['limit']))
+		abs_song_paths = [os.path.join(root, rel_song_path) for rel_song_path in rel_song_paths]
+		total_bytes = sum(os.path.getsize(abs_song_path) for abs_song_path in abs_song_paths)
+		if not abs_song_paths:
+			raise CommandError('No songs found in ' + root)
+
+		def read_with_tagreader(batch):
+			unparsed = 0
+			for abs_song_path in batch:
+				try:
+					read_tags(abs_song_path)
+				except TagReadError:
+					unparsed += 1
+			return unparsed
+
+		def read_with_exiftool(batch):
+			return len(batch) - len(read_exiftool_metadata(batch))
+
+		def timed_read(reader):
+			unread = 0
+			start_time = time.time()
+			for index in range(0, len(abs_song_paths), EXTRACT_BATCH_SIZE):
+				unread += reader(abs_song_paths[index:index+EXTRACT_BATCH_SIZE])
+			return max(time.time() - start_time, 1e-6), unread
+
+		readers = [('exiftool', read_with_exiftool), ('tagreader', read_with_tagreader)]
+		# An untimed pass of both readers starts the exiftool workers and
+		# brings what each of them reads into the page cache, so neither is
+		# timed on a cache the other one warmed.  The order is then swapped
+		# every run
+		for reader_name, reader in readers:
+			timed_read(reader)
+		results = {}
+		for run in range(max(options['runs'], 1)):
+			for reader_name, reader in (readers if run % 2 == 0 else readers[::-1]):
+				elapsed, unread = timed_read(reader)
+				if reader_name not in results or elapsed < results[reader_name][0]:
+					results[reader_name] = (elapsed, unread)
+		for reader_name, reader in readers:
+			elapsed, unread = results[reader_name]
+			self.stdout.write('%-10s %d files in %.2fs: %.1f files/s, %.1f MB/s, %d unread' % (
+				reader_name, len(abs_song_paths), elapsed, len(abs_song_paths) / elapsed,
+				total_bytes / elapsed / 1048576, unread))
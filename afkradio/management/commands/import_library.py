@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand, CommandError
+from afkradio.models import MPD_DB_ROOT, format_duration
+from afkradio.scanner import LibraryScanner, WRITE_BATCH_SIZE
+from afkradio.errors import *
+from optparse import make_option
+import os
+import time
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 5
+
+
+# ImportProgress
+# Prints the throughput and ETA of a scan at most every interval seconds
+class ImportProgress:
+	def __init__(self, stdout, interval=PROGRESS_INTERVAL):
+		self.stdout = stdout
+		self.interval = interval
+		self.start_time = time.time()
+		self.last_report = self.start_time
+		self.last_done_count = 0
+
+	def __call__(self, scanner, force=False):
+		now = time.time()
+		if not force and now - self.last_report < self.interval:
+			return
+		if scanner.done_count == self.last_done_count:
+			return
+		self.last_report = now
+		self.last_done_count = scanner.done_count
+		elapsed = max(now - self.start_time, 0.001)
+		files_per_sec = scanner.done_count / elapsed
+		mb_per_sec = scanner.done_bytes / elapsed / (1024 * 1024)
+		if files_per_sec:
+			eta = format_duration((scanner.total_count - scanner.done_count) / files_per_sec)
+		else:
+			eta = '?'
+		self.stdout.write('%d/%d files, %.1f files/s, %.1f MB/s, ETA %s' %
+				(scanner.done_count, scanner.total_count, files_per_sec, mb_per_sec, eta))
+
+class Command(BaseCommand):
+	help = 'Imports every song under the MPD root.  Songs are committed every ' + \
+		'--checkpoint songs, so an interrupted import can be run again and ' + \
+		'carries on where it stopped'
+	option_list = BaseCommand.option_list + (
+		make_option('--checkpoint', type='int', default=WRITE_BATCH_SIZE,
+			help='Number of songs committed at a time (default %d)' % WRITE_BATCH_SIZE),
+		make_option('--workers', type='int', default=None,
+			help='Number of threads reading tags (default: one per exiftool worker)'),
+		make_option('--interval', type='float', default=PROGRESS_INTERVAL,
+			help='Seconds between progress lines (default %d)' % PROGRESS_INTERVAL),
+		)
+
+	def handle(self, *args, **options):
+		if MPD_DB_ROOT == '' or not os.path.isdir(MPD_DB_ROOT):
+			raise MPDRootNotFound()
+		if options['checkpoint'] < 1:
+			raise CommandError('--checkpoint has to be at least 1')
+		progress = ImportProgress(self.stdout, options['interval'])
+		scanner = LibraryScanner(MPD_DB_ROOT, workers=options['workers'],
+				batch_size=options['checkpoint'], progress=progress)
+		self.stdout.write('Looking for new and changed songs in ' + MPD_DB_ROOT)
+		try:
+			dupe_list = scanner.scan()
+		except KeyboardInterrupt:
+			progress(scanner, force=True)
+			self.stdout.write('Interrupted.  %d songs were saved, run import_library ' \
+					'again to carry on' % (scanner.added_count + scanner.updated_count +
+						scanner.moved_count))
+			return
+		progress(scanner, force=True)
+		self.stdout.write('Added %d, updated %d, moved %d and removed %d songs ' \
+				'(%d unchanged) in %s' % (scanner.added_count, scanner.updated_count,
+					scanner.moved_count, scanner.removed_count, len(dupe_list),
+					format_duration(time.time() - progress.start_time)))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from afkradio.rollups import roll_up, HISTORY_RETENTION_DAYS, HOURLY_ROLLUP_RETENTION_DAYS
+
+class Command(BaseCommand):
+	help = 'Rolls play history up into hourly and daily play counts and prunes ' + \
+		'plays older than %d days and hourly counts older than %d days' % \
+		(HISTORY_RETENTION_DAYS, HOURLY_ROLLUP_RETENTION_DAYS)
+
+	def handle(self, *args, **options):
+		play_count = roll_up()
+		self.stdout.write('Rolled up %d plays' % play_count)
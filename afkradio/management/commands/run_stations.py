@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from afkradio.models import Station
+from afkradio.stream import StreamDaemon, STREAM_METRICS_FILE
+from optparse import make_option
+import logging
+import multiprocessing
+import os
+
+# station_metrics_file
+# Each station writes its metrics next to the configured file, with the
+# station's name before the extension
+def station_metrics_file(station):
+	if not STREAM_METRICS_FILE:
+		return ''
+	root, extension = os.path.splitext(STREAM_METRICS_FILE)
+	return root + '.' + station.name + extension
+
+# run_station
+# Body of a station's process: the station's stream until its MPD stops
+def run_station(station_pk, init, from_setlists):
+	station = Station.objects.get(pk=station_pk)
+	try:
+		StreamDaemon(from_setlists, metrics_file=station_metrics_file(station),
+				station=station).run(init)
+	except KeyboardInterrupt:
+		pass
+	except Exception:
+		logging.exception('The stream of station ' + station.name + ' stopped')
+		raise
+
+class Command(BaseCommand):
+	args = '[station name ...]'
+	help = 'Runs the stream of every active station (or of the named ones), ' + \
+		'each in a process of its own, until their MPDs stop'
+	option_list = BaseCommand.option_list + (
+		make_option('--no-init', action='store_false', dest='init', default=True,
+			help="Play the stations' queues as they are instead of refilling them"),
+		make_option('--all-songs', action='store_false', dest='from_setlists',
+			default=True, help='Pick from all songs instead of the setlists'),
+		)
+
+	def handle(self, *args, **options):
+		if args:
+			stations = list(Station.objects.filter(name__in=args))
+			missing_names = set(args) - set(station.name for station in stations)
+			if missing_names:
+				raise CommandError('No station named ' + ', '.join(sorted(missing_names)))
+		else:
+			stations = list(Station.objects.filter(active=True))
+		if not stations:
+			raise CommandError('There are no active stations')
+		# The processes open database connections of their own, they can't
+		# share this one
+		connection.close()
+		processes = [multiprocessing.Process(target=run_station,
+				args=(station.pk, options['init'], options['from_setlists']),
+				name='afkradio station ' + station.name) for station in stations]
+		for process in processes:
+			process.start()
+		try:
+			for process in processes:
+				process.join()
+		except KeyboardInterrupt:
+			for process in processes:
+				process.terminate()
+				process.join()
+		for station, process in zip(stations, processes):
+			self.stdout.write('Station %s stopped (exit code %s)' % (station.name,
+					process.exitcode))
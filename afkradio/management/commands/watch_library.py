@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from afkradio.models import MPD_DB_ROOT
+from afkradio.watcher import LibraryWatcher, DEBOUNCE_SECONDS
+from afkradio.errors import *
+from optparse import make_option
+import os
+
+class Command(BaseCommand):
+	help = 'Watches the MPD root with inotify and adds, updates or removes songs ' + \
+		'as their files change'
+	option_list = BaseCommand.option_list + (
+		make_option('--debounce', type='float', default=DEBOUNCE_SECONDS,
+			help='Seconds a file has to be quiet before it is ingested ' + \
+				'(default %s)' % DEBOUNCE_SECONDS),
+		make_option('--no-mpd-update', action='store_false', dest='update_mpd',
+			default=True, help="Don't run mpc update for changed folders"),
+		)
+
+	def handle(self, *args, **options):
+		if MPD_DB_ROOT == '' or not os.path.isdir(MPD_DB_ROOT):
+			raise MPDRootNotFound()
+		watcher = LibraryWatcher(MPD_DB_ROOT, options['debounce'], options['update_mpd'])
+		try:
+			watcher.run()
+		except KeyboardInterrupt:
+			self.stdout.write('Stopped watching ' + MPD_DB_ROOT)
+		except InotifyError as error:
+			raise CommandError('Could not watch ' + MPD_DB_ROOT)
@@ -0,0 +1,40 @@
+from collections import deque
+import threading
+
+# Number of recent samples percentiles are taken over
+METRIC_WINDOW = 1000
+
+
+# LatencyMetric
+# Count, mean and max of every sample, and percentiles of the recent ones
+class LatencyMetric:
+	def __init__(self, window=METRIC_WINDOW):
+		self.samples = deque(maxlen=window)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.lock = threading.Lock()
+
+	def observe(self, seconds):
+		with self.lock:
+			self.samples.append(seconds)
+			self.count += 1
+			self.total += seconds
+			self.max = max(self.max, seconds)
+
+	def percentile(self, sorted_samples, fraction):
+		if not sorted_samples:
+			return None
+		return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * fraction))]
+
+	def snapshot(self):
+		with self.lock:
+			samples = sorted(self.samples)
+			return {
+				'count': self.count,
+				'mean': self.total / self.count if self.count else None,
+				'max': self.max if self.count else None,
+				'p50': self.percentile(samples, 0.5),
+				'p95': self.percentile(samples, 0.95),
+				'p99': self.percentile(samples, 0.99),
+				}
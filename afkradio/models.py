@@ -3,10 +3,15 @@ from django.utils import timezone
 from afkradio.errors import *
 from django.core.exceptions import FieldError
 from django.core.urlresolvers import reverse
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from afkradio.albumart import store_album_art
+from afkradio.tagreader import read_metadata, audio_fingerprint
+from afkradio.idcache import IdArrayCache, KeyedIdArrayCache
+from afkradio.mpd import MPDClient, using
+import copy
 import random
 import json
 import os
-import subprocess
 
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 
@@ -15,6 +20,46 @@ with open(os.path.join(APP_ROOT,'config.json')) as config_file:
 	MPD_DB_ROOT = config_data['MPD DB root']
 	STATIC_FILE_ROOT = config_data['Static file root']
 
+# format_duration
+# Formats a duration in seconds as H:MM:SS
+def format_duration(seconds):
+	seconds = int(float(seconds))
+	return '%d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+# parse_duration
+# Turns a stored H:MM:SS (or M:SS) duration back into seconds, or None if it
+# can't be read.  Only needed to fill duration_secs for existing songs
+def parse_duration(duration):
+	seconds = 0
+	try:
+		for part in duration.strip().split(':'):
+			seconds = seconds * 60 + int(float(part))
+	except ValueError:
+		return None
+	return seconds
+
+
+# pick_song_id
+# Picks an id from an array of song ids with engine, or uniformly at random
+def pick_song_id(song_ids, engine=None):
+	if engine is not None:
+		return engine.pick(song_ids)
+	if not song_ids:
+		return None
+	return song_ids[random.randrange(len(song_ids))]
+
+# pick_song_ids
+# Picks count ids from an array of song ids with engine, or uniformly at
+# random (without repeats unless there are fewer than count songs)
+def pick_song_ids(song_ids, count, engine=None):
+	if engine is not None:
+		return engine.pick_many(song_ids, count)
+	if not song_ids:
+		return []
+	if count <= len(song_ids):
+		return random.sample(song_ids, count)
+	return [song_ids[random.randrange(len(song_ids))] for pick in range(count)]
+
 
 # Songs Model
 # Store Songs as well as their metadata here
@@ -23,12 +68,20 @@ with open(os.path.join(APP_ROOT,'config.json')) as config_file:
 # album is Song Album
 # year is Year the song was released
 # duration is Duration of the song in H:MM:SS
+# duration_secs is the same duration in whole seconds, for anything that has
+# 	to add durations up
 # filepath is the path to the song in relation to the mpd song db root
 # 	(i.e. if the root of the mpd is '~/mpd_music'
 # 	the song is located in '~/mpd_music/album/artist/example.mp3'
 # 	then filepath would be '/album/artist/example.mp3'
 # date_added is the date the song was added to the database
 # extra is for any other extra data or tags to aid in searching
+# file_size, file_mtime and file_inode are the manifest of the file as it was
+# 	when the metadata was last read.  Rescans compare them against os.stat
+# 	to only re-read new or changed files
+# removed is set when a rescan no longer finds the file under the mpd root
+# fingerprint is a hash of the audio payload (without tags) so a rescan can
+# 	recognise a song that was moved or renamed
 class SongManager(models.Manager):
 	def check_if_exists(self, song_query, field=id):
 		try: 
@@ -53,28 +106,112 @@ class SongManager(models.Manager):
 			raise SongNotFoundError('The song with the id ' + song_id +
 				' does not exist')
 	
-	def get_random(self):
-		if self.count():
-			last = self.count() - 1
-			index = random.randint(0, last)
-			return self.all()[index]
-		else:
-			raise SongNotFoundError( 'There are no songs in the database yet. Please click ' + \
-				'Update Database in the admin panel or run Control.scan_for_songs() in ' + \
-				' afkradio.utils from the shell' )
-
-	def get_random_from_active_setlists(self):
-		active_songs = list(Setlist.objects.song_ids_of_active_setlists())
-		if not active_songs or not active_songs[0]:
+	# Songs whose file is still in the mpd root
+	def available(self):
+		return self.filter(removed=False)
+
+	# get_random
+	# Picks a random id from available_song_ids and fetches that one song.
+	# If the song went away since the ids were loaded (in another process)
+	# the ids are reloaded and the pick is made again.  engine, if given, is a
+	# selection engine from afkradio.scheduler that does the picking
+	def get_random(self, engine=None):
+		for attempt in range(2):
+			random_song_id = pick_song_id(available_song_ids.get_ids(), engine)
+			if random_song_id is None:
+				break
 			try:
-				raise SongNotFoundError( 'There are no songs associated to the active setlists' )
-			except SongNotFoundError:
-				return False
-		else:
-			active_song_count = len(active_songs)
-			index = random.randint(0,active_song_count-1)
-			random_active_song_id = active_songs[index]
-			return self.get(pk=random_active_song_id)
+				return self.available().get(pk=random_song_id)
+			except Song.DoesNotExist:
+				available_song_ids.invalidate()
+		raise SongNotFoundError( 'There are no songs in the database yet. Please click ' + \
+			'Update Database in the admin panel or run Control.scan_for_songs() in ' + \
+			' afkradio.utils from the shell' )
+
+	# get_random_from_rule
+	# Picks a random song from the songs matching a setlist rule such as
+	# '(Fast | Anime) - Ballads', see afkradio.setlistrules.  Returns False if
+	# no songs match
+	def get_random_from_rule(self, rule, engine=None):
+		# setlistrules builds on the models, so it can only be imported here
+		from afkradio.setlistrules import song_ids_matching_rule, invalidate_songs
+		for attempt in range(2):
+			random_song_id = pick_song_id(song_ids_matching_rule(rule), engine)
+			if random_song_id is None:
+				break
+			try:
+				return self.available().get(pk=random_song_id)
+			except Song.DoesNotExist:
+				invalidate_songs()
+		try:
+			raise SongNotFoundError( 'There are no songs matching the rule ' + rule )
+		except SongNotFoundError:
+			return False
+
+	# get_random_batch
+	# Picks count songs with one call to the engine (see pick_song_ids) and
+	# fetches them in one query.  Songs that went away since the ids were
+	# loaded are left out, so fewer than count songs can come back
+	def get_random_batch(self, count, engine=None):
+		return self.fetch_batch(self.available(),
+				pick_song_ids(available_song_ids.get_ids(), count, engine))
+
+	# get_random_batch_from_active_setlists
+	# get_random_batch for the songs of the active setlists
+	def get_random_batch_from_active_setlists(self, count, engine=None):
+		setlist_pks = frozenset(active_setlist_pks.get_ids())
+		if not setlist_pks:
+			return []
+		return self.fetch_batch(self.available().filter(setlist__active=True),
+				pick_song_ids(active_setlist_song_ids.get_ids(setlist_pks), count, engine))
+
+	# get_random_batch_from_setlists
+	# get_random_batch for the songs of the setlists with the given pks,
+	# active or not (a station's own setlists)
+	def get_random_batch_from_setlists(self, setlist_pks, count, engine=None):
+		setlist_pks = frozenset(setlist_pks)
+		if not setlist_pks:
+			return []
+		return self.fetch_batch(self.available().filter(setlist__pk__in=setlist_pks),
+				pick_song_ids(active_setlist_song_ids.get_ids(setlist_pks), count, engine))
+
+	# fetch_batch
+	# Returns the songs in songs with the given ids, in the same order (and
+	# with the same repeats) as the ids
+	def fetch_batch(self, songs, song_ids):
+		if not song_ids:
+			return []
+		songs = dict((song.pk, song) for song in songs.filter(pk__in=set(song_ids)).distinct())
+		if len(songs) < len(set(song_ids)):
+			available_song_ids.invalidate()
+			active_setlist_pks.invalidate()
+			active_setlist_song_ids.invalidate()
+		return [songs[song_id] for song_id in song_ids if song_id in songs]
+
+	# get_random_from_active_setlists
+	# Picks a random song from the cached pool of the current combination of
+	# active setlists.  Returns False if they have no songs
+	def get_random_from_active_setlists(self, engine=None):
+		for attempt in range(2):
+			setlist_pks = frozenset(active_setlist_pks.get_ids())
+			random_active_song_id = None
+			if setlist_pks:
+				random_active_song_id = pick_song_id(
+						active_setlist_song_ids.get_ids(setlist_pks), engine)
+			if random_active_song_id is None:
+				break
+			# Checking the setlists again here costs nothing extra and catches
+			# changes made by another process
+			random_active_song = self.available().filter(pk=random_active_song_id,
+					setlist__active=True)[:1]
+			if random_active_song:
+				return random_active_song[0]
+			active_setlist_pks.invalidate()
+			active_setlist_song_ids.invalidate()
+		try:
+			raise SongNotFoundError( 'There are no songs associated to the active setlists' )
+		except SongNotFoundError:
+			return False
 
 
 class Song(models.Model):
@@ -85,17 +222,32 @@ class Song(models.Model):
 	year = models.CharField(max_length=20, blank=True)
 	genre = models.CharField(max_length=50, blank=True)
 	duration = models.CharField(max_length=20, blank=True)
+	duration_secs = models.PositiveIntegerField(null=True, blank=True)
 	filepath = models.CharField(max_length=500, blank=True)
 	artpath = models.CharField(max_length=500, blank=True)
 	date_added = models.DateTimeField('Date Added', null=True, blank=True)
 	extra = models.CharField(max_length=500, blank=True)
 	playcount = models.PositiveIntegerField(default=0)
 	favecount = models.PositiveIntegerField(default=0)
+	file_size = models.BigIntegerField(null=True, blank=True)
+	file_mtime = models.FloatField(null=True, blank=True)
+	file_inode = models.BigIntegerField(null=True, blank=True)
+	removed = models.BooleanField(default=False)
+	fingerprint = models.CharField(max_length=40, blank=True, db_index=True)
 	objects = SongManager()
 
+	# Fields read from the file.  Used to update a changed song in place
+	# without touching its counters or date_added
+	metadata_fields = ('title', 'artist', 'album', 'trackno', 'year', 'genre',
+		'duration', 'duration_secs', 'artpath', 'file_size', 'file_mtime', 'file_inode', 'removed',
+		'fingerprint')
+	# Fields that describe where the file is.  Used to move a song to a new path
+	manifest_fields = ('filepath', 'file_size', 'file_mtime', 'file_inode', 'removed',
+		'fingerprint')
+
 	# add_song_exiftool method
-	# Given the song path relative MPD_DB_ROOT, runs exiftool
-	# on the song and adds the song to the database with existing
+	# Given the song path relative MPD_DB_ROOT, reads the tags of
+	# the song and adds the song to the database with existing
 	# metadata
 	@classmethod
 	def add_song_exiftool(cls, rel_song_path, extra=None):
@@ -109,16 +261,42 @@ class Song(models.Model):
 		if cls.objects.filter(filepath=rel_song_path):
 			raise DuplicateEntryError("There is already a song with the same path in the database: " +
 					abs_song_path)
+		new_song = cls.from_file(rel_song_path, extra)
+		if new_song.artist == 'volume: n/a   repeat:':
+			return "'volume: n/a   repeat:' is an invalid artist.  " + \
+					"Please don't try to break the stream"
+		new_song.save()
+
+	# from_file method
+	# Given the song path relative MPD_DB_ROOT, reads the song's tags (in
+	# process, or with exiftool for files tagreader can't parse) and returns
+	# a new unsaved Song filled with the metadata that was found.
+	# Does not touch the database so it can be run from several threads
+	# at once by the library scanner
+	@classmethod
+	def from_file(cls, rel_song_path, extra=None):
+		# Get absolute path of song
+		abs_song_path = os.path.join(MPD_DB_ROOT, rel_song_path)
+		metadata = read_metadata([abs_song_path])
+		# Halt if no file was found in the rel_song_path
+		if abs_song_path not in metadata:
+			raise FileNotFoundError("File not found: " + abs_song_path)
+		return cls.from_metadata(rel_song_path, metadata[abs_song_path], extra)
+
+	# from_metadata method
+	# Builds a new unsaved Song from the {tag: value} dict tagreader or
+	# exiftool -j gave for the song at rel_song_path.  The audio fingerprint
+	# is computed unless the caller already has it
+	@classmethod
+	def from_metadata(cls, rel_song_path, metadata, extra=None, fingerprint=None):
 		# Create our new song instance and tie fields to variables
 		new_song = cls()
 		# Get absolute path of song
 		abs_song_path = os.path.join(MPD_DB_ROOT, rel_song_path)
 		# List supported file types in supported_file_types
 		supported_file_types = ('MP3', 'OGG', 'FLAC',)
-		# image_suffix to hold and later check if there's an image embedded in the song 
-		image_suffix = ''
 		# Dict of metadata that we want from exiftool and corresponding fields
-		# Keys are exiftool labels for the metadata
+		# Keys are exiftool tag names for the metadata
 		# Values are the corresponding field names of our new Songs model object
 		metadata_dict = {
 				'Year' : 'year',
@@ -126,91 +304,56 @@ class Song(models.Model):
 				'Album' : 'album',
 				'Title' : 'title',
 				'Artist' : 'artist',
-				'Duration' : 'duration',
-				'Track' : 'trackno',
 				}
-		# Preemptively set our IntegerField trackno to None
+		# Halt if the file is not a supported file type
+		file_type = metadata.get('FileType', '')
+		if file_type not in supported_file_types:
+			raise FileTypeError(
+				'Not a supported file type. The song located at "' + abs_song_path + \
+					' is  a ' + file_type + '" which is not ' + \
+					str(supported_file_types)
+			)
+		for metadata_entry, field in metadata_dict.items():
+			if metadata_entry in metadata:
+				setattr(new_song, field, unicode(metadata[metadata_entry]))
+		# Some songs have a TRACKTOTAL field in Track (i.e. 3/12)
 		new_song.trackno = None
-		# Run exiftool on the song
-		exiftool_path = APP_ROOT + '/exiftool/exiftool'
-		proc = subprocess.Popen([exiftool_path, abs_song_path],
-				 stderr = subprocess.STDOUT,
-				 stdout = subprocess.PIPE)
-		while True:
-			line = proc.stdout.readline()
-			# Halt if no file was found in the rel_song_path
-			if line.startswith('File not found'):
-				raise FileNotFoundError("File not found: " + abs_song_path)
-			# Halt if the file is not a supported file type
-			elif line.startswith('File Type'):
-				colon_index = line.find(':')
-				exiftool_metadata_contents = line[(colon_index+2):-1]
-				file_type = exiftool_metadata_contents
-				if file_type not in supported_file_types:
-					raise FileTypeError(
-						'Not a supported file type. The song located at "' + abs_song_path + \
-							' is  a ' + file_type + '" which is not ' + \
-							str(supported_file_types)
-					)
-			elif line !='':
-				# Get any metadata we can find from the song that's one of the
-				# metadata entries defined in metadata_dict
-				for metadata_entry in metadata_dict.keys():
-					if line.startswith(metadata_entry):
-						colon_index = line.find(':')
-						exiftool_metadata_contents = line[(colon_index+2):-1]
-						# Set field to the exiftool metadata we found. Make sure trackno is int
-						if metadata_entry == 'Track':
-							# Some songs have a TRACKTOTAL field that may obscure our scrape
-							slash_index = line.find('/')
-							if slash_index != -1: # Found '/' in Track field
-								exiftool_metadata_contents = line[(colon_index+2):slash_index]
-							setattr(new_song, metadata_dict[metadata_entry],
-								int(exiftool_metadata_contents))
-						else: 
-							setattr(new_song, metadata_dict[metadata_entry],
-								exiftool_metadata_contents)
-					# Check if there's embedded art
-					elif line.startswith('Picture Mime Type'):
-						colon_index = line.find('/')
-						image_type = line[(colon_index+1):-1]
-						if image_type == 'png':
-							image_suffix = 'png'
-						elif image_type == 'jpeg':
-							image_suffix = 'jpg'
+		if 'Track' in metadata:
+			try:
+				new_song.trackno = int(unicode(metadata['Track']).split('/')[0])
+			except ValueError:
+				pass
+		# Duration comes back in seconds
+		if 'Duration' in metadata:
+			try:
+				new_song.duration_secs = int(float(metadata['Duration']))
+			except ValueError:
+				pass
 			else:
-				break
-		# exiftool has (approx) after duration.  Let's get rid of it
-		if new_song.artist == 'volume: n/a   repeat:':
-			return "'volume: n/a   repeat:' is an invalid artist.  " + \
-					"Please don't try to break the stream"
-		if new_song.duration is not None:
-			new_song.duration = new_song.duration[0:7]
+				new_song.duration = format_duration(new_song.duration_secs)
+		# Queue embedded art to be saved to the static folder if we got some
+		new_song.artpath = store_album_art(metadata.get('Picture'),
+				metadata.get('PictureMIMEType'))
 		# Add file path data
 		new_song.filepath = rel_song_path
 		# Add Date Added data
 		new_song.date_added = timezone.now()
+		# Record the manifest and fingerprint of the file we just read
+		new_song.set_manifest(os.stat(abs_song_path))
+		if fingerprint is None:
+			fingerprint = audio_fingerprint(abs_song_path)
+		new_song.fingerprint = fingerprint
 		# Add extra data if we got some
 		if extra is not None and not '':
 			new_song.extra = extra
-		new_song.save()
-		# Save embedded image to static folder if we got one
-		if image_suffix:
-			dir_name = os.path.join(STATIC_FILE_ROOT, 'afkradio/album_art')
-			base_filename = str(new_song.pk)
-			filename_suffix = '.' + image_suffix
-			image_path = os.path.join(dir_name, base_filename + filename_suffix)
-			[static_path_head, static_path_tail] = os.path.split(STATIC_FILE_ROOT)
-			static_path_tail = os.path.join('/' , static_path_tail)
-			rel_dir_name = os.path.join(static_path_tail, 'afkradio/album_art')
-			rel_path = os.path.join(rel_dir_name, base_filename + filename_suffix) 
-			with open(image_path, 'wb') as image_out:
-				save_proc = subprocess.Popen([exiftool_path, '-picture', '-b', abs_song_path],
-						 stderr = subprocess.PIPE,
-						 stdout = image_out)
-			# Add image path to artpath
-			new_song.artpath = rel_path
-			new_song.save()
+		return new_song
+
+	# set_manifest method
+	# Stores the size, mtime and inode of an os.stat result on the song
+	def set_manifest(self, file_stat):
+		self.file_size = file_stat.st_size
+		self.file_mtime = file_stat.st_mtime
+		self.file_inode = file_stat.st_ino
 
 
 	def __unicode__(self):
@@ -219,6 +362,24 @@ class Song(models.Model):
 		except TypeError:
 			return 'Empty title field'
 
+# Ids of the songs in Song.objects.available(), for get_random.  Saving or
+# deleting a song invalidates them; bulk_create and update() don't send
+# signals, so code using them (the library scanner) has to invalidate too
+available_song_ids = IdArrayCache(lambda: Song.objects.available()
+		.values_list('pk', flat=True).iterator())
+post_save.connect(available_song_ids.invalidate, sender=Song,
+		dispatch_uid='afkradio.available_song_ids.post_save')
+post_delete.connect(available_song_ids.invalidate, sender=Song,
+		dispatch_uid='afkradio.available_song_ids.post_delete')
+
+# manifest_matches
+# Compares a stored (size, mtime, inode) manifest with an os.stat result
+def manifest_matches(manifest, file_stat):
+	file_size, file_mtime, file_inode = manifest
+	return file_size == file_stat.st_size and \
+		file_mtime == file_stat.st_mtime and \
+		file_inode == file_stat.st_ino
+
 # Setlist Model
 # Available Setlists to associate with songs are stored here.
 # Setlists are created and associated with songs in order to have
@@ -255,7 +416,8 @@ class SetlistManager(models.Manager):
 		return self.filter(active=True)
 
 	def song_ids_of_active_setlists(self):
-		return self.filter(active=True).values_list('associated_songs', flat=True).distinct()
+		return self.filter(active=True, associated_songs__removed=False).values_list(
+				'associated_songs', flat=True).distinct()
 
 class Setlist(models.Model):
 	setlist = models.CharField(max_length=50)
@@ -284,6 +446,79 @@ class Setlist(models.Model):
 	def __unicode__(self):
 		return self.setlist
 
+# Pks of the active setlists, and the ids of the available songs in each
+# combination of setlists that has been picked from (keyed by the frozenset
+# of their pks), the active ones or a station's.  A change to a setlist's songs only drops the
+# pools that include that setlist
+active_setlist_pks = IdArrayCache(lambda: Setlist.objects.active_setlists()
+		.values_list('pk', flat=True).iterator())
+active_setlist_song_ids = KeyedIdArrayCache(lambda setlist_pks: Song.objects.available()
+		.filter(setlist__pk__in=setlist_pks).values_list('pk', flat=True)
+		.distinct().iterator())
+
+# Activating, deactivating or deleting a setlist changes the combination,
+# the pools of other combinations stay valid
+def setlist_changed(sender, instance, **kwargs):
+	active_setlist_pks.invalidate()
+
+def setlist_songs_changed(sender, instance, action, reverse, pk_set, **kwargs):
+	if action not in ('post_add', 'post_remove', 'pre_clear', 'post_clear'):
+		return
+	if not reverse:
+		changed_setlist_pks = set([instance.pk])
+	elif pk_set:
+		changed_setlist_pks = pk_set
+	else:
+		# A song's setlists were cleared, we don't know which ones they were
+		active_setlist_song_ids.invalidate()
+		return
+	active_setlist_song_ids.invalidate(
+			lambda setlist_pks: not changed_setlist_pks.isdisjoint(setlist_pks))
+
+# New songs aren't in any setlist yet, other saves may have removed the song
+def setlist_song_saved(sender, instance, created, **kwargs):
+	if not created:
+		active_setlist_song_ids.invalidate()
+
+post_save.connect(setlist_changed, sender=Setlist,
+		dispatch_uid='afkradio.active_setlist_song_ids.setlist_post_save')
+post_delete.connect(setlist_changed, sender=Setlist,
+		dispatch_uid='afkradio.active_setlist_song_ids.setlist_post_delete')
+m2m_changed.connect(setlist_songs_changed, sender=Setlist.associated_songs.through,
+		dispatch_uid='afkradio.active_setlist_song_ids.m2m_changed')
+post_save.connect(setlist_song_saved, sender=Song,
+		dispatch_uid='afkradio.active_setlist_song_ids.song_post_save')
+
+# Station Model
+# A stream of its own, played by a separate MPD instance from the same
+# library: its own queue and play history, picked from its own setlists.
+# Songs and setlists are shared by all the stations.
+# setlists are the setlists the station picks from, the active setlists
+# 	when it has none
+# Playlist and PlayHistory rows without a station belong to the default
+# station, the MPD set in config.json, which has no row here
+class Station(models.Model):
+	name = models.CharField(max_length=50, unique=True)
+	mpd_host = models.CharField(max_length=200, default='localhost')
+	mpd_port = models.PositiveIntegerField(default=6600)
+	mpd_password = models.CharField(max_length=200, blank=True)
+	setlists = models.ManyToManyField(Setlist, blank=True)
+	active = models.BooleanField(default=True)
+
+	def setlist_pks(self):
+		return frozenset(self.setlists.values_list('pk', flat=True))
+
+	def mpd_client(self):
+		return MPDClient(self.mpd_host, self.mpd_port, self.mpd_password)
+
+	# mpd
+	# with station.mpd(): Playback in this thread talks to the station's MPD
+	def mpd(self):
+		return using(self.mpd_host, self.mpd_port, self.mpd_password)
+
+	def __unicode__(self):
+		return self.name
+
 class Timer(models.Model):
 	function = models.CharField(max_length=50)
 	user = models.CharField(max_length=75, blank=True)
@@ -295,33 +530,102 @@ class PlayHistoryManager(models.Manager):
 	def clear_playhistory(self):
 		self.all().delete()
 
+	# for_station
+	# The history of one station, None for the default station
+	def for_station(self, station):
+		return self.filter(station=station)
+
+# station is None for the default station
 class PlayHistory(models.Model):
-	song_id = models.CharField(max_length=16)
-	played_time = models.DateTimeField('Time Played')
+	song = models.ForeignKey(Song)
+	played_time = models.DateTimeField('Time Played', db_index=True)
+	station = models.ForeignKey(Station, null=True, blank=True)
+	objects = PlayHistoryManager()
 
 	class Meta:
 		verbose_name = "Play History"
 		verbose_name_plural = "Play History"
+		index_together = [['station', 'played_time']]
 	
 	@classmethod
-	def add_song(cls, new_song_id, set_played_time):
-		new_song = cls(song_id = new_song_id, played_time = set_played_time)
+	def add_song(cls, new_song_id, set_played_time, station=None):
+		new_song = cls(song_id = new_song_id, played_time = set_played_time,
+				station = station)
 		new_song.save()
 
 	def song_title(self):
-		return Song.objects.get(pk=self.song_id).title
+		return self.song.title
 
 	def song_artist(self):
-		return Song.objects.get(pk=self.song_id).title
+		return self.song.artist
+
+	def __unicode__(self):
+		return unicode(self.song_id)
+
+# Play Rollups Model
+# Number of plays of a song per hour or day, built from PlayHistory by
+# afkradio.rollups so charts and stats don't have to read the raw history
+# period is ROLLUP_HOUR or ROLLUP_DAY
+# bucket_start is the (UTC) start of the hour or day
+ROLLUP_HOUR = 'h'
+ROLLUP_DAY = 'd'
+
+class PlayRollup(models.Model):
+	song = models.ForeignKey(Song)
+	period = models.CharField(max_length=1, choices=((ROLLUP_HOUR, 'Hour'), (ROLLUP_DAY, 'Day')))
+	bucket_start = models.DateTimeField('Bucket start')
+	plays = models.PositiveIntegerField(default=0)
+
+	class Meta:
+		verbose_name = "Play Rollup"
+		verbose_name_plural = "Play Rollups"
+		unique_together = [['song', 'period', 'bucket_start']]
+		index_together = [['period', 'bucket_start']]
+
+	def __unicode__(self):
+		return u'%s %s %s: %d' % (self.song_id, self.period, self.bucket_start, self.plays)
+
+# Rollup Watermark Model
+# A single row holding the pk of the last PlayHistory row added to the
+# rollups.  Kept apart from the rollups, which are pruned
+class RollupWatermark(models.Model):
+	last_play_id = models.PositiveIntegerField(default=0)
+
+	class Meta:
+		verbose_name = "Rollup Watermark"
+		verbose_name_plural = "Rollup Watermarks"
 
 	def __unicode__(self):
-		return self.song_id
+		return unicode(self.last_play_id)
+
+# Space left between the positions of songs added to the end of the queue,
+# so a request can be put in between without renumbering the queue
+QUEUE_POSITION_GAP = 1 << 16
 
 class PlaylistManager(models.Manager):
+	# Set on the copies for_station returns
+	scoped = False
+	station = None
+
+	# for_station
+	# This manager limited to the queue of one station, None for the default
+	# station.  Playlist.objects itself sees the queues of all the stations
+	def for_station(self, station):
+		manager = copy.copy(self)
+		manager.scoped = True
+		manager.station = station
+		return manager
+
+	def get_queryset(self):
+		queryset = super(PlaylistManager, self).get_queryset()
+		if self.scoped:
+			queryset = queryset.filter(station=self.station)
+		return queryset
+
 	# Get current song with precedence to user_requested songs
 	def current_song(self):
 		try:
-			current_song = self.order_by('-user_requested', 'add_time')[0]
+			current_song = self.order_by('position')[0]
 			return current_song
 		except Playlist.DoesNotExist:
 			raise SongNotFoundError('There are no songs in the Playlist')
@@ -329,11 +633,45 @@ class PlaylistManager(models.Manager):
 	# Get next song with precedence to user_requested songs
 	def next_song(self):
 		try:
-			next_song = self.order_by('-user_requested', 'add_time')[1]
+			next_song = self.order_by('position')[1]
 			return next_song
 		except Playlist.DoesNotExist:
 			raise SongNotFoundError('Next song does not exist in the Playlist')
 
+	# next_position
+	# Position for a new song: after every song for unrequested songs, after
+	# the other requests (and before the first unrequested song) for requests.
+	# Each lookup is a read of one end of the (user_requested, position) index
+	def next_position(self, requested=False):
+		last_position = self.order_by('-position').values_list('position', flat=True)[:1]
+		if not last_position:
+			return QUEUE_POSITION_GAP
+		if not requested:
+			return last_position[0] + QUEUE_POSITION_GAP
+		first_unrequested = self.filter(user_requested=False).order_by('position') \
+				.values_list('position', flat=True)[:1]
+		if not first_unrequested:
+			return last_position[0] + QUEUE_POSITION_GAP
+		last_requested = self.filter(user_requested=True).order_by('-position') \
+				.values_list('position', flat=True)[:1]
+		if last_requested:
+			low = last_requested[0]
+		else:
+			low = first_unrequested[0] - 2 * QUEUE_POSITION_GAP
+		high = first_unrequested[0]
+		if high - low < 2:
+			# Out of room between the two, space the queue out again
+			self.renumber()
+			return self.next_position(requested)
+		return (low + high) // 2
+
+	# renumber
+	# Spaces the positions of the queue QUEUE_POSITION_GAP apart again
+	def renumber(self):
+		for index, playlist_pk in enumerate(self.order_by('position', 'add_time')
+				.values_list('pk', flat=True)):
+			self.filter(pk=playlist_pk).update(position=(index + 1) * QUEUE_POSITION_GAP)
+
 	def clear_playlist_full(self):
 		self.all().delete()
 
@@ -341,16 +679,16 @@ class PlaylistManager(models.Manager):
 		self.filter(user_requested=False).delete()
 
 	def queue_sorted(self):
-		return self.order_by('-user_requested', 'add_time')
+		return self.select_related('song').order_by('position')
 
 	def queue_sorted_song_id(self):
-		return self.order_by('-user_requested', 'add_time').values_list('song_id', flat=True)
+		return self.order_by('position').values_list('song_id', flat=True)
 
 	def requested_sorted(self):
-		return self.filter(user_requested=True).order_by('add_time')
+		return self.filter(user_requested=True).order_by('position')
 
 	def unrequested_sorted(self):
-		return self.filter(user_requested=False).order_by('add_time')
+		return self.filter(user_requested=False).order_by('position')
 
 	def requested_count(self):
 		return self.filter(user_requested=True).count()
@@ -358,40 +696,89 @@ class PlaylistManager(models.Manager):
 	def unrequested_count(self):
 		return self.filter(user_requested=False).count()
 
+	# song_durations
+	# Returns {song_id: duration in seconds} for the songs in the playlist
+	# in one query.  Songs without a duration count as 0
+	def song_durations(self):
+		return dict((song_id, duration_secs or 0) for song_id, duration_secs in
+				self.values_list('song_id', 'song__duration_secs'))
+
+	# Total length of the queue in seconds
+	def queue_duration(self):
+		return sum(duration_secs or 0 for duration_secs in
+				self.values_list('song__duration_secs', flat=True))
+
 	def last_song(self):
-		last_song = self.filter(user_requested=False).latest('add_time')
+		last_song = self.filter(user_requested=False).order_by('-position')[:1]
 		if not last_song:
-			last_song = self.filter(user_requested=True).latest('add_time')
-		return last_song
-
+			last_song = self.filter(user_requested=True).order_by('-position')[:1]
+		if not last_song:
+			raise Playlist.DoesNotExist()
+		return last_song[0]
+
+# song is the queued Song, its column is still called song_id
+# position is the place of the song in the queue.  Requested songs come
+# before the others, each in the order they were added.  Positions are
+# spaced QUEUE_POSITION_GAP apart so songs can be put in between, within the
+# queue of the song's station
+# station is None for the default station
 class Playlist(models.Model):
-	song_id = models.CharField(max_length=16)
+	song = models.ForeignKey(Song)
 	add_time = models.DateTimeField('Add Time')
 	user_requested = models.BooleanField(default=False)
+	position = models.BigIntegerField(null=True, db_index=True)
+	station = models.ForeignKey(Station, null=True, blank=True)
 	objects = PlaylistManager()
 
 	class Meta:
 		verbose_name = "Playlist Song"
 		verbose_name_plural = "Playlist Songs"
+		# Every lookup is of one station's queue: the ends of the queue and
+		# of its requests are index reads
+		index_together = [['station', 'user_requested', 'position'], ['station', 'position']]
 
 	@classmethod
-	def add_song(cls, new_song_id, requested=False):
+	def add_song(cls, new_song_id, requested=False, station=None):
 		new_song = cls(
 				song_id = new_song_id,
 				add_time = timezone.now(),
 				user_requested = requested,
+				position = cls.objects.for_station(station).next_position(requested),
+				station = station,
 				)
 		new_song.save()
+
+	# add_songs
+	# Adds several songs to the end of the queue with one insert.  Requests
+	# go in one at a time, they need a place in the middle of the queue
+	@classmethod
+	def add_songs(cls, new_song_ids, requested=False, station=None):
+		if requested:
+			for new_song_id in new_song_ids:
+				cls.add_song(new_song_id, True, station)
+			return
+		add_time = timezone.now()
+		first_position = cls.objects.for_station(station).next_position()
+		cls.objects.bulk_create([cls(
+				song_id = new_song_id,
+				add_time = add_time,
+				user_requested = requested,
+				position = first_position + index * QUEUE_POSITION_GAP,
+				station = station,
+				) for index, new_song_id in enumerate(new_song_ids)])
 	
 	def song_title(self):
-		return Song.objects.get(pk=self.song_id).title
+		return self.song.title
 
 	def song_artist(self):
-		return Song.objects.get(pk=self.song_id).artist
+		return self.song.artist
 
 	def song_duration(self):
-		return Song.objects.get(pk=self.song_id).duration
+		return self.song.duration
+
+	def song_duration_secs(self):
+		return self.song.duration_secs or 0
 
 	def __unicode__(self):
-		return self.song_id
+		return unicode(self.song_id)
 
@@ -0,0 +1,356 @@
+from afkradio.errors import *
+from contextlib import contextmanager
+from django.utils.encoding import smart_str
+import json
+import os
+import Queue
+import socket
+import threading
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+with open(os.path.join(APP_ROOT,'config.json')) as config_file:
+	config_data = json.load(config_file)
+	# A host starting with / is the path of MPD's unix socket
+	MPD_HOST = config_data.get('MPD host', 'localhost')
+	MPD_PORT = int(config_data.get('MPD port', 6600))
+	MPD_PASSWORD = config_data.get('MPD password', '')
+	# Connections kept open per process, shared by the web workers' threads
+	MPD_POOL_SIZE = int(config_data.get('MPD pool size', 4))
+
+MPD_TIMEOUT_SECONDS = 10
+
+HELLO_PREFIX = 'OK MPD '
+ERROR_PREFIX = 'ACK '
+SUCCESS = 'OK'
+LIST_SUCCESS = 'list_OK'
+
+# Commands that don't change MPD, safe to send again when the connection
+# drops before their response came back
+READ_ONLY_COMMANDS = frozenset(['commands', 'count', 'currentsong', 'find', 'idle',
+	'list', 'listall', 'listallinfo', 'lsinfo', 'outputs', 'ping', 'playlistfind',
+	'playlistid', 'playlistinfo', 'playlistsearch', 'plchanges', 'plchangesposid',
+	'search', 'stats', 'status', 'tagtypes'])
+
+# Minimal client for MPD's text protocol.  Playback used to start an mpc
+# process per command; this keeps the connection open between commands and
+# sends several commands in one round trip with command lists.
+
+# quote_arg
+# Arguments are sent double quoted, with \ and " escaped
+def quote_arg(arg):
+	if isinstance(arg, (int, long)):
+		return str(arg)
+	arg = smart_str(arg)
+	return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def command_line(command, args=()):
+	return ' '.join([command] + [quote_arg(arg) for arg in args]) + '\n'
+
+def int_or_none(value):
+	if value is None or value == '':
+		return None
+	return int(value)
+
+def float_or_none(value):
+	if value is None or value == '':
+		return None
+	return float(value)
+
+
+# MPDStatus
+# The response to status.  song is the 0-based queue position of the
+# current song, volume is None when MPD has no mixer
+class MPDStatus:
+	def __init__(self, pairs):
+		self.fields = dict(pairs)
+		self.state = self.fields.get('state', 'stop')
+		self.volume = int_or_none(self.fields.get('volume'))
+		if self.volume is not None and self.volume < 0:
+			self.volume = None
+		self.repeat = self.fields.get('repeat') == '1'
+		self.random = self.fields.get('random') == '1'
+		self.playlist_length = int(self.fields.get('playlistlength', 0))
+		self.song = int_or_none(self.fields.get('song'))
+		self.song_id = int_or_none(self.fields.get('songid'))
+		self.elapsed = float_or_none(self.fields.get('elapsed'))
+		self.duration = float_or_none(self.fields.get('duration'))
+		if self.duration is None and ':' in self.fields.get('time', ''):
+			self.duration = float(self.fields['time'].split(':')[1])
+		self.error = self.fields.get('error')
+
+	def is_stopped(self):
+		return self.state == 'stop'
+
+
+# MPDSong
+# One song of a currentsong or playlistinfo response.  position is 0-based
+class MPDSong:
+	def __init__(self, pairs):
+		self.fields = dict(pairs)
+		self.file = self.fields.get('file')
+		self.title = self.fields.get('Title')
+		self.artist = self.fields.get('Artist')
+		self.album = self.fields.get('Album')
+		self.position = int_or_none(self.fields.get('Pos'))
+		self.id = int_or_none(self.fields.get('Id'))
+		self.duration = float_or_none(self.fields.get('duration',
+			self.fields.get('Time')))
+
+	# display_name
+	# What mpc prints for the song: [artist - ]title, else the file path
+	def display_name(self):
+		if self.title:
+			if self.artist:
+				return self.artist + ' - ' + self.title
+			return self.title
+		return self.file
+
+# split_songs
+# Splits the pairs of a multi-song response into MPDSongs, each of which
+# starts at its file key
+def split_songs(pairs):
+	songs = []
+	for key, value in pairs:
+		if key == 'file':
+			songs.append([])
+		if songs:
+			songs[-1].append((key, value))
+	return [MPDSong(song_pairs) for song_pairs in songs]
+
+
+# MPDClient
+# One connection to MPD, connected on first use.  A command sent on a
+# connection MPD dropped while it sat unused (MPD closes idle clients after
+# its connection_timeout) is sent again once on a new connection.  Not
+# thread safe, threads share connections through MPDConnectionPool.
+class MPDClient:
+	def __init__(self, host=MPD_HOST, port=MPD_PORT, password=MPD_PASSWORD,
+			timeout=MPD_TIMEOUT_SECONDS):
+		self.host = host
+		self.port = port
+		self.password = password
+		self.timeout = timeout
+		self.sock = None
+		self.file = None
+		self.version = None
+		# Whether any of the response to the last command has been read
+		self.received = False
+
+	def connect(self):
+		self.close()
+		try:
+			if self.host.startswith('/'):
+				sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				sock.settimeout(self.timeout)
+				sock.connect(self.host)
+			else:
+				sock = socket.create_connection((self.host, self.port), self.timeout)
+		except socket.error as error:
+			raise MPDConnectionError('Could not connect to MPD at ' + self.host + \
+					': ' + str(error))
+		self.attach(sock)
+
+	# attach
+	# Starts the protocol on an already connected socket
+	def attach(self, sock):
+		self.sock = sock
+		self.file = sock.makefile('rb')
+		hello = self.read_line()
+		if not hello.startswith(HELLO_PREFIX):
+			self.close()
+			raise MPDConnectionError('Not an MPD server: ' + hello)
+		self.version = hello[len(HELLO_PREFIX):]
+		if self.password:
+			self.execute('password', self.password)
+
+	def connected(self):
+		return self.sock is not None
+
+	def close(self):
+		if self.sock is not None:
+			try:
+				self.file.close()
+				self.sock.close()
+			except socket.error:
+				pass
+		self.sock = None
+		self.file = None
+
+	def read_line(self):
+		try:
+			line = self.file.readline()
+		except (socket.error, AttributeError) as error:
+			self.close()
+			raise MPDConnectionError('Lost the connection to MPD: ' + str(error))
+		if not line.endswith('\n'):
+			self.close()
+			raise MPDConnectionError('MPD closed the connection')
+		self.received = True
+		return line[:-1]
+
+	def send(self, data):
+		try:
+			self.sock.sendall(data)
+		except socket.error as error:
+			self.close()
+			raise MPDConnectionError('Lost the connection to MPD: ' + str(error))
+
+	# read_pairs
+	# Reads key: value lines up to end (or the final OK).  Raises
+	# MPDCommandError for an ACK
+	def read_pairs(self, end=SUCCESS):
+		pairs = []
+		while True:
+			line = self.read_line()
+			if line == end or line == SUCCESS:
+				return pairs
+			if line.startswith(ERROR_PREFIX):
+				raise MPDCommandError(line[len(ERROR_PREFIX):])
+			key, separator, value = line.partition(': ')
+			pairs.append((key, value.decode('utf-8')))
+
+	# request
+	# Sends data and returns read(), retrying once on a new connection if
+	# the old one turns out to be dead before anything came back.  MPD only
+	# runs a command once its last line arrived, so a failed send is always
+	# retried.  Once data was sent it is only sent again when read_only,
+	# MPD may have run it before the connection dropped
+	def request(self, data, read, read_only=False):
+		if self.sock is None:
+			self.connect()
+		else:
+			self.received = False
+			sent = False
+			try:
+				self.send(data)
+				sent = True
+				return read()
+			except MPDConnectionError:
+				if self.received or (sent and not read_only):
+					raise
+				self.connect()
+		self.received = False
+		self.send(data)
+		return read()
+
+	# execute
+	# Runs one command and returns its response as (key, value) pairs
+	def execute(self, command, *args):
+		return self.request(command_line(command, args), self.read_pairs,
+				command in READ_ONLY_COMMANDS)
+
+	# execute_list
+	# Runs [(command, arg, ...)] in one command list, one round trip for
+	# all of them.  Returns a list of their responses.  MPD stops at the
+	# first failing command, which raises MPDCommandError
+	def execute_list(self, commands):
+		commands = list(commands)
+		if not commands:
+			return []
+		data = 'command_list_ok_begin\n' + ''.join(command_line(command[0], command[1:])
+				for command in commands) + 'command_list_end\n'
+		def read_responses():
+			responses = [self.read_pairs(LIST_SUCCESS) for command in commands]
+			self.read_pairs()
+			return responses
+		return self.request(data, read_responses,
+				all(command[0] in READ_ONLY_COMMANDS for command in commands))
+
+	# idle
+	# Waits, without a timeout, until one of the subsystems changes and
+	# returns the names of the ones that did
+	def idle(self, *subsystems):
+		def read_changes():
+			self.sock.settimeout(None)
+			try:
+				return self.read_pairs()
+			finally:
+				if self.sock is not None:
+					self.sock.settimeout(self.timeout)
+		pairs = self.request(command_line('idle', subsystems), read_changes, True)
+		return [value for key, value in pairs if key == 'changed']
+
+	def status(self):
+		return MPDStatus(self.execute('status'))
+
+	# currentsong
+	# The current song as an MPDSong, or None
+	def currentsong(self):
+		songs = split_songs(self.execute('currentsong'))
+		if songs:
+			return songs[0]
+		return None
+
+	def playlistinfo(self):
+		return split_songs(self.execute('playlistinfo'))
+
+
+# MPDConnectionPool
+# Up to size MPDClients shared between threads.  connection() lends one
+# out and blocks while all of them are in use.  A client whose connection
+# broke, or that was interrupted mid command, is thrown away
+class MPDConnectionPool:
+	def __init__(self, size=MPD_POOL_SIZE, client_factory=MPDClient):
+		self.client_factory = client_factory
+		self.clients = Queue.LifoQueue()
+		self.slots = threading.BoundedSemaphore(size)
+
+	@contextmanager
+	def connection(self):
+		self.slots.acquire()
+		try:
+			try:
+				client = self.clients.get_nowait()
+			except Queue.Empty:
+				client = self.client_factory()
+			try:
+				yield client
+			except MPDCommandError:
+				self.clients.put(client)
+				raise
+			except:
+				client.close()
+				raise
+			self.clients.put(client)
+		finally:
+			self.slots.release()
+
+	def close(self):
+		while True:
+			try:
+				self.clients.get_nowait().close()
+			except Queue.Empty:
+				return
+
+pool = MPDConnectionPool()
+
+# Pools of the other MPDs the process talks to (the stations'), by
+# (host, port, password), and the one the current thread is using if any
+address_pools = {}
+address_pools_lock = threading.Lock()
+thread_pool = threading.local()
+
+# using
+# with using(host, port, password): mpd_connection in this thread borrows
+# from the pool of that MPD instead of the process' pool
+@contextmanager
+def using(host, port=MPD_PORT, password=''):
+	address = (host, port, password)
+	with address_pools_lock:
+		if address not in address_pools:
+			address_pools[address] = MPDConnectionPool(
+					client_factory=lambda: MPDClient(host, port, password))
+		address_pool = address_pools[address]
+	previous_pool = getattr(thread_pool, 'pool', None)
+	thread_pool.pool = address_pool
+	try:
+		yield
+	finally:
+		thread_pool.pool = previous_pool
+
+# mpd_connection
+# with mpd_connection() as client: borrows a client from the process' pool,
+# or from the one using() picked for this thread
+def mpd_connection():
+	return (getattr(thread_pool, 'pool', None) or pool).connection()
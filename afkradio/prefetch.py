@@ -0,0 +1,175 @@
+from afkradio.models import MPD_DB_ROOT
+from afkradio.metrics import LatencyMetric
+from collections import deque
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+with open(os.path.join(APP_ROOT,'config.json')) as config_file:
+	config_data = json.load(config_file)
+	# Number of upcoming songs whose files are read ahead, 0 turns it off
+	PREFETCH_SONGS = int(config_data.get('Prefetch songs', 3))
+	# Bytes read ahead from the start of each file, 0 for the whole file
+	PREFETCH_BYTES = int(config_data.get('Prefetch bytes', 16777216))
+
+POSIX_FADV_WILLNEED = 3
+
+# Bytes read to time whether a file's start was in the page cache
+PROBE_BYTES = 4096
+# A probe read slower than this went to the disk
+CACHE_MISS_SECONDS = 0.001
+# Chunk size when reading ahead without posix_fadvise
+READ_CHUNK_BYTES = 1048576
+
+STOP = object()
+
+_fadvise = None
+
+# get_fadvise
+# libc's posix_fadvise through ctypes (os.posix_fadvise is Python 3 only),
+# or None where there is none
+def get_fadvise():
+	global _fadvise
+	if _fadvise is None:
+		_fadvise = False
+		libc_name = ctypes.util.find_library('c')
+		if libc_name is not None:
+			libc = ctypes.CDLL(libc_name, use_errno=True)
+			for name in ('posix_fadvise64', 'posix_fadvise'):
+				if hasattr(libc, name):
+					_fadvise = getattr(libc, name)
+					_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+							ctypes.c_int]
+					_fadvise.restype = ctypes.c_int
+					break
+	return _fadvise or None
+
+
+# Prefetcher
+# Warms the page cache for the files of the next songs, so MPD doesn't
+# stall at a track boundary on a cold file on a slow disk or NFS.  Each
+# file is asked for with posix_fadvise(WILLNEED), which starts the kernel
+# reading it in the background, or read through where that isn't
+# available.  Before that, a small read from the start of the file is timed
+# to tell whether it was cached already: probe_latency keeps those times
+# and hits/misses the counts.  submit() hands the paths to a thread of its
+# own, so slow disks never hold up the stream.
+class Prefetcher:
+	def __init__(self, root=MPD_DB_ROOT, byte_count=PREFETCH_BYTES, song_count=PREFETCH_SONGS):
+		self.root = root
+		self.byte_count = byte_count
+		self.song_count = song_count
+		self.pending = Queue.Queue()
+		# Recently prefetched paths, which aren't prefetched again
+		self.recent = deque(maxlen=max(song_count, 1) * 4)
+		self.probe_latency = LatencyMetric()
+		self.hits = 0
+		self.misses = 0
+		self.prefetched_bytes = 0
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name='afkradio prefetcher')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		if self.thread is not None:
+			self.pending.put(STOP)
+			self.thread.join()
+			self.thread = None
+
+	# submit
+	# Queues the paths (relative to the root) of the next songs, in play
+	# order.  Only the first song_count are prefetched
+	def submit(self, rel_paths):
+		if self.song_count:
+			self.pending.put(list(rel_paths)[:self.song_count])
+
+	# run
+	# Prefetches submitted paths until stopped.  Only the latest submission
+	# matters when several queued up
+	def run(self):
+		while True:
+			rel_paths = self.pending.get()
+			stopping = rel_paths is STOP
+			while not stopping:
+				try:
+					next_paths = self.pending.get_nowait()
+				except Queue.Empty:
+					break
+				if next_paths is STOP:
+					stopping = True
+				else:
+					rel_paths = next_paths
+			if rel_paths is not STOP:
+				self.prefetch(rel_paths)
+			if stopping:
+				return
+
+	# prefetch
+	# Prefetches the files that weren't recently.  Returns the number of
+	# files prefetched
+	def prefetch(self, rel_paths):
+		prefetched_count = 0
+		for rel_path in rel_paths:
+			if rel_path in self.recent:
+				continue
+			self.recent.append(rel_path)
+			if self.prefetch_file(rel_path):
+				prefetched_count += 1
+		return prefetched_count
+
+	def prefetch_file(self, rel_path):
+		abs_path = os.path.join(self.root, rel_path)
+		try:
+			fd = os.open(abs_path, os.O_RDONLY)
+		except OSError as error:
+			logging.info('Could not prefetch ' + abs_path + ': ' + error.strerror)
+			return False
+		try:
+			size = os.fstat(fd).st_size
+			length = min(size, self.byte_count) if self.byte_count else size
+			start_time = time.time()
+			os.read(fd, PROBE_BYTES)
+			probe_seconds = time.time() - start_time
+			self.probe_latency.observe(probe_seconds)
+			if probe_seconds > CACHE_MISS_SECONDS:
+				self.misses += 1
+			else:
+				self.hits += 1
+			fadvise = get_fadvise()
+			if fadvise is None or fadvise(fd, 0, length, POSIX_FADV_WILLNEED) != 0:
+				self.read_ahead(fd, length)
+			self.prefetched_bytes += length
+		except OSError as error:
+			logging.info('Could not prefetch ' + abs_path + ': ' + error.strerror)
+			return False
+		finally:
+			os.close(fd)
+		return True
+
+	# read_ahead
+	# Reads length bytes from the start of the file, for the page cache
+	def read_ahead(self, fd, length):
+		os.lseek(fd, 0, os.SEEK_SET)
+		while length > 0:
+			data = os.read(fd, min(length, READ_CHUNK_BYTES))
+			if not data:
+				return
+			length -= len(data)
+
+	def snapshot(self):
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'prefetched_bytes': self.prefetched_bytes,
+			'probe_latency_seconds': self.probe_latency.snapshot(),
+			}
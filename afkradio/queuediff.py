@@ -0,0 +1,78 @@
+from difflib import SequenceMatcher
+
+# queue_operations
+# Returns the operations that turn the queue current_paths into
+# desired_paths, as a list of
+# 	('delete', position), ('move', from position, to position) and
+# 	('insert', position, [paths])
+# with 1-based positions, in the order they have to be applied.  The
+# longest run of songs the two have in common (in order) is left alone.
+# Other songs that are still wanted are moved, the rest deleted, and only
+# songs that aren't queued yet are inserted, so queuing a request is an
+# insert and a delete whatever the length of the queue.  offset is added to
+# every position, for diffing a tail of the queue
+def queue_operations(current_paths, desired_paths, offset=0):
+	current_paths = list(current_paths)
+	desired_paths = list(desired_paths)
+	kept = [False] * len(current_paths)
+	desired_kept = [False] * len(desired_paths)
+	matcher = SequenceMatcher(None, current_paths, desired_paths, autojunk=False)
+	for current_start, desired_start, size in matcher.get_matching_blocks():
+		for index in range(size):
+			kept[current_start + index] = True
+			desired_kept[desired_start + index] = True
+	# Songs that aren't kept but are wanted somewhere else can be moved
+	wanted = {}
+	for index, path in enumerate(desired_paths):
+		if not desired_kept[index]:
+			wanted[path] = wanted.get(path, 0) + 1
+	operations = []
+	# queue holds (path, kept) for the songs that survive the deletes
+	queue = []
+	deletes = []
+	for index, path in enumerate(current_paths):
+		if kept[index]:
+			queue.append((path, True))
+		elif wanted.get(path):
+			wanted[path] -= 1
+			queue.append((path, False))
+		else:
+			deletes.append(index + 1)
+	for position in reversed(deletes):
+		operations.append(('delete', position + offset))
+	for index, path in enumerate(desired_paths):
+		if desired_kept[index]:
+			if queue[index] != (path, True):
+				# A moved song is in the way, bring the kept one forward
+				from_index = queue.index((path, True), index)
+				queue.insert(index, queue.pop(from_index))
+				operations.append(('move', from_index + 1 + offset, index + 1 + offset))
+			continue
+		if index < len(queue) and queue[index] == (path, False):
+			continue
+		try:
+			from_index = queue.index((path, False), index)
+		except ValueError:
+			queue.insert(index, (path, False))
+			if operations and operations[-1][0] == 'insert' and \
+					operations[-1][1] + len(operations[-1][2]) == index + 1 + offset:
+				operations[-1][2].append(path)
+			else:
+				operations.append(('insert', index + 1 + offset, [path]))
+			continue
+		queue.insert(index, queue.pop(from_index))
+		operations.append(('move', from_index + 1 + offset, index + 1 + offset))
+	return operations
+
+# apply_operations
+# Applies queue_operations to a list the way MPD would
+def apply_operations(paths, operations):
+	paths = list(paths)
+	for operation in operations:
+		if operation[0] == 'delete':
+			del paths[operation[1] - 1]
+		elif operation[0] == 'move':
+			paths.insert(operation[2] - 1, paths.pop(operation[1] - 1))
+		else:
+			paths[operation[1] - 1:operation[1] - 1] = operation[2]
+	return paths
@@ -0,0 +1,173 @@
+from afkradio.models import PlayHistory, PlayRollup, RollupWatermark, ROLLUP_HOUR, ROLLUP_DAY
+from django.db import IntegrityError, transaction
+from django.db.models import F, Min, Sum
+from django.utils import timezone
+import datetime
+import json
+import logging
+import os
+import threading
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+with open(os.path.join(APP_ROOT,'config.json')) as config_file:
+	config_data = json.load(config_file)
+	# Raw PlayHistory rows are kept this long, after that only the rollups
+	HISTORY_RETENTION_DAYS = int(config_data.get('Play history retention days', 30))
+	# Hourly rollups are kept this long, daily rollups are kept forever
+	HOURLY_ROLLUP_RETENTION_DAYS = int(config_data.get('Hourly rollup retention days', 90))
+
+# Rolls up at most once per hour from roll_up_if_due
+_last_rollup_hour = None
+_rollup_lock = threading.Lock()
+
+# Buckets are in UTC so they don't shift or repeat across DST changes
+def to_utc(moment):
+	if timezone.is_aware(moment):
+		return moment.astimezone(timezone.utc)
+	return moment
+
+def hour_start(moment):
+	return moment.replace(minute=0, second=0, microsecond=0)
+
+def day_start(moment):
+	return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+# rolled_up_through
+# Plays up to this PlayHistory pk are in the rollups, 0 when none are
+def rolled_up_through():
+	for last_play_id in RollupWatermark.objects.values_list('last_play_id', flat=True)[:1]:
+		return last_play_id
+	return 0
+
+# move_watermark
+# Moves the watermark from since to last_play_id.  Returns False when
+# another process moved it first
+def move_watermark(since, last_play_id):
+	if RollupWatermark.objects.filter(last_play_id=since).update(last_play_id=last_play_id):
+		return True
+	if since or RollupWatermark.objects.exists():
+		return False
+	# Raises IntegrityError when another process creates it meanwhile
+	RollupWatermark.objects.create(pk=1, last_play_id=last_play_id)
+	return True
+
+# roll_up
+# Adds the plays after the watermark that happened before the current hour
+# (in UTC) to the hourly and daily rollups, then prunes raw history and
+# hourly rollups older than their retention.  The watermark is a
+# PlayHistory pk rather than a time, so a play saved late into an hour
+# that was rolled up already is still added.  Plays are taken in pk order
+# up to the first one of the current hour, so none is skipped.  The plays
+# of all the stations are rolled up together; when the stream of another
+# station moved the watermark first, nothing is added.  Returns the number
+# of plays added
+def roll_up(now=None):
+	if now is None:
+		now = timezone.now()
+	until = hour_start(to_utc(now))
+	since = rolled_up_through()
+	plays = PlayHistory.objects.filter(pk__gt=since)
+	first_unfinished = plays.filter(played_time__gte=until) \
+			.aggregate(first_unfinished=Min('pk'))['first_unfinished']
+	if first_unfinished is not None:
+		plays = plays.filter(pk__lt=first_unfinished)
+	last_play_id = since
+	hourly_plays = {}
+	daily_plays = {}
+	play_count = 0
+	for play_pk, song_pk, played_time in plays.values_list('pk', 'song', 'played_time').iterator():
+		last_play_id = max(last_play_id, play_pk)
+		played_time = to_utc(played_time)
+		hour_key = (song_pk, hour_start(played_time))
+		day_key = (song_pk, day_start(played_time))
+		hourly_plays[hour_key] = hourly_plays.get(hour_key, 0) + 1
+		daily_plays[day_key] = daily_plays.get(day_key, 0) + 1
+		play_count += 1
+	try:
+		with transaction.atomic():
+			if play_count and not move_watermark(since, last_play_id):
+				logging.info('Plays were rolled up by another process meanwhile')
+				return 0
+			add_plays(ROLLUP_HOUR, hourly_plays)
+			add_plays(ROLLUP_DAY, daily_plays)
+			prune(now)
+	except IntegrityError:
+		logging.info('Plays were rolled up by another process meanwhile')
+		return 0
+	if play_count:
+		logging.info('Rolled up %d plays' % play_count)
+	return play_count
+
+# add_plays
+# Adds {(song pk, bucket start): plays} to the rollups of period.  A bucket
+# can be rolled up over several runs (a day, or an hour a play was saved
+# late into), existing buckets are incremented with F()
+def add_plays(period, bucket_plays):
+	if not bucket_plays:
+		return
+	bucket_starts = set(bucket_start for song_pk, bucket_start in bucket_plays)
+	existing = dict(((song_pk, bucket_start), rollup_pk) for rollup_pk, song_pk, bucket_start in
+			PlayRollup.objects.filter(period=period, bucket_start__in=bucket_starts)
+			.values_list('pk', 'song', 'bucket_start'))
+	new_rollups = []
+	for key, plays in bucket_plays.items():
+		if key in existing:
+			PlayRollup.objects.filter(pk=existing[key]).update(plays=F('plays') + plays)
+		else:
+			new_rollups.append(PlayRollup(song_id=key[0], period=period,
+				bucket_start=key[1], plays=plays))
+	PlayRollup.objects.bulk_create(new_rollups)
+
+# prune
+# Deletes raw plays that are both rolled up and older than the history
+# retention, and hourly rollups older than theirs
+def prune(now):
+	history_cutoff = now - datetime.timedelta(days=HISTORY_RETENTION_DAYS)
+	PlayHistory.objects.filter(pk__lte=rolled_up_through(),
+			played_time__lt=history_cutoff).delete()
+	PlayRollup.objects.filter(period=ROLLUP_HOUR, bucket_start__lt=now -
+			datetime.timedelta(days=HOURLY_ROLLUP_RETENTION_DAYS)).delete()
+
+# roll_up_if_due
+# roll_up, at most once per hour per process.  Called from the play loop
+def roll_up_if_due(now=None):
+	global _last_rollup_hour
+	if now is None:
+		now = timezone.now()
+	with _rollup_lock:
+		if _last_rollup_hour == hour_start(now):
+			return 0
+		_last_rollup_hour = hour_start(now)
+	return roll_up(now)
+
+# top_songs
+# Returns [(song pk, plays)] of the most played songs of the last days
+# days (today included), read from the daily rollups
+def top_songs(days=7, limit=50, now=None):
+	if now is None:
+		now = timezone.now()
+	first_day = day_start(to_utc(now)) - datetime.timedelta(days=days - 1)
+	return list(PlayRollup.objects.filter(period=ROLLUP_DAY, bucket_start__gte=first_day)
+			.values_list('song').annotate(total_plays=Sum('plays'))
+			.order_by('-total_plays', 'song')[:limit])
+
+# song_plays
+# Returns [(bucket start, plays)] for one song, oldest first, for graphs.
+# period is ROLLUP_HOUR or ROLLUP_DAY
+def song_plays(song_id, period=ROLLUP_DAY, since=None):
+	rollups = PlayRollup.objects.filter(song=song_id, period=period)
+	if since is not None:
+		rollups = rollups.filter(bucket_start__gte=since)
+	return list(rollups.order_by('bucket_start').values_list('bucket_start', 'plays'))
+
+# total_plays
+# Returns {song pk: plays} over the whole history: the daily rollups plus
+# the raw plays that aren't rolled up yet
+def total_plays():
+	plays = dict(PlayRollup.objects.filter(period=ROLLUP_DAY).values_list('song')
+			.annotate(total_plays=Sum('plays')).order_by())
+	raw_plays = PlayHistory.objects.filter(pk__gt=rolled_up_through())
+	for song_pk in raw_plays.values_list('song', flat=True).iterator():
+		plays[song_pk] = plays.get(song_pk, 0) + 1
+	return plays
@@ -0,0 +1,360 @@
+from afkradio.models import Song, manifest_matches, available_song_ids, \
+	active_setlist_song_ids
+from afkradio.tagreader import read_metadata, audio_fingerprint
+from afkradio.albumart import flush_album_art
+from afkradio.setlistrules import invalidate_songs
+from afkradio.errors import *
+from afkradio.exifpool import EXIFTOOL_WORKERS
+from django.db import connection, transaction
+from multiprocessing.pool import ThreadPool
+import fnmatch
+import logging
+import multiprocessing
+import os
+import threading
+
+SUPPORTED_FILE_TYPES = ('mp3', 'ogg', 'flac')
+# Number of songs written per bulk_create/transaction
+WRITE_BATCH_SIZE = 500
+# Number of files handed to each extract call
+EXTRACT_BATCH_SIZE = 32
+# Most parameters put in one UPDATE, sqlite allows 999
+MAX_QUERY_PARAMS = 900
+# How often (in seconds) the scan wakes up to notice Ctrl-C while waiting on
+# the extract threads
+EXTRACT_POLL_SECONDS = 1
+
+# is_supported
+# True if the file at path has one of the supported extensions
+def is_supported(path):
+	for extension in SUPPORTED_FILE_TYPES:
+		if fnmatch.fnmatch(path, '*.' + extension):
+			return True
+	return False
+
+# update_songs
+# Writes field_names of the songs, which have their pks, with one
+# UPDATE ... SET field = CASE pk WHEN ... ELSE field END per chunk of songs
+# (as many as fit in MAX_QUERY_PARAMS).  Django has no bulk update, and
+# save() is an UPDATE per song.  The ELSE (never reached, the WHERE only
+# has the chunk's pks) gives the CASE the column's type on every backend:
+# without it PostgreSQL types a CASE of nothing but NULLs as text, which
+# can't be assigned to an integer column
+def update_songs(songs, field_names):
+	quote_name = connection.ops.quote_name
+	fields = [Song._meta.get_field(field_name) for field_name in field_names]
+	pk_column = quote_name(Song._meta.pk.column)
+	chunk_size = max(1, MAX_QUERY_PARAMS // (2 * len(fields) + 1))
+	cursor = connection.cursor()
+	for index in range(0, len(songs), chunk_size):
+		chunk = songs[index:index+chunk_size]
+		assignments = []
+		params = []
+		for field in fields:
+			column = quote_name(field.column)
+			assignments.append('%s = CASE %s %s ELSE %s END' % (column, pk_column,
+					' '.join(['WHEN %s THEN %s'] * len(chunk)), column))
+			for song in chunk:
+				params.append(song.pk)
+				params.append(field.get_db_prep_save(getattr(song, field.attname), connection))
+		params.extend(song.pk for song in chunk)
+		cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+				quote_name(Song._meta.db_table), ', '.join(assignments), pk_column,
+				', '.join(['%s'] * len(chunk))), params)
+
+
+# LibraryScanner
+# Scans the MPD root for new songs in three stages:
+# 	walk() lists the supported files under the root,
+# 	extract() reads the tags of batches of EXTRACT_BATCH_SIZE new files
+# 	from a pool of threads (one per exiftool worker so every core is kept
+# 	busy with files that have to fall back to exiftool), and
+# 	write() stores the extracted songs with bulk_create, one transaction
+# 	per batch of WRITE_BATCH_SIZE songs.
+# Album art is captured while the tags are read and written by the
+# background albumart writer.
+# The manifest (size, mtime, inode) of every song is loaded in a single
+# query up front and compared against os.stat, so only new or changed files
+# are read.  Changed songs are updated in place and songs whose file has
+# gone are marked as removed, unless a new file has the same audio
+# fingerprint, in which case the song is moved to the new path without
+# reading its tags again (keeping its counters, setlists and history).
+# The number of database round trips grows with the number of batches,
+# not files.
+# Every write is a checkpoint: if the scan is interrupted, the songs already
+# written have their manifest stored and are skipped when it is run again.
+# progress, if given, is called with the scanner after every extract batch
+# so callers can report total_count, done_count and done_bytes.
+class LibraryScanner:
+	def __init__(self, root, workers=None, batch_size=WRITE_BATCH_SIZE, progress=None):
+		self.root = root
+		if not workers:
+			workers = int(EXIFTOOL_WORKERS or multiprocessing.cpu_count())
+		self.workers = workers
+		self.batch_size = batch_size
+		self.added_count = 0
+		self.updated_count = 0
+		self.moved_count = 0
+		self.removed_count = 0
+		self.total_count = 0
+		self.done_count = 0
+		self.done_bytes = 0
+		self.progress = progress
+		self.missing_fingerprints = {}
+		self.moved_song_pks = set()
+		self.missing_lock = threading.Lock()
+
+	# walk
+	# Yields the path relative to the root of every supported file, or only
+	# those under rel_dir_path if given
+	def walk(self, rel_dir_path=''):
+		for root, dirs, files in os.walk(os.path.join(self.root, rel_dir_path)):
+			for extension in SUPPORTED_FILE_TYPES:
+				for filename in fnmatch.filter(files, '*.' + extension):
+					yield os.path.relpath(os.path.join(root, filename), self.root)
+
+	# load_manifest
+	# Returns {filepath: (pk, (size, mtime, inode), removed, fingerprint)}
+	# for every song, or for the songs in the given queryset
+	def load_manifest(self, songs=None):
+		if songs is None:
+			songs = Song.objects.all()
+		manifest = {}
+		for song_pk, filepath, file_size, file_mtime, file_inode, removed, fingerprint in \
+				songs.values_list('pk', 'filepath', 'file_size', 'file_mtime',
+					'file_inode', 'removed', 'fingerprint').iterator():
+			manifest[filepath] = (song_pk, (file_size, file_mtime, file_inode),
+					removed, fingerprint)
+		return manifest
+
+	# find_moved_song
+	# Returns (pk of a missing song with the same audio as the new file at
+	# rel_song_path or None, the file's fingerprint or None if it wasn't
+	# computed).  Each missing song can only be claimed once
+	def find_moved_song(self, rel_song_path):
+		if not self.missing_fingerprints:
+			return None, None
+		try:
+			fingerprint = audio_fingerprint(os.path.join(self.root, rel_song_path))
+		except (IOError, OSError):
+			return None, None
+		with self.missing_lock:
+			song_pk = self.missing_fingerprints.pop(fingerprint, None)
+			if song_pk is not None:
+				self.moved_song_pks.add(song_pk)
+			return song_pk, fingerprint
+
+	# moved_song
+	# Builds the update for a song whose file moved to rel_song_path
+	def moved_song(self, rel_song_path, song_pk, fingerprint):
+		abs_song_path = os.path.join(self.root, rel_song_path)
+		song = Song(pk=song_pk, filepath=rel_song_path, removed=False)
+		song.set_manifest(os.stat(abs_song_path))
+		song.fingerprint = fingerprint
+		song.moved = True
+		return song
+
+	# extract
+	# Runs in the thread pool on a list of (path, pk of the song to update
+	# or None) work items.  New files whose audio matches a missing song are
+	# treated as moves and not read at all.  Files tagreader can't parse are
+	# read with a single exiftool command for the whole batch.  A file's
+	# audio is hashed once, the fingerprint the move check computed is
+	# reused for the new song.  Returns an unsaved Song, carrying the pk,
+	# for every file that could be read
+	def extract(self, work_items):
+		songs = []
+		read_items = []
+		for rel_song_path, song_pk in work_items:
+			moved_song_pk = fingerprint = None
+			if song_pk is None:
+				moved_song_pk, fingerprint = self.find_moved_song(rel_song_path)
+			if moved_song_pk is None:
+				read_items.append((rel_song_path, song_pk, fingerprint))
+				continue
+			try:
+				songs.append(self.moved_song(rel_song_path, moved_song_pk, fingerprint))
+			except OSError:
+				logging.warning('Skipped ' + rel_song_path + ' while scanning')
+		try:
+			metadata = read_metadata([os.path.join(self.root, rel_song_path)
+					for rel_song_path, song_pk, fingerprint in read_items])
+		except ExiftoolError:
+			logging.warning('Skipped a batch of %d files while scanning' % len(read_items))
+			return songs
+		for rel_song_path, song_pk, fingerprint in read_items:
+			abs_song_path = os.path.join(self.root, rel_song_path)
+			if abs_song_path not in metadata:
+				logging.warning('Skipped ' + rel_song_path + ' while scanning')
+				continue
+			try:
+				new_song = Song.from_metadata(rel_song_path, metadata[abs_song_path],
+						fingerprint=fingerprint)
+			except (FileTypeError, IOError, OSError):
+				logging.warning('Skipped ' + rel_song_path + ' while scanning')
+				continue
+			if new_song.artist == 'volume: n/a   repeat:':
+				continue
+			new_song.pk = song_pk
+			songs.append(new_song)
+		return songs
+
+	# extract_batch
+	# extract() for the thread pool, also returning how many files it was given
+	def extract_batch(self, work_items):
+		return (len(work_items), self.extract(work_items))
+
+	# write
+	# Stores a batch of extracted songs in one transaction: new songs with
+	# bulk_create, changed and moved songs with update_songs
+	def write(self, songs):
+		new_songs = [song for song in songs if song.pk is None]
+		moved_songs = [song for song in songs if getattr(song, 'moved', False)]
+		changed_songs = [song for song in songs
+				if song.pk is not None and not getattr(song, 'moved', False)]
+		with transaction.atomic():
+			Song.objects.bulk_create(new_songs)
+			update_songs(changed_songs, Song.metadata_fields)
+			update_songs(moved_songs, Song.manifest_fields)
+		available_song_ids.invalidate()
+		invalidate_songs()
+		if changed_songs or moved_songs:
+			active_setlist_song_ids.invalidate()
+		self.added_count += len(new_songs)
+		self.updated_count += len(changed_songs)
+		self.moved_count += len(moved_songs)
+
+	# mark_removed
+	# Flags the songs with the given pks as removed, one query per batch
+	def mark_removed(self, song_pks):
+		song_pks = list(song_pks)
+		for index in range(0, len(song_pks), self.batch_size):
+			Song.objects.filter(pk__in=song_pks[index:index+self.batch_size]).update(removed=True)
+		if song_pks:
+			available_song_ids.invalidate()
+			active_setlist_song_ids.invalidate()
+			invalidate_songs()
+		self.removed_count += len(song_pks)
+
+	# classify
+	# Sorts the files at rel_song_paths into work items for the songs that
+	# are new or changed according to manifest.  Unchanged files are added
+	# to dupe_list
+	def classify(self, rel_song_paths, manifest, dupe_list):
+		work_items = []
+		for rel_song_path in rel_song_paths:
+			if rel_song_path not in manifest:
+				work_items.append((rel_song_path, None))
+				continue
+			song_pk, song_manifest, removed, fingerprint = manifest[rel_song_path]
+			try:
+				file_stat = os.stat(os.path.join(self.root, rel_song_path))
+			except OSError:
+				continue
+			if not removed and manifest_matches(song_manifest, file_stat):
+				dupe_list.append(os.path.join(self.root, rel_song_path))
+			else:
+				work_items.append((rel_song_path, song_pk))
+		return work_items
+
+	# process
+	# Extracts and writes the work items.  missing_songs are the
+	# (pk, removed, fingerprint) of songs whose file is gone: new files are
+	# matched against them by fingerprint and the ones that aren't claimed
+	# by a move are marked as removed
+	def process(self, work_items, missing_songs):
+		# New files are only fingerprinted if there is a missing song they
+		# could be a move of
+		self.missing_fingerprints = dict((fingerprint, song_pk)
+				for song_pk, removed, fingerprint in missing_songs if fingerprint)
+		self.total_count += len(work_items)
+		pool = ThreadPool(self.workers)
+		batch = []
+		try:
+			extract_batches = [work_items[index:index+EXTRACT_BATCH_SIZE]
+					for index in range(0, len(work_items), EXTRACT_BATCH_SIZE)]
+			results = pool.imap_unordered(self.extract_batch, extract_batches)
+			while True:
+				# Wait with a timeout, an untimed wait can't be interrupted
+				try:
+					item_count, songs = results.next(EXTRACT_POLL_SECONDS)
+				except multiprocessing.TimeoutError:
+					continue
+				except StopIteration:
+					break
+				batch.extend(songs)
+				self.done_count += item_count
+				self.done_bytes += sum(song.file_size or 0 for song in songs)
+				if len(batch) >= self.batch_size:
+					self.write(batch)
+					batch = []
+				if self.progress is not None:
+					self.progress(self)
+			if batch:
+				self.write(batch)
+		except KeyboardInterrupt:
+			pool.terminate()
+			# Keep the songs that were already read so a rerun skips them
+			if batch:
+				self.write(batch)
+			flush_album_art()
+			raise
+		finally:
+			pool.close()
+			pool.join()
+		# Make sure the album art of the new songs is on disk before returning
+		flush_album_art()
+		self.mark_removed(song_pk for song_pk, removed, fingerprint in missing_songs
+				if not removed and song_pk not in self.moved_song_pks)
+		logging.info('Scan added %d, updated %d, moved %d and removed %d songs' %
+				(self.added_count, self.updated_count, self.moved_count, self.removed_count))
+
+	# scan
+	# Runs the pipeline over the whole root and returns the absolute paths
+	# of the files that were already in the database and have not changed
+	def scan(self):
+		dupe_list = []
+		manifest = self.load_manifest()
+		# Walk the whole tree first so the songs that went missing are known
+		# before any new file is looked at
+		rel_song_paths = list(self.walk())
+		work_items = self.classify(rel_song_paths, manifest, dupe_list)
+		seen_paths = set(rel_song_paths)
+		missing_songs = [(song_pk, removed, fingerprint) for filepath,
+				(song_pk, song_manifest, removed, fingerprint) in manifest.iteritems()
+				if filepath not in seen_paths]
+		self.process(work_items, missing_songs)
+		return dupe_list
+
+	# sync
+	# Brings the songs at the given paths (files or directories, relative to
+	# the root) up to date: new files are added, changed ones updated, moved
+	# ones followed and missing ones marked as removed.  Used by the library
+	# watcher to ingest single files without walking the whole root
+	def sync(self, rel_paths):
+		dupe_list = []
+		rel_song_paths = set()
+		songs = Song.objects.none()
+		rel_file_paths = []
+		for rel_path in rel_paths:
+			abs_path = os.path.join(self.root, rel_path)
+			if os.path.isdir(abs_path):
+				rel_song_paths.update(self.walk(rel_path))
+				songs = songs | Song.objects.filter(filepath__startswith=rel_path + '/')
+			elif os.path.isfile(abs_path):
+				if is_supported(rel_path):
+					rel_song_paths.add(rel_path)
+				rel_file_paths.append(rel_path)
+			else:
+				# Gone: either a single song or a whole directory of them
+				rel_file_paths.append(rel_path)
+				songs = songs | Song.objects.filter(filepath__startswith=rel_path + '/')
+		if rel_file_paths:
+			songs = songs | Song.objects.filter(filepath__in=rel_file_paths)
+		manifest = self.load_manifest(songs)
+		work_items = self.classify(sorted(rel_song_paths), manifest, dupe_list)
+		missing_songs = [(song_pk, removed, fingerprint) for filepath,
+				(song_pk, song_manifest, removed, fingerprint) in manifest.iteritems()
+				if filepath not in rel_song_paths]
+		self.process(work_items, missing_songs)
+		return dupe_list
@@ -0,0 +1,349 @@
+from afkradio.models import Song, PlayHistory, Playlist
+from afkradio.idcache import ID_CACHE_SECONDS
+from django.db.models.signals import post_save, post_delete
+from collections import deque, OrderedDict
+import json
+import math
+import os
+import random
+import threading
+import time
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+with open(os.path.join(APP_ROOT,'config.json')) as config_file:
+	config_data = json.load(config_file)
+	SELECTION_ENGINE = config_data.get('Selection engine', 'weighted')
+	SONG_HISTORY_SIZE = int(config_data.get('Song history size', 50))
+	ARTIST_HISTORY_SIZE = int(config_data.get('Artist history size', 5))
+
+# Number of song pools (active setlists, all songs, ...) kept built at once
+POOL_CACHE_SIZE = 4
+# Number of songs whose weights are read per query
+WEIGHT_QUERY_SIZE = 500
+
+# song_weight
+# Favourited songs come up more often, songs that have been played a lot
+# less often
+def song_weight(playcount, favecount):
+	return (1.0 + (favecount or 0)) / math.sqrt(1.0 + (playcount or 0))
+
+
+# SongWeights
+# {song pk: (artist, weight)} of the available songs, shared by every pool
+# so building one doesn't read the songs table again.  Saving or deleting a
+# song updates its entry.  Songs that aren't in the map yet (bulk_create
+# sends no signals) are read when a pool asks for them, in queries of
+# WEIGHT_QUERY_SIZE.  The whole map is read again once older than ttl
+# seconds, for the counts flushed with update() and changes made by other
+# processes
+class SongWeights:
+	def __init__(self, ttl=ID_CACHE_SECONDS):
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		self.weights = None
+		self.loaded_time = 0
+
+	def load(self, songs):
+		for song_pk, artist, playcount, favecount in songs \
+				.values_list('pk', 'artist', 'playcount', 'favecount').iterator():
+			self.weights[song_pk] = (artist, song_weight(playcount, favecount))
+
+	# get
+	# Returns {song pk: (artist, weight)} covering the available songs among
+	# song_ids
+	def get(self, song_ids):
+		with self.lock:
+			if self.weights is None or time.time() - self.loaded_time > self.ttl:
+				self.weights = {}
+				self.load(Song.objects.available())
+				self.loaded_time = time.time()
+			else:
+				missing_song_ids = [song_id for song_id in song_ids
+						if song_id not in self.weights]
+				for index in range(0, len(missing_song_ids), WEIGHT_QUERY_SIZE):
+					self.load(Song.objects.available().filter(
+							pk__in=missing_song_ids[index:index+WEIGHT_QUERY_SIZE]))
+			return self.weights
+
+	def song_saved(self, sender, instance, **kwargs):
+		with self.lock:
+			if self.weights is None:
+				return
+			if instance.removed:
+				self.weights.pop(instance.pk, None)
+			else:
+				self.weights[instance.pk] = (instance.artist,
+						song_weight(instance.playcount, instance.favecount))
+
+	def song_deleted(self, sender, instance, **kwargs):
+		with self.lock:
+			if self.weights is not None:
+				self.weights.pop(instance.pk, None)
+
+song_weights = SongWeights()
+
+post_save.connect(song_weights.song_saved, sender=Song,
+		dispatch_uid='afkradio.scheduler.song_weights.post_save')
+post_delete.connect(song_weights.song_deleted, sender=Song,
+		dispatch_uid='afkradio.scheduler.song_weights.post_delete')
+
+
+# FenwickTree
+# Prefix sums over a list of weights with O(log n) updates and lookups
+class FenwickTree:
+	def __init__(self, weights):
+		self.size = len(weights)
+		self.tree = [0.0] * (self.size + 1)
+		# Build in O(n) by pushing every node into its parent
+		for index, weight in enumerate(weights):
+			self.tree[index + 1] += weight
+			parent = index + 1 + ((index + 1) & -(index + 1))
+			if parent <= self.size:
+				self.tree[parent] += self.tree[index + 1]
+
+	def add(self, index, delta):
+		index += 1
+		while index <= self.size:
+			self.tree[index] += delta
+			index += index & -index
+
+	def total(self):
+		total = 0.0
+		index = self.size
+		while index > 0:
+			total += self.tree[index]
+			index -= index & -index
+		return total
+
+	# find
+	# Returns the index whose weight covers position in [0, total)
+	def find(self, position):
+		index = 0
+		step = 1
+		while step * 2 <= self.size:
+			step *= 2
+		while step:
+			if index + step <= self.size and self.tree[index + step] <= position:
+				index += step
+				position -= self.tree[index]
+			step //= 2
+		return min(index, self.size - 1)
+
+
+# WeightedSongPool
+# The weights of one pool of song ids, from song_weights, in a FenwickTree.
+# Songs (and all songs of artists) that are excluded have their weight set
+# to 0
+class WeightedSongPool:
+	def __init__(self, song_ids, excluded_song_ids, excluded_artists):
+		self.song_ids = song_ids
+		self.indexes = dict((song_id, index) for index, song_id in enumerate(song_ids))
+		self.weights = [0.0] * len(song_ids)
+		self.index_artists = [None] * len(song_ids)
+		self.artist_indexes = {}
+		weights = song_weights.get(song_ids)
+		for index, song_id in enumerate(song_ids):
+			if song_id not in weights:
+				continue
+			artist, weight = weights[song_id]
+			self.weights[index] = weight
+			self.index_artists[index] = artist
+			self.artist_indexes.setdefault(artist, []).append(index)
+		self.current_weights = list(self.weights)
+		for song_id in excluded_song_ids:
+			if song_id in self.indexes:
+				self.current_weights[self.indexes[song_id]] = 0.0
+		for artist in excluded_artists:
+			for index in self.artist_indexes.get(artist, ()):
+				self.current_weights[index] = 0.0
+		self.tree = FenwickTree(self.current_weights)
+
+	def set_weight(self, index, weight):
+		self.tree.add(index, weight - self.current_weights[index])
+		self.current_weights[index] = weight
+
+	def exclude_song(self, song_id):
+		if song_id in self.indexes:
+			self.set_weight(self.indexes[song_id], 0.0)
+
+	def exclude_artist(self, artist):
+		for index in self.artist_indexes.get(artist, ()):
+			self.set_weight(index, 0.0)
+
+	# include_song and include_artist put weights back, unless the song is
+	# still excluded through the other history
+	def include_song(self, song_id, excluded_artists):
+		index = self.indexes.get(song_id)
+		if index is not None and self.index_artists[index] not in excluded_artists:
+			self.set_weight(index, self.weights[index])
+
+	def include_artist(self, artist, excluded_song_ids):
+		for index in self.artist_indexes.get(artist, ()):
+			if self.song_ids[index] not in excluded_song_ids:
+				self.set_weight(index, self.weights[index])
+
+	# pick
+	# Returns a song id with probability proportional to its weight, or a
+	# uniformly random one if every song in the pool is excluded
+	def pick(self):
+		if not self.song_ids:
+			return None
+		total = self.tree.total()
+		if total > 0:
+			index = self.tree.find(random.random() * total)
+			# Rounding in the sums can land on an excluded song at the very end
+			if self.current_weights[index] > 0:
+				return self.song_ids[index]
+			for index in range(len(self.song_ids) - 1, -1, -1):
+				if self.current_weights[index] > 0:
+					return self.song_ids[index]
+		return self.song_ids[random.randrange(len(self.song_ids))]
+
+
+# UniformEngine
+# Picks every song in a pool with the same probability
+class UniformEngine:
+	# Its picks don't depend on what the station played
+	def __init__(self, station=None):
+		pass
+
+	def pick(self, song_ids):
+		if not song_ids:
+			return None
+		return song_ids[random.randrange(len(song_ids))]
+
+	def pick_many(self, song_ids, count):
+		if not song_ids:
+			return []
+		if count <= len(song_ids):
+			return random.sample(song_ids, count)
+		return [self.pick(song_ids) for pick in range(count)]
+
+	def record_song(self, song):
+		pass
+
+
+# WeightedEngine
+# Picks songs weighted by song_weight, leaving out the last song_history_size
+# songs and the artists of the last artist_history_size songs.  Both
+# histories are ring buffers seeded from PlayHistory and the playlist, and
+# every pool's FenwickTree is updated as songs enter and leave them, so a
+# pick never looks at the history.  The histories are those of one station
+class WeightedEngine:
+	def __init__(self, song_history_size=SONG_HISTORY_SIZE,
+			artist_history_size=ARTIST_HISTORY_SIZE, station=None):
+		self.station = station
+		self.song_history = deque()
+		self.song_history_size = song_history_size
+		self.artist_history = deque()
+		self.artist_history_size = artist_history_size
+		# {song id or artist: times it is in the history}
+		self.song_counts = {}
+		self.artist_counts = {}
+		self.pools = OrderedDict()
+		self.lock = threading.Lock()
+		self.seed()
+
+	# seed
+	# Fills the histories with the songs played last and the songs queued
+	def seed(self):
+		history_size = max(self.song_history_size, self.artist_history_size)
+		history = list(reversed(PlayHistory.objects.for_station(self.station)
+				.order_by('-played_time').values_list('song_id', 'song__artist')[:history_size]))
+		history.extend(Playlist.objects.for_station(self.station).order_by('position')
+				.values_list('song_id', 'song__artist'))
+		for song_id, artist in history[-history_size:]:
+			# Rows whose song has gone have no artist
+			if artist is not None:
+				self.push(song_id, artist)
+
+	def get_pool(self, song_ids):
+		# Pools are keyed by the array from the id caches, which is replaced
+		# whenever those ids change
+		key = id(song_ids)
+		pool = self.pools.get(key)
+		if pool is None or pool.song_ids is not song_ids:
+			pool = WeightedSongPool(song_ids, self.song_counts, self.artist_counts)
+			self.pools[key] = pool
+			while len(self.pools) > POOL_CACHE_SIZE:
+				self.pools.popitem(last=False)
+		return pool
+
+	def pick(self, song_ids):
+		with self.lock:
+			return self.get_pool(song_ids).pick()
+
+	# pick_many
+	# Picks count songs, recording each in the history as it is picked so
+	# the batch follows the same rules as count single picks
+	def pick_many(self, song_ids, count):
+		with self.lock:
+			pool = self.get_pool(song_ids)
+			picked_ids = []
+			for pick in range(count):
+				song_id = pool.pick()
+				if song_id is None:
+					break
+				picked_ids.append(song_id)
+				self.push(song_id, pool.index_artists[pool.indexes[song_id]])
+			return picked_ids
+
+	def record_song(self, song):
+		with self.lock:
+			self.push(song.pk, song.artist)
+
+	# push
+	# Adds a song to the histories.  Songs without an artist only go in the
+	# song history, untagged songs aren't all by the same artist
+	def push(self, song_id, artist):
+		if self.song_history_size:
+			self.song_history.append(song_id)
+			self.song_counts[song_id] = self.song_counts.get(song_id, 0) + 1
+			for pool in self.pools.values():
+				pool.exclude_song(song_id)
+			if len(self.song_history) > self.song_history_size:
+				self.expire_song(self.song_history.popleft())
+		if self.artist_history_size and artist:
+			self.artist_history.append(artist)
+			self.artist_counts[artist] = self.artist_counts.get(artist, 0) + 1
+			for pool in self.pools.values():
+				pool.exclude_artist(artist)
+			if len(self.artist_history) > self.artist_history_size:
+				self.expire_artist(self.artist_history.popleft())
+
+	def expire_song(self, song_id):
+		self.song_counts[song_id] -= 1
+		if self.song_counts[song_id]:
+			return
+		del self.song_counts[song_id]
+		for pool in self.pools.values():
+			pool.include_song(song_id, self.artist_counts)
+
+	def expire_artist(self, artist):
+		self.artist_counts[artist] -= 1
+		if self.artist_counts[artist]:
+			return
+		del self.artist_counts[artist]
+		for pool in self.pools.values():
+			pool.include_artist(artist, self.song_counts)
+
+
+SELECTION_ENGINES = {
+		'uniform' : UniformEngine,
+		'weighted' : WeightedEngine,
+		}
+
+# {station pk, None for the default station: engine}
+_engines = {}
+_engine_lock = threading.Lock()
+
+# get_engine
+# Returns this process's selection engine for the station, set by
+# 'Selection engine' in config.json
+def get_engine(station=None):
+	station_pk = station.pk if station is not None else None
+	with _engine_lock:
+		if station_pk not in _engines:
+			_engines[station_pk] = SELECTION_ENGINES[SELECTION_ENGINE](station=station)
+		return _engines[station_pk]
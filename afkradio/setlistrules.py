@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+from afkradio.models import Song, Setlist, available_song_ids
+from afkradio.idcache import KeyedIdArrayCache, ID_CACHE_SECONDS
+from afkradio.errors import *
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from array import array
+import binascii
+import re
+import threading
+import time
+
+# Setlist rules combine setlists (and song field filters) into one pool of
+# songs, i.e. '(Fast | Anime) - Ballads & year>=2010'
+# 	|, ∪	union
+# 	&, ∩	intersection (binds tighter than union and difference)
+# 	-, −	difference
+# 	name or "name with spaces"	the songs of a setlist
+# 	field op value	songs whose field compares to value (op is one of
+# 		= != < <= > >=), i.e. year>=2010 or genre="Drum & Bass"
+# A name matches every setlist called that.  year is text in the database,
+# < <= > and >= compare it as a number, by its leading digits, and leave out
+# songs whose year doesn't start with one.  Other text fields compare as text.
+# Every setlist and filter is kept as a bitmap over song ids (a Python long
+# with bit n set for song n), so combining them is a handful of big integer
+# operations however large the library is.
+
+# Song fields rules can filter on
+RULE_FIELDS = ('title', 'artist', 'album', 'trackno', 'year', 'genre',
+	'duration_secs', 'playcount', 'favecount')
+
+# Fields whose values have to be whole numbers
+INTEGER_RULE_FIELDS = ('trackno', 'duration_secs', 'playcount', 'favecount')
+# Text fields ordered as numbers
+NUMERIC_TEXT_FIELDS = ('year',)
+LEADING_NUMBER = re.compile(r'\s*(\d+)')
+
+RULE_LOOKUPS = {
+		'=' : 'exact',
+		'!=' : 'exact',
+		'<' : 'lt',
+		'<=' : 'lte',
+		'>' : 'gt',
+		'>=' : 'gte',
+		}
+
+RULE_TOKEN = re.compile(ur'''\s*(?:
+	(?P<filter>(?P<field>\w+)\s*(?P<lookup>>=|<=|!=|=|>|<)\s*
+		(?:"(?P<quoted_value>[^"]*)"|(?P<value>[\w.:]+)))
+	|(?P<operator>[|&()\-∪∩−])
+	|"(?P<quoted_name>[^"]*)"
+	|(?P<name>\w+)
+	)''', re.UNICODE | re.VERBOSE)
+
+OPERATOR_ALIASES = {
+		u'∪' : '|',
+		u'∩' : '&',
+		u'−' : '-',
+		}
+
+# ids_to_bitmap
+# Builds a bitmap with the bit of every id set
+def ids_to_bitmap(ids):
+	ids = list(ids)
+	if not ids:
+		return 0L
+	bits = bytearray(max(ids) // 8 + 1)
+	for song_id in ids:
+		bits[song_id >> 3] |= 1 << (song_id & 7)
+	bits.reverse()
+	return long(binascii.hexlify(bits), 16)
+
+# bitmap_to_ids
+# Returns the ids set in a bitmap, in ascending order, as an array('l')
+def bitmap_to_ids(bitmap):
+	ids = array('l')
+	hex_bitmap = '%x' % bitmap
+	if len(hex_bitmap) % 2:
+		hex_bitmap = '0' + hex_bitmap
+	bits = bytearray(binascii.unhexlify(hex_bitmap))
+	bits.reverse()
+	for byte_index, byte in enumerate(bits):
+		if byte:
+			for bit in range(8):
+				if byte & (1 << bit):
+					ids.append(byte_index * 8 + bit)
+	return ids
+
+# parse_rule
+# Parses a rule into nested tuples:
+# 	('setlist', name), ('filter', field, op, value) or (operator, left, right)
+def parse_rule(rule):
+	tokens = []
+	position = 0
+	rule = rule.strip()
+	while position < len(rule):
+		match = RULE_TOKEN.match(rule, position)
+		if not match or match.end() == position:
+			raise SetlistRuleError('Could not read the rule "' + rule + '" at "' +
+					rule[position:] + '"')
+		position = match.end()
+		if match.group('filter'):
+			field = match.group('field')
+			if field not in RULE_FIELDS:
+				raise FieldNotFoundError('Setlist rules can not filter on ' + field)
+			value = match.group('quoted_value')
+			if value is None:
+				value = match.group('value')
+			lookup = match.group('lookup')
+			if (field in INTEGER_RULE_FIELDS or (field in NUMERIC_TEXT_FIELDS and
+					lookup not in ('=', '!='))) and not value.isdigit():
+				raise SetlistRuleError(field + ' can only be compared with a number, not ' +
+						value)
+			tokens.append(('filter', field, lookup, value))
+		elif match.group('operator'):
+			operator = match.group('operator')
+			tokens.append(('operator', OPERATOR_ALIASES.get(operator, operator)))
+		elif match.group('quoted_name') is not None:
+			tokens.append(('setlist', match.group('quoted_name')))
+		elif match.group('name'):
+			tokens.append(('setlist', match.group('name')))
+	parser = RuleParser(rule, tokens)
+	tree = parser.parse_union()
+	if parser.position != len(tokens):
+		raise SetlistRuleError('Unexpected ' + repr(tokens[parser.position][-1]) +
+				' in the rule "' + rule + '"')
+	return tree
+
+
+# RuleParser
+# Recursive descent parser over the tokens of a rule
+class RuleParser:
+	def __init__(self, rule, tokens):
+		self.rule = rule
+		self.tokens = tokens
+		self.position = 0
+
+	def peek_operator(self):
+		if self.position < len(self.tokens) and self.tokens[self.position][0] == 'operator':
+			return self.tokens[self.position][1]
+		return None
+
+	def parse_union(self):
+		tree = self.parse_intersection()
+		while self.peek_operator() in ('|', '-'):
+			operator = self.peek_operator()
+			self.position += 1
+			tree = (operator, tree, self.parse_intersection())
+		return tree
+
+	def parse_intersection(self):
+		tree = self.parse_operand()
+		while self.peek_operator() == '&':
+			self.position += 1
+			tree = ('&', tree, self.parse_operand())
+		return tree
+
+	def parse_operand(self):
+		if self.position >= len(self.tokens):
+			raise SetlistRuleError('The rule "' + self.rule + '" ends too early')
+		token = self.tokens[self.position]
+		self.position += 1
+		if token == ('operator', '('):
+			tree = self.parse_union()
+			if self.peek_operator() != ')':
+				raise SetlistRuleError('Missing ) in the rule "' + self.rule + '"')
+			self.position += 1
+			return tree
+		if token[0] == 'operator':
+			raise SetlistRuleError('Unexpected ' + token[1] + ' in the rule "' +
+					self.rule + '"')
+		return token
+
+
+# BitmapCache
+# Bitmaps of the setlists and filters used by rules.  Setlist bitmaps are
+# dropped when the songs of that setlist change, filter bitmaps (and the
+# bitmap of available songs) when any song changes.  Both are reloaded once
+# older than ttl seconds to pick up changes made by other processes
+class BitmapCache:
+	def __init__(self, ttl=ID_CACHE_SECONDS):
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		# {key: (bitmap, loaded time)}
+		self.bitmaps = {}
+
+	def get(self, key, load_ids):
+		with self.lock:
+			if key in self.bitmaps:
+				bitmap, loaded_time = self.bitmaps[key]
+				if time.time() - loaded_time <= self.ttl:
+					return bitmap
+		bitmap = ids_to_bitmap(load_ids())
+		with self.lock:
+			self.bitmaps[key] = (bitmap, time.time())
+		return bitmap
+
+	def invalidate(self, key_filter=None):
+		with self.lock:
+			if key_filter is None:
+				self.bitmaps = {}
+			else:
+				for key in [key for key in self.bitmaps if key_filter(key)]:
+					del self.bitmaps[key]
+
+	# setlist_bitmap
+	# Bitmap of the songs of the setlists called name, setlist names aren't
+	# unique
+	def setlist_bitmap(self, name):
+		setlist_pks = list(Setlist.objects.filter(setlist=name).values_list('pk', flat=True))
+		if not setlist_pks:
+			raise SetlistNotFoundError('The Setlist with the setlist ' + name + \
+				' does not exist')
+		bitmap = 0L
+		for setlist_pk in setlist_pks:
+			bitmap |= self.get(('setlist', setlist_pk),
+					lambda: Setlist.associated_songs.through.objects.filter(
+						setlist=setlist_pk).values_list('song', flat=True).iterator())
+		return bitmap
+
+	def filter_bitmap(self, field, lookup, value):
+		if field in NUMERIC_TEXT_FIELDS and lookup not in ('=', '!='):
+			return self.numeric_filter_bitmap(field, lookup, value)
+		def load_ids():
+			songs = Song.objects.all()
+			query = {field + '__' + RULE_LOOKUPS[lookup] : value}
+			if lookup == '!=':
+				songs = songs.exclude(**query)
+			else:
+				songs = songs.filter(**query)
+			return songs.values_list('pk', flat=True).iterator()
+		return self.get(('filter', field, lookup, value), load_ids)
+
+	# numeric_filter_bitmap
+	# filter_bitmap for a text field ordered as a number.  Compared in Python,
+	# the database would order the text.  parse_rule made sure value is a
+	# number
+	def numeric_filter_bitmap(self, field, lookup, value):
+		value = int(value)
+		compare = {
+				'<' : lambda number: number < value,
+				'<=' : lambda number: number <= value,
+				'>' : lambda number: number > value,
+				'>=' : lambda number: number >= value,
+				}[lookup]
+		def load_ids():
+			for song_pk, text in Song.objects.exclude(**{field: ''}) \
+					.values_list('pk', field).iterator():
+				number = LEADING_NUMBER.match(text)
+				if number and compare(int(number.group(1))):
+					yield song_pk
+		return self.get(('filter', field, lookup, value), load_ids)
+
+	def available_bitmap(self):
+		return self.get(('available',), available_song_ids.get_ids)
+
+	# evaluate
+	# Returns the bitmap of the available songs a parsed rule matches
+	def evaluate(self, tree):
+		return self.evaluate_tree(tree) & self.available_bitmap()
+
+	def evaluate_tree(self, tree):
+		if tree[0] == 'setlist':
+			return self.setlist_bitmap(tree[1])
+		if tree[0] == 'filter':
+			return self.filter_bitmap(*tree[1:])
+		left = self.evaluate_tree(tree[1])
+		right = self.evaluate_tree(tree[2])
+		if tree[0] == '|':
+			return left | right
+		if tree[0] == '&':
+			return left & right
+		return left & ~right
+
+
+bitmaps = BitmapCache()
+
+# Ids of the songs matching each rule that has been picked from
+rule_song_ids = KeyedIdArrayCache(
+		lambda rule: bitmap_to_ids(bitmaps.evaluate(parse_rule(rule))))
+
+# song_ids_matching_rule
+# Returns an array of the ids of the available songs matching rule
+def song_ids_matching_rule(rule):
+	return rule_song_ids.get_ids(rule)
+
+# invalidate_songs
+# Drops everything that depends on song fields.  For code that changes songs
+# without sending signals (bulk_create, update())
+def invalidate_songs(*args, **kwargs):
+	bitmaps.invalidate(lambda key: key[0] != 'setlist')
+	rule_song_ids.invalidate()
+
+def setlist_songs_changed(sender, instance, action, reverse, pk_set, **kwargs):
+	if action not in ('post_add', 'post_remove', 'pre_clear', 'post_clear'):
+		return
+	if not reverse:
+		bitmaps.invalidate(lambda key: key == ('setlist', instance.pk))
+	elif pk_set:
+		bitmaps.invalidate(lambda key: key[0] == 'setlist' and key[1] in pk_set)
+	else:
+		bitmaps.invalidate(lambda key: key[0] == 'setlist')
+	rule_song_ids.invalidate()
+
+# Rules refer to setlists by name, renaming or deleting one changes them
+def setlist_changed(sender, instance, **kwargs):
+	bitmaps.invalidate(lambda key: key == ('setlist', instance.pk))
+	rule_song_ids.invalidate()
+
+post_save.connect(invalidate_songs, sender=Song,
+		dispatch_uid='afkradio.setlistrules.song_post_save')
+post_delete.connect(invalidate_songs, sender=Song,
+		dispatch_uid='afkradio.setlistrules.song_post_delete')
+post_save.connect(setlist_changed, sender=Setlist,
+		dispatch_uid='afkradio.setlistrules.setlist_post_save')
+post_delete.connect(setlist_changed, sender=Setlist,
+		dispatch_uid='afkradio.setlistrules.setlist_post_delete')
+m2m_changed.connect(setlist_songs_changed, sender=Setlist.associated_songs.through,
+		dispatch_uid='afkradio.setlistrules.m2m_changed')
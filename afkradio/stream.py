@@ -0,0 +1,239 @@
+from afkradio.models import Song, Playlist, PlayHistory
+from afkradio.utils import Playback, Control, station_mpd
+from afkradio.mpd import MPDClient, MPDStatus, mpd_connection, split_songs
+from afkradio.counters import count_play
+from afkradio.rollups import roll_up_if_due
+from afkradio.metrics import LatencyMetric
+from afkradio.prefetch import Prefetcher
+from django.db import connection
+from django.utils import timezone
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+with open(os.path.join(APP_ROOT,'config.json')) as config_file:
+	config_data = json.load(config_file)
+	PLAYLIST_SIZE = int(config_data['Playlist size'])
+	# JSON file the stream's metrics are written to after every refill,
+	# nothing is written when empty
+	STREAM_METRICS_FILE = config_data.get('Stream metrics file', '')
+
+# Stop marker for the worker's event queue
+STOP = object()
+
+
+# StreamDaemon
+# Keeps the stream going.  The main thread holds one MPD connection in
+# idle and wakes up only when MPD reports a player or playlist change; the
+# database and queue work those changes need runs on a worker thread, so
+# the idle connection goes straight back to waiting.
+#  - player: when MPD moved on to another song, the played songs are
+#    recorded and the queue refilled.  Pauses and seeks are ignored
+#  - playlist: MPD's queue is reconciled with the Playlist table, which
+#    repairs changes made by other MPD clients
+# After each refill the files of the next songs are read ahead by the
+# Prefetcher.  The time from MPD's event to the refill being done is kept
+# in refill_latency, and written to metrics_file when there is one, with
+# the prefetcher's cache hits and misses.
+# A daemon plays one station, the default station (None) unless one is
+# given: its queue, its history and its MPD.
+class StreamDaemon:
+	def __init__(self, from_setlists=True, client=None, metrics_file=STREAM_METRICS_FILE,
+			prefetcher=None, station=None):
+		self.from_setlists = from_setlists
+		self.station = station
+		self.playlist = Playlist.objects.for_station(station)
+		if client is None:
+			client = station.mpd_client() if station is not None else MPDClient()
+		self.client = client
+		self.prefetcher = prefetcher if prefetcher is not None else Prefetcher()
+		self.metrics_file = metrics_file
+		self.events = Queue.Queue()
+		self.refill_latency = LatencyMetric()
+		self.song_id = None
+		self.worker = None
+
+	# run
+	# Starts playing, filling the queue first when init is set, and
+	# returns when MPD stops
+	def run(self, init=True):
+		with station_mpd(self.station):
+			self.start(init)
+		self.worker = threading.Thread(target=self.run_worker, name='afkradio stream worker')
+		self.worker.daemon = True
+		self.worker.start()
+		try:
+			self.listen()
+		finally:
+			self.events.put(STOP)
+			self.worker.join()
+			self.prefetcher.stop()
+			self.client.close()
+
+	# run_inline
+	# Like run, but the database work happens on the calling thread and MPD
+	# is listened to on another, for databases that can't be shared between
+	# threads such as sqlite's in-memory test database
+	def run_inline(self, init=True):
+		with station_mpd(self.station):
+			self.start(init)
+		listen_errors = []
+		def listen():
+			try:
+				self.listen()
+			except Exception as error:
+				listen_errors.append(error)
+			finally:
+				self.events.put(STOP)
+		listener = threading.Thread(target=listen, name='afkradio stream listener')
+		listener.daemon = True
+		listener.start()
+		try:
+			with station_mpd(self.station):
+				self.work()
+		finally:
+			listener.join()
+			self.prefetcher.stop()
+			self.client.close()
+		if listen_errors:
+			raise listen_errors[0]
+
+	def start(self, init=True):
+		logging.info('Stream has been initiated')
+		if init:
+			Playback.mpc_clear()
+			self.playlist.clear_playlist_full()
+			Control.add_random_songs(PLAYLIST_SIZE, self.from_setlists, self.station)
+		Playback.mpc_play()
+		self.song_id = self.client.status().song_id
+		playing_path = Playback.mpc_current_path()
+		if playing_path is not None:
+			self.record_plays([playing_path])
+		self.prefetcher.start()
+		self.prefetcher.submit(Control.queue_paths(playing_path, self.station)[1:])
+
+	# listen
+	# Hands MPD's changes to the worker until MPD stops
+	def listen(self):
+		while self.wait():
+			pass
+
+	# wait
+	# Waits for MPD's next change and hands it to the worker.  Returns
+	# False once MPD has stopped
+	def wait(self):
+		changed = self.client.idle('player', 'playlist')
+		received_time = time.time()
+		if 'player' in changed:
+			status = self.client.status()
+			if status.song_id != self.song_id:
+				self.song_id = status.song_id
+				self.events.put(('player', received_time))
+			if status.is_stopped():
+				return False
+		if 'playlist' in changed:
+			self.events.put(('playlist', received_time))
+		return True
+
+	def run_worker(self):
+		try:
+			with station_mpd(self.station):
+				self.work()
+		finally:
+			connection.close()
+
+	# work
+	# Handles the events wait() queues, until STOP.  Whatever queued up
+	# meanwhile is handled together, with at most one reconcile.  A failing
+	# event is logged and the worker carries on with the next
+	def work(self):
+		while True:
+			events = [self.events.get()]
+			while True:
+				try:
+					events.append(self.events.get_nowait())
+				except Queue.Empty:
+					break
+			reconcile = False
+			for event in events:
+				if event is STOP:
+					return
+				if event[0] == 'player':
+					self.handle(self.handle_player, event[1])
+				else:
+					reconcile = True
+			if reconcile:
+				self.handle(self.reconcile)
+
+	def handle(self, handler, *args):
+		try:
+			handler(*args)
+		except Exception:
+			logging.exception('The stream could not handle an MPD event')
+
+	# handle_player
+	# MPD moved on: drops the played songs, records the ones that started
+	# and refills the end of the queue.  MPD can get more than one song
+	# further before the worker gets to it, the current song's position
+	# says how many.  The played songs are found by path, as a request
+	# sorts before the song that is playing in the Playlist.  Songs MPD
+	# has that aren't in the database (added by another MPD client) are
+	# left out, the queue is refilled all the same
+	def handle_player(self, received_time):
+		with mpd_connection() as client:
+			status, queue = client.execute_list([('status',), ('playlistinfo',)])
+		played_count = MPDStatus(status).song
+		if not played_count:
+			return
+		song_paths = [song.file for song in split_songs(queue)]
+		for song_path in song_paths[:played_count]:
+			played_pks = self.playlist.filter(song__filepath=song_path) \
+					.order_by('position').values_list('pk', flat=True)[:1]
+			Playlist.objects.filter(pk__in=list(played_pks)).delete()
+		self.record_plays(song_paths[1:played_count+1])
+		Control.add_random_songs(played_count, self.from_setlists, self.station)
+		Playback.mpc_delete(1, played_count)
+		self.refill_latency.observe(time.time() - received_time)
+		self.prefetcher.submit(song_paths[played_count+1:])
+		self.write_metrics()
+
+	# record_plays
+	# Records the songs at the paths as played, in order
+	def record_plays(self, song_paths):
+		song_ids = dict(Song.objects.filter(filepath__in=song_paths)
+				.values_list('filepath', 'pk'))
+		for song_path in song_paths:
+			if song_path not in song_ids:
+				logging.warning('MPD played ' + song_path + ', which is not in the database')
+				continue
+			self.record_play(song_ids[song_path])
+			logging.info('Played ' + song_path + ' (Song ID: ' + str(song_ids[song_path]) + ')')
+
+	def record_play(self, song_id):
+		PlayHistory.add_song(song_id, timezone.now(), self.station)
+		count_play(song_id)
+		roll_up_if_due()
+
+	def reconcile(self):
+		Playback.mpc_reconcile(Control.queue_paths(Playback.mpc_current_path(),
+				self.station))
+
+	# write_metrics
+	# Replaces metrics_file with the current metrics, as JSON
+	def write_metrics(self):
+		if not self.metrics_file:
+			return
+		metrics = {
+			'refill_latency_seconds': self.refill_latency.snapshot(),
+			'prefetch': self.prefetcher.snapshot(),
+			'updated': time.time(),
+			}
+		temp_path = self.metrics_file + '.tmp'
+		with open(temp_path, 'w') as metrics_file:
+			json.dump(metrics, metrics_file)
+		os.rename(temp_path, self.metrics_file)
@@ -0,0 +1,594 @@
+from afkradio.errors import *
+from afkradio.exifpool import read_metadata as read_exiftool_metadata
+import base64
+import hashlib
+import os
+import struct
+
+# In-process tag reader for the file types afkradio supports (MP3, OGG
+# Vorbis and FLAC).  Only the header bytes that are needed are read, using
+# bounded reads, so a file costs a few small reads instead of an exiftool
+# process.  read_tags returns the same {tag: value} dict as
+# exifpool.read_metadata so the results can be handed to Song.from_metadata
+# unchanged:
+# 	FileType, Title, Artist, Album, Year, Genre, Track,
+# 	Duration (in seconds), PictureMIMEType and Picture (the image bytes)
+# Anything it can't make sense of raises TagReadError and read_metadata
+# falls back to exiftool for that file.
+
+# How far past the ID3v2 tag to look for the first MPEG frame
+MPEG_SYNC_SEARCH_BYTES = 65536
+# How far from the end of an Ogg file to look for the last page
+OGG_LAST_PAGE_SEARCH_BYTES = 65536
+
+ID3V1_GENRES = (
+	'Blues', 'Classic Rock', 'Country', 'Dance', 'Disco', 'Funk', 'Grunge',
+	'Hip-Hop', 'Jazz', 'Metal', 'New Age', 'Oldies', 'Other', 'Pop', 'R&B',
+	'Rap', 'Reggae', 'Rock', 'Techno', 'Industrial', 'Alternative', 'Ska',
+	'Death Metal', 'Pranks', 'Soundtrack', 'Euro-Techno', 'Ambient',
+	'Trip-Hop', 'Vocal', 'Jazz+Funk', 'Fusion', 'Trance', 'Classical',
+	'Instrumental', 'Acid', 'House', 'Game', 'Sound Clip', 'Gospel', 'Noise',
+	'Alt. Rock', 'Bass', 'Soul', 'Punk', 'Space', 'Meditative',
+	'Instrumental Pop', 'Instrumental Rock', 'Ethnic', 'Gothic', 'Darkwave',
+	'Techno-Industrial', 'Electronic', 'Pop-Folk', 'Eurodance', 'Dream',
+	'Southern Rock', 'Comedy', 'Cult', 'Gangsta Rap', 'Top 40',
+	'Christian Rap', 'Pop/Funk', 'Jungle', 'Native American', 'Cabaret',
+	'New Wave', 'Psychedelic', 'Rave', 'Showtunes', 'Trailer', 'Lo-Fi',
+	'Tribal', 'Acid Punk', 'Acid Jazz', 'Polka', 'Retro', 'Musical',
+	'Rock & Roll', 'Hard Rock', 'Folk', 'Folk-Rock', 'National Folk', 'Swing',
+	'Fast-Fusion', 'Bebop', 'Latin', 'Revival', 'Celtic', 'Bluegrass',
+	'Avantgarde', 'Gothic Rock', 'Progressive Rock', 'Psychedelic Rock',
+	'Symphonic Rock', 'Slow Rock', 'Big Band', 'Chorus', 'Easy Listening',
+	'Acoustic', 'Humour', 'Speech', 'Chanson', 'Opera', 'Chamber Music',
+	'Sonata', 'Symphony', 'Booty Bass', 'Primus', 'Porn Groove', 'Satire',
+	'Slow Jam', 'Club', 'Tango', 'Samba', 'Folklore', 'Ballad',
+	'Power Ballad', 'Rhythmic Soul', 'Freestyle', 'Duet', 'Punk Rock',
+	'Drum Solo', 'A Cappella', 'Euro-House', 'Dance Hall', 'Goa',
+	'Drum & Bass', 'Club-House', 'Hardcore', 'Terror', 'Indie', 'BritPop',
+	'Afro-Punk', 'Polsk Punk', 'Beat', 'Christian Gangsta Rap', 'Heavy Metal',
+	'Black Metal', 'Crossover', 'Contemporary Christian', 'Christian Rock',
+	'Merengue', 'Salsa', 'Thrash Metal', 'Anime', 'JPop', 'Synthpop',
+	)
+
+# ID3v2 frame ids (v2.3/v2.4 and v2.2) and the tags they fill
+ID3_TEXT_FRAMES = {
+		'TIT2' : 'Title', 'TT2' : 'Title',
+		'TPE1' : 'Artist', 'TP1' : 'Artist',
+		'TALB' : 'Album', 'TAL' : 'Album',
+		'TYER' : 'Year', 'TYE' : 'Year', 'TDRC' : 'Year',
+		'TCON' : 'Genre', 'TCO' : 'Genre',
+		'TRCK' : 'Track', 'TRK' : 'Track',
+		}
+
+# Vorbis comment fields and the tags they fill
+VORBIS_COMMENT_FIELDS = {
+		'TITLE' : 'Title',
+		'ARTIST' : 'Artist',
+		'ALBUM' : 'Album',
+		'DATE' : 'Year',
+		'GENRE' : 'Genre',
+		'TRACKNUMBER' : 'Track',
+		}
+
+# v2.2 PIC frames store a three letter image format instead of a mime type
+ID3V22_IMAGE_FORMATS = {
+		'JPG' : 'image/jpeg',
+		'PNG' : 'image/png',
+		}
+
+# Bitrates in kbps indexed by [MPEG-1?][layer][bitrate index]
+MPEG_BITRATES = {
+		True : {
+			1 : (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+			2 : (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+			3 : (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+			},
+		False : {
+			1 : (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+			2 : (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+			3 : (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+			},
+		}
+# Sample rates indexed by version bits then sample rate index
+MPEG_SAMPLE_RATES = {
+		3 : (44100, 48000, 32000),
+		2 : (22050, 24000, 16000),
+		0 : (11025, 12000, 8000),
+		}
+
+
+# read_exact
+# Reads exactly length bytes or raises TagReadError
+def read_exact(song_file, length):
+	data = song_file.read(length)
+	if len(data) != length:
+		raise TagReadError('Unexpected end of file in ' + song_file.name)
+	return data
+
+def syncsafe_int(data):
+	value = 0
+	for byte in data:
+		value = (value << 7) | (ord(byte) & 0x7f)
+	return value
+
+# decode_id3_text
+# Decodes an ID3v2 text frame and returns the first of its values
+def decode_id3_text(data):
+	if not data:
+		return u''
+	encoding = ord(data[0])
+	if encoding == 0:
+		text = data[1:].decode('latin-1')
+	elif encoding == 1:
+		text = data[1:].decode('utf-16', 'replace')
+	elif encoding == 2:
+		text = data[1:].decode('utf-16-be', 'replace')
+	else:
+		text = data[1:].decode('utf-8', 'replace')
+	return text.split(u'\x00')[0].strip()
+
+# split_id3_string
+# Splits a null terminated string in the given ID3 encoding off the front
+# of data.  Returns (string, rest of data)
+def split_id3_string(data, encoding):
+	if encoding in (1, 2):
+		index = 0
+		while True:
+			index = data.find('\x00\x00', index)
+			if index == -1 or index % 2 == 0:
+				break
+			index += 1
+		terminator_length = 2
+	else:
+		index = data.find('\x00')
+		terminator_length = 1
+	if index == -1:
+		return data, ''
+	return data[:index], data[index+terminator_length:]
+
+# resolve_id3_genre
+# TCON may hold ID3v1 genre numbers as '(13)' or '13'
+def resolve_id3_genre(genre):
+	if genre.startswith(u'(') and u')' in genre:
+		genre_number, rest = genre[1:].split(u')', 1)
+		if rest:
+			return rest
+		genre = genre_number
+	if genre.isdigit() and int(genre) < len(ID3V1_GENRES):
+		return unicode(ID3V1_GENRES[int(genre)])
+	return genre
+
+# read_id3v2
+# Reads the ID3v2 tag at the start of song_file into tags.  Returns the
+# size of the tag in bytes (0 if there is none)
+def read_id3v2(song_file, tags):
+	song_file.seek(0)
+	header = song_file.read(10)
+	if len(header) < 10 or not header.startswith('ID3'):
+		return 0
+	major_version = ord(header[3])
+	flags = ord(header[5])
+	tag_size = syncsafe_int(header[6:10])
+	total_size = 10 + tag_size + (10 if flags & 0x10 else 0)
+	if major_version not in (2, 3, 4):
+		return total_size
+	tag_data = read_exact(song_file, tag_size)
+	# Whole-tag unsynchronisation (v2.2/v2.3)
+	if flags & 0x80 and major_version < 4:
+		tag_data = tag_data.replace('\xff\x00', '\xff')
+	position = 0
+	# Skip the extended header
+	if flags & 0x40 and major_version > 2:
+		if major_version == 3:
+			position = 4 + struct.unpack('>I', tag_data[0:4])[0]
+		else:
+			position = syncsafe_int(tag_data[0:4])
+	if major_version == 2:
+		frame_header_size = 6
+	else:
+		frame_header_size = 10
+	while position + frame_header_size <= len(tag_data):
+		frame_header = tag_data[position:position+frame_header_size]
+		if major_version == 2:
+			frame_id = frame_header[0:3]
+			frame_size = struct.unpack('>I', '\x00' + frame_header[3:6])[0]
+			frame_flags = 0
+		else:
+			frame_id = frame_header[0:4]
+			if major_version == 4:
+				frame_size = syncsafe_int(frame_header[4:8])
+			else:
+				frame_size = struct.unpack('>I', frame_header[4:8])[0]
+			frame_flags = struct.unpack('>H', frame_header[8:10])[0]
+		# Padding
+		if frame_id[0] == '\x00':
+			break
+		position += frame_header_size
+		frame_data = tag_data[position:position+frame_size]
+		position += frame_size
+		if major_version == 4:
+			# Data length indicator and per-frame unsynchronisation
+			if frame_flags & 0x0001:
+				frame_data = frame_data[4:]
+			if frame_flags & 0x0002:
+				frame_data = frame_data.replace('\xff\x00', '\xff')
+		# Skip compressed or encrypted frames
+		if (major_version == 3 and frame_flags & 0x00c0) or \
+				(major_version == 4 and frame_flags & 0x000c):
+			continue
+		if frame_id in ID3_TEXT_FRAMES:
+			tag = ID3_TEXT_FRAMES[frame_id]
+			if tag in tags:
+				continue
+			text = decode_id3_text(frame_data)
+			if tag == 'Genre':
+				text = resolve_id3_genre(text)
+			elif tag == 'Year':
+				text = text[0:4]
+			if text:
+				tags[tag] = text
+		elif frame_id in ('APIC', 'PIC') and 'Picture' not in tags and frame_data:
+			encoding = ord(frame_data[0])
+			if frame_id == 'PIC':
+				mime_type = ID3V22_IMAGE_FORMATS.get(frame_data[1:4].upper(), '')
+				rest = frame_data[4:]
+			else:
+				mime_type, rest = split_id3_string(frame_data[1:], 0)
+				mime_type = mime_type.lower()
+				if mime_type == 'image/jpg':
+					mime_type = 'image/jpeg'
+			# Skip the picture type then the description
+			description, picture = split_id3_string(rest[1:], encoding)
+			if mime_type and picture:
+				tags['PictureMIMEType'] = mime_type
+				tags['Picture'] = picture
+	return total_size
+
+# read_id3v1
+# Fills in whatever tags the ID3v1 tag at the end of song_file has that the
+# ID3v2 tag didn't.  Returns True if there is an ID3v1 tag
+def read_id3v1(song_file, file_size, tags):
+	if file_size < 128:
+		return False
+	song_file.seek(file_size - 128)
+	tag_data = song_file.read(128)
+	if not tag_data.startswith('TAG'):
+		return False
+	def text(data):
+		return data.split('\x00')[0].strip().decode('latin-1')
+	id3v1_tags = {
+			'Title' : text(tag_data[3:33]),
+			'Artist' : text(tag_data[33:63]),
+			'Album' : text(tag_data[63:93]),
+			'Year' : text(tag_data[93:97]),
+			}
+	# ID3v1.1 keeps the track number in the last byte of the comment
+	if tag_data[125] == '\x00' and tag_data[126] != '\x00':
+		id3v1_tags['Track'] = unicode(ord(tag_data[126]))
+	genre_number = ord(tag_data[127])
+	if genre_number < len(ID3V1_GENRES):
+		id3v1_tags['Genre'] = unicode(ID3V1_GENRES[genre_number])
+	for tag, value in id3v1_tags.items():
+		if value and tag not in tags:
+			tags[tag] = value
+	return True
+
+# parse_mpeg_header
+# Returns (MPEG-1?, version bits, layer, bitrate in kbps, sample rate,
+# channel mode) for a 4 byte frame header or None if it isn't valid
+def parse_mpeg_header(header):
+	header_int = struct.unpack('>I', header)[0]
+	if header_int & 0xffe00000 != 0xffe00000:
+		return None
+	version_bits = (header_int >> 19) & 3
+	layer_bits = (header_int >> 17) & 3
+	bitrate_index = (header_int >> 12) & 0xf
+	sample_rate_index = (header_int >> 10) & 3
+	channel_mode = (header_int >> 6) & 3
+	if version_bits == 1 or layer_bits == 0 or bitrate_index in (0, 15) or \
+			sample_rate_index == 3:
+		return None
+	is_mpeg1 = version_bits == 3
+	layer = 4 - layer_bits
+	bitrate = MPEG_BITRATES[is_mpeg1][layer][bitrate_index]
+	sample_rate = MPEG_SAMPLE_RATES[version_bits][sample_rate_index]
+	return (is_mpeg1, version_bits, layer, bitrate, sample_rate, channel_mode)
+
+# read_mpeg_duration
+# Finds the first MPEG frame after the ID3v2 tag and works out the
+# duration from its Xing/Info or VBRI header, or from the bitrate for CBR
+# files
+def read_mpeg_duration(song_file, audio_start, audio_end):
+	song_file.seek(audio_start)
+	data = song_file.read(MPEG_SYNC_SEARCH_BYTES)
+	index = data.find('\xff')
+	frame = None
+	while index != -1 and index + 4 <= len(data):
+		frame = parse_mpeg_header(data[index:index+4])
+		if frame is not None:
+			break
+		index = data.find('\xff', index + 1)
+	if frame is None:
+		raise TagReadError('No MPEG audio frame found in ' + song_file.name)
+	is_mpeg1, version_bits, layer, bitrate, sample_rate, channel_mode = frame
+	if layer == 1:
+		samples_per_frame = 384
+	elif layer == 2 or is_mpeg1:
+		samples_per_frame = 1152
+	else:
+		samples_per_frame = 576
+	# Xing/Info header sits after the side information
+	if is_mpeg1:
+		side_info_size = 17 if channel_mode == 3 else 32
+	else:
+		side_info_size = 9 if channel_mode == 3 else 17
+	xing_offset = index + 4 + side_info_size
+	vbr_frame_count = None
+	if data[xing_offset:xing_offset+4] in ('Xing', 'Info'):
+		xing_flags = struct.unpack('>I', data[xing_offset+4:xing_offset+8])[0]
+		if xing_flags & 1:
+			vbr_frame_count = struct.unpack('>I', data[xing_offset+8:xing_offset+12])[0]
+	elif data[index+36:index+40] == 'VBRI':
+		vbr_frame_count = struct.unpack('>I', data[index+50:index+54])[0]
+	if vbr_frame_count:
+		return float(vbr_frame_count * samples_per_frame) / sample_rate
+	audio_bytes = audio_end - (audio_start + index)
+	return audio_bytes * 8.0 / (bitrate * 1000)
+
+def read_mp3(song_file, file_size, tags):
+	tags['FileType'] = 'MP3'
+	audio_start = read_id3v2(song_file, tags)
+	audio_end = file_size
+	if read_id3v1(song_file, file_size, tags):
+		audio_end -= 128
+	tags['Duration'] = read_mpeg_duration(song_file, audio_start, audio_end)
+
+# parse_vorbis_comments
+# Reads a Vorbis comment block (shared by Ogg Vorbis and FLAC) into tags
+def parse_vorbis_comments(data, tags):
+	try:
+		vendor_length = struct.unpack('<I', data[0:4])[0]
+		position = 4 + vendor_length
+		comment_count = struct.unpack('<I', data[position:position+4])[0]
+		position += 4
+		for comment_number in range(comment_count):
+			comment_length = struct.unpack('<I', data[position:position+4])[0]
+			position += 4
+			comment = data[position:position+comment_length]
+			position += comment_length
+			if '=' not in comment:
+				continue
+			field, value = comment.split('=', 1)
+			field = field.upper()
+			if field in VORBIS_COMMENT_FIELDS:
+				tag = VORBIS_COMMENT_FIELDS[field]
+				if tag not in tags:
+					tags[tag] = value.decode('utf-8', 'replace').strip()
+					if tag == 'Year':
+						tags[tag] = tags[tag][0:4]
+			elif field == 'METADATA_BLOCK_PICTURE' and 'Picture' not in tags:
+				parse_flac_picture(base64.b64decode(value), tags)
+	except (struct.error, TypeError):
+		raise TagReadError('Malformed Vorbis comment block')
+
+# parse_flac_picture
+# Reads a FLAC PICTURE block (also used base64 encoded in Ogg comments)
+def parse_flac_picture(data, tags):
+	try:
+		mime_length = struct.unpack('>I', data[4:8])[0]
+		mime_type = data[8:8+mime_length].lower()
+		position = 8 + mime_length
+		description_length = struct.unpack('>I', data[position:position+4])[0]
+		# Skip the description, width, height, depth and color count
+		position += 4 + description_length + 16
+		picture_length = struct.unpack('>I', data[position:position+4])[0]
+		position += 4
+		picture = data[position:position+picture_length]
+	except struct.error:
+		raise TagReadError('Malformed FLAC picture block')
+	if mime_type == 'image/jpg':
+		mime_type = 'image/jpeg'
+	if picture:
+		tags['PictureMIMEType'] = mime_type
+		tags['Picture'] = picture
+
+def read_flac(song_file, file_size, tags):
+	tags['FileType'] = 'FLAC'
+	# Some taggers put an ID3v2 tag in front of the FLAC stream
+	song_file.seek(0)
+	if song_file.read(3) == 'ID3':
+		song_file.seek(6)
+		song_file.seek(10 + syncsafe_int(read_exact(song_file, 4)))
+	else:
+		song_file.seek(0)
+	if read_exact(song_file, 4) != 'fLaC':
+		raise TagReadError('Not a FLAC stream: ' + song_file.name)
+	is_last_block = False
+	while not is_last_block:
+		block_header = read_exact(song_file, 4)
+		is_last_block = bool(ord(block_header[0]) & 0x80)
+		block_type = ord(block_header[0]) & 0x7f
+		block_length = struct.unpack('>I', '\x00' + block_header[1:4])[0]
+		if block_type == 0:
+			streaminfo = read_exact(song_file, block_length)
+			sample_info = struct.unpack('>Q', streaminfo[10:18])[0]
+			sample_rate = sample_info >> 44
+			total_samples = sample_info & 0xfffffffff
+			if sample_rate:
+				tags['Duration'] = float(total_samples) / sample_rate
+		elif block_type == 4:
+			parse_vorbis_comments(read_exact(song_file, block_length), tags)
+		elif block_type == 6 and 'Picture' not in tags:
+			parse_flac_picture(read_exact(song_file, block_length), tags)
+		elif block_type == 127:
+			raise TagReadError('Invalid FLAC metadata block in ' + song_file.name)
+		else:
+			song_file.seek(block_length, os.SEEK_CUR)
+	if 'Duration' not in tags:
+		raise TagReadError('No FLAC STREAMINFO block in ' + song_file.name)
+
+# read_ogg_packets
+# Yields the packets of the first logical stream of an Ogg file, reading
+# a page at a time
+def read_ogg_packets(song_file):
+	packet = ''
+	while True:
+		page_header = song_file.read(27)
+		if len(page_header) < 27:
+			return
+		if not page_header.startswith('OggS'):
+			raise TagReadError('Lost Ogg page sync in ' + song_file.name)
+		segment_count = ord(page_header[26])
+		segment_table = read_exact(song_file, segment_count)
+		page_data = read_exact(song_file, sum(ord(size) for size in segment_table))
+		position = 0
+		for segment_size in segment_table:
+			segment_size = ord(segment_size)
+			packet += page_data[position:position+segment_size]
+			position += segment_size
+			if segment_size < 255:
+				yield packet
+				packet = ''
+
+def read_ogg(song_file, file_size, tags):
+	tags['FileType'] = 'OGG'
+	song_file.seek(0)
+	packets = read_ogg_packets(song_file)
+	identification = next(packets, '')
+	if not identification.startswith('\x01vorbis'):
+		raise TagReadError('Not an Ogg Vorbis stream: ' + song_file.name)
+	sample_rate = struct.unpack('<I', identification[12:16])[0]
+	comments = next(packets, '')
+	if comments.startswith('\x03vorbis'):
+		parse_vorbis_comments(comments[7:], tags)
+	# The granule position of the last page is the total sample count
+	search_start = max(0, file_size - OGG_LAST_PAGE_SEARCH_BYTES)
+	song_file.seek(search_start)
+	tail = song_file.read(OGG_LAST_PAGE_SEARCH_BYTES)
+	last_page = tail.rfind('OggS')
+	if last_page == -1 or last_page + 14 > len(tail) or not sample_rate:
+		raise TagReadError('No final Ogg page found in ' + song_file.name)
+	granule_position = struct.unpack('<q', tail[last_page+6:last_page+14])[0]
+	tags['Duration'] = float(granule_position) / sample_rate
+
+# read_tags
+# Reads the tags of a single file.  Raises IOError/OSError if the file
+# can't be opened and TagReadError if it can't be parsed
+def read_tags(abs_song_path):
+	tags = {}
+	with open(abs_song_path, 'rb') as song_file:
+		file_size = os.fstat(song_file.fileno()).st_size
+		magic = song_file.read(4)
+		try:
+			if magic == 'fLaC':
+				read_flac(song_file, file_size, tags)
+			elif magic == 'OggS':
+				read_ogg(song_file, file_size, tags)
+			elif magic.startswith('ID3') or \
+					(len(magic) == 4 and parse_mpeg_header(magic) is not None):
+				# FLAC files can carry an ID3v2 tag too
+				if magic.startswith('ID3'):
+					song_file.seek(6)
+					song_file.seek(10 + syncsafe_int(read_exact(song_file, 4)))
+					if song_file.read(4) == 'fLaC':
+						read_flac(song_file, file_size, tags)
+						return tags
+				read_mp3(song_file, file_size, tags)
+			else:
+				raise TagReadError('Unrecognised file type: ' + abs_song_path)
+		except (struct.error, IndexError, KeyError):
+			raise TagReadError('Malformed tags in ' + abs_song_path)
+	return tags
+
+# read_metadata
+# Same interface as exifpool.read_metadata.  Reads what it can in-process
+# and hands the rest to exiftool with a single command
+def read_metadata(abs_song_paths):
+	metadata = {}
+	exiftool_song_paths = []
+	for abs_song_path in abs_song_paths:
+		try:
+			metadata[abs_song_path] = read_tags(abs_song_path)
+		except TagReadError:
+			exiftool_song_paths.append(abs_song_path)
+		except (IOError, OSError):
+			# Missing files are left out, like exiftool does
+			pass
+	if exiftool_song_paths:
+		metadata.update(read_exiftool_metadata(exiftool_song_paths))
+	return metadata
+
+# Bytes hashed from each of the start, middle and end of the audio payload
+FINGERPRINT_SAMPLE_BYTES = 65536
+
+# audio_payload_range
+# Returns (start, end) of the audio data in song_file, leaving out ID3v2,
+# ID3v1 and APEv2 tags, FLAC metadata blocks and Ogg header pages, so
+# retagging a file doesn't change its fingerprint
+def audio_payload_range(song_file, file_size):
+	song_file.seek(0)
+	start = 0
+	end = file_size
+	header = song_file.read(10)
+	if header.startswith('ID3') and len(header) == 10:
+		start = 10 + syncsafe_int(header[6:10])
+		if ord(header[5]) & 0x10:
+			start += 10
+		song_file.seek(start)
+		header = song_file.read(4)
+	if header.startswith('fLaC'):
+		position = start + 4
+		is_last_block = False
+		while not is_last_block and position + 4 <= file_size:
+			song_file.seek(position)
+			block_header = read_exact(song_file, 4)
+			is_last_block = bool(ord(block_header[0]) & 0x80)
+			position += 4 + struct.unpack('>I', '\x00' + block_header[1:4])[0]
+		return (min(position, file_size), end)
+	if header.startswith('OggS'):
+		# Header pages have a granule position of 0, audio starts at the
+		# first page with a real one
+		position = start
+		while position + 27 <= file_size:
+			song_file.seek(position)
+			page_header = read_exact(song_file, 27)
+			if not page_header.startswith('OggS'):
+				break
+			if struct.unpack('<q', page_header[6:14])[0] > 0:
+				break
+			segment_table = read_exact(song_file, ord(page_header[26]))
+			position += 27 + len(segment_table) + sum(ord(size) for size in segment_table)
+		return (min(position, file_size), end)
+	if end - start >= 128:
+		song_file.seek(end - 128)
+		if song_file.read(3) == 'TAG':
+			end -= 128
+	if end - start >= 32:
+		song_file.seek(end - 32)
+		ape_footer = song_file.read(32)
+		if ape_footer.startswith('APETAGEX'):
+			end -= struct.unpack('<I', ape_footer[12:16])[0]
+			# The APEv2 size leaves out its header
+			if struct.unpack('<I', ape_footer[20:24])[0] & 0x80000000:
+				end -= 32
+	return (start, max(start, end))
+
+# audio_fingerprint
+# A cheap content hash of a song's audio: the payload size plus samples
+# from the start, middle and end of the payload.  Stays the same when the
+# file is moved, renamed or retagged
+def audio_fingerprint(abs_song_path):
+	with open(abs_song_path, 'rb') as song_file:
+		file_size = os.fstat(song_file.fileno()).st_size
+		try:
+			start, end = audio_payload_range(song_file, file_size)
+		except (TagReadError, struct.error, IndexError):
+			start, end = 0, file_size
+		payload_size = end - start
+		fingerprint = hashlib.sha1(str(payload_size))
+		for sample_start in (start, start + payload_size // 2 - FINGERPRINT_SAMPLE_BYTES // 2,
+				end - FINGERPRINT_SAMPLE_BYTES):
+			sample_start = max(start, sample_start)
+			song_file.seek(sample_start)
+			fingerprint.update(song_file.read(min(FINGERPRINT_SAMPLE_BYTES, end - sample_start)))
+	return fingerprint.hexdigest()
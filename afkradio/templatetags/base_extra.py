@@ -1,5 +1,6 @@
 from django.template import Library, Node
 from afkradio.models import Playlist, PlayHistory
+from afkradio.counters import pending_amount
 import datetime
 
 register = Library()
@@ -27,6 +28,11 @@ def get_song_artist(playlist_song, length=None):
 	else:
 		return shorten(artist, length)
 
+# The song's favourites, with the ones this process hasn't written yet
+@register.filter(name='favecount')
+def favecount(song):
+	return song.favecount + pending_amount(song.pk, 'favecount')
+
 # The characters + & ; % # need to use their URL encoding reference
 # The following filter fixes them
 @register.filter(name='fix_special_chars')
@@ -52,24 +58,14 @@ class PlaylistContentNode(Node):
 		self.varname = varname
 	
 	def create_timetable(self, sorted_playlist):
-		latest_song_time = PlayHistory.objects.latest('played_time').played_time
+		latest_song_time = PlayHistory.objects.for_station(None).latest('played_time').played_time
 		timetable = []
-		timedelta_table=[]
-		count = 0
+		elapsed_secs = 0
+		# sorted_playlist comes with its songs (queue_sorted uses select_related)
 		for playlist_song in sorted_playlist:
-			duration = playlist_song.song_duration()
-			hrs = int(duration[0])
-			mins = int(duration[2:4])
-			secs = int(duration[5:7])
-			if count == 0:
-				time = latest_song_time + \
-						datetime.timedelta(hours=hrs,minutes=mins,seconds=secs)
-			else:
-				time = timedelta_table[count-1] + \
-						datetime.timedelta(hours=hrs,minutes=mins,seconds=secs)
-			timedelta_table.append(time)
+			elapsed_secs += playlist_song.song_duration_secs()
+			time = latest_song_time + datetime.timedelta(seconds=elapsed_secs)
 			timetable.append(time.strftime("%H:%M"))
-			count += 1
 		return timetable
 
 	def check_requested(self, sorted_playlist):
@@ -82,7 +78,7 @@ class PlaylistContentNode(Node):
 		return request_check
 
 	def render(self, context):
-		playlist_sorted = Playlist.objects.queue_sorted()[:self.count]
+		playlist_sorted = list(Playlist.objects.for_station(None).queue_sorted()[:self.count])
 		request_check = self.check_requested(playlist_sorted)
 		timetable = self.create_timetable(playlist_sorted)
 		context[self.varname] = zip(request_check, timetable, playlist_sorted)
@@ -90,7 +86,7 @@ class PlaylistContentNode(Node):
 
 def get_playlist(parser, token):
 	bits = token.contents.split()
-	count = Playlist.objects.count()
+	count = Playlist.objects.for_station(None).count()
 	if len(bits) != 3:
 		raise TemplateSyntaxError, "get_playlist tag takes exactly 2 arguments"
 	if bits[1] != 'as':
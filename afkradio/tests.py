@@ -1,14 +1,125 @@
+# -*- coding: utf-8 -*-
 from django.test import TestCase
-from afkradio.models import Song, Setlist
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test.utils import CaptureQueriesContext
+from afkradio.models import Song, Setlist, Station
 from django.utils import timezone
-from afkradio.utils import Playback, Database, Playlist, PlayHistory
+from afkradio.utils import Playback, Control, Database, Playlist, PlayHistory
 from afkradio.errors import *
+from afkradio.exifpool import ExiftoolPool, read_metadata
+from afkradio.scanner import LibraryScanner
+from afkradio.watcher import LibraryWatcher
+from afkradio import inotify
+from afkradio import tagreader
+from afkradio import albumart
+from afkradio import setlistrules
+from afkradio import scheduler
+from afkradio import counters
+from afkradio import rollups
+from afkradio.models import PlayRollup, ROLLUP_HOUR, ROLLUP_DAY
+from afkradio.queuediff import queue_operations, apply_operations
+from afkradio import mpd
+from afkradio import stream
+from afkradio.fakempd import FakeMPDServer, AckError
+from afkradio import prefetch
+from afkradio.templatetags.base_extra import PlaylistContentNode
+from afkradio.templatetags import base_extra
+from array import array
+from StringIO import StringIO
+import afkradio.models
+import afkradio.scanner
 import datetime
+import json
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
 import time
 
 # If you want to run these tests, then please place the folder 'Test Path' located
 # in the app root into your MPD music root folder.
 
+def available_song_ids_array():
+	return afkradio.models.available_song_ids.get_ids()
+
+# write_test_mp3
+# Writes a small silent MP3 with an ID3v2.3 tag to path so tests that don't
+# need the 'Test Path' folder can build their own music root
+def write_test_mp3(path, frame_count=400, **tags):
+	id3_frame_ids = {
+			'title' : 'TIT2',
+			'artist' : 'TPE1',
+			'album' : 'TALB',
+			'year' : 'TYER',
+			'genre' : 'TCON',
+			'trackno' : 'TRCK',
+			}
+	id3_frames = ''
+	for tag in tags.keys():
+		frame_data = '\x03' + tags[tag].encode('utf-8')
+		id3_frames += id3_frame_ids[tag] + struct.pack('>I', len(frame_data)) + \
+				'\x00\x00' + frame_data
+	tag_size = len(id3_frames)
+	syncsafe_size = ''.join(chr((tag_size >> shift) & 0x7f) for shift in (21, 14, 7, 0))
+	# MPEG-1 Layer III, 128kbps, 44100Hz frames are 417 bytes long
+	mpeg_frame = '\xff\xfb\x90\x64' + '\x00' * 413
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, 'wb') as mp3_file:
+		mp3_file.write('ID3\x03\x00\x00' + syncsafe_size + id3_frames)
+		mp3_file.write(mpeg_frame * frame_count)
+
+# vorbis_comment_block
+# Builds a Vorbis comment block as used by both Ogg Vorbis and FLAC
+def vorbis_comment_block(tags):
+	comments = ['%s=%s' % (field.upper(), value.encode('utf-8'))
+			for field, value in tags.items()]
+	block = struct.pack('<I', 4) + 'test' + struct.pack('<I', len(comments))
+	for comment in comments:
+		block += struct.pack('<I', len(comment)) + comment
+	return block
+
+# write_test_flac
+# Writes a FLAC stream with STREAMINFO, Vorbis comment and, if given,
+# PICTURE blocks but no audio frames
+def write_test_flac(path, seconds=60, picture=None, **tags):
+	sample_rate = 44100
+	streaminfo = struct.pack('>HH', 4096, 4096) + '\x00' * 6 + \
+			struct.pack('>Q', (sample_rate << 44) | (1 << 41) | (15 << 36) | \
+				(sample_rate * seconds)) + '\x00' * 16
+	blocks = [(0, streaminfo), (4, vorbis_comment_block(tags))]
+	if picture is not None:
+		blocks.append((6, struct.pack('>II', 3, 10) + 'image/jpeg' + \
+			struct.pack('>I', 0) + struct.pack('>IIII', 1, 1, 24, 0) + \
+			struct.pack('>I', len(picture)) + picture))
+	with open(path, 'wb') as flac_file:
+		flac_file.write('fLaC')
+		for index, (block_type, block) in enumerate(blocks):
+			if index == len(blocks) - 1:
+				block_type |= 0x80
+			flac_file.write(chr(block_type) + struct.pack('>I', len(block))[1:] + block)
+
+# write_test_ogg
+# Writes an Ogg Vorbis stream with identification and comment headers and
+# a final page whose granule position gives the duration
+def write_test_ogg(path, seconds=60, **tags):
+	sample_rate = 44100
+	def ogg_page(header_type, granule_position, sequence, packet):
+		segments = [255] * (len(packet) // 255) + [len(packet) % 255]
+		return 'OggS\x00' + chr(header_type) + struct.pack('<qII', granule_position, 1, sequence) + \
+				'\x00' * 4 + chr(len(segments)) + ''.join(chr(size) for size in segments) + packet
+	identification = '\x01vorbis' + struct.pack('<IBI', 0, 2, sample_rate) + \
+			'\x00' * 12 + '\xb8\x01'
+	comments = '\x03vorbis' + vorbis_comment_block(tags) + '\x01'
+	with open(path, 'wb') as ogg_file:
+		ogg_file.write(ogg_page(2, 0, 0, identification))
+		ogg_file.write(ogg_page(0, 0, 1, comments))
+		ogg_file.write(ogg_page(0, sample_rate, 2, '\x00' * 300))
+		ogg_file.write(ogg_page(4, sample_rate * seconds, 3, '\x00' * 100))
+
 class ModelSongMethodTests(TestCase):
 	def test_add_song_exiftool_test_song(self):
 		"""
@@ -100,6 +211,948 @@ class ModelSongMethodTests(TestCase):
 		self.assertTrue(len(Setlist.objects.song_ids_of_active_setlists()) == 4)
 		self.assertEqual(Song.objects.get_random_from_active_setlists().title, 'Test_Title')
 
+class ModelSongRandomTests(TestCase):
+	def test_get_random(self):
+		"""
+		Tests that get_random only picks available songs, with a single
+		query once the ids are loaded, and sees songs as they are added
+		"""
+		with self.assertRaises(SongNotFoundError):
+			Song.objects.get_random()
+		Song.objects.create(title='Removed', removed=True)
+		available_song = Song.objects.create(title='Available')
+		Song.objects.get_random()
+		with self.assertNumQueries(1):
+			self.assertEqual(Song.objects.get_random(), available_song)
+		other_song = Song.objects.create(title='Other')
+		picked_titles = set(Song.objects.get_random().title for pick in range(50))
+		self.assertEqual(picked_titles, set(['Available', 'Other']))
+
+	def test_get_random_reloads_stale_ids(self):
+		"""
+		Tests that a song removed without a signal (by update()) is never
+		returned
+		"""
+		removed_song = Song.objects.create(title='Removed')
+		available_song = Song.objects.create(title='Available')
+		Song.objects.get_random()
+		Song.objects.filter(pk=removed_song.pk).update(removed=True)
+		for pick in range(20):
+			self.assertEqual(Song.objects.get_random(), available_song)
+
+class ModelSetlistPoolTests(TestCase):
+	def setUp(self):
+		self.songs = [Song.objects.create(title='Song %d' % song_count)
+				for song_count in range(4)]
+		self.setlists = []
+		for setlist_name in ('one', 'two'):
+			Setlist.add_setlist(setlist_name)
+			self.setlists.append(Setlist.objects.get(setlist=setlist_name))
+		self.setlists[0].associated_songs.add(self.songs[0], self.songs[1])
+		self.setlists[1].associated_songs.add(self.songs[2])
+
+	def picked_titles(self, picks=40):
+		return set(Song.objects.get_random_from_active_setlists().title
+				for pick in range(picks))
+
+	def test_picks_from_active_setlists(self):
+		"""
+		Tests that picks come from the active setlists and take one query
+		once their pool is loaded
+		"""
+		self.assertFalse(Song.objects.get_random_from_active_setlists())
+		Setlist.objects.activate_setlist('one')
+		self.assertEqual(self.picked_titles(), set(['Song 0', 'Song 1']))
+		with self.assertNumQueries(1):
+			Song.objects.get_random_from_active_setlists()
+		Setlist.objects.activate_setlist('two')
+		self.assertEqual(self.picked_titles(), set(['Song 0', 'Song 1', 'Song 2']))
+
+	def test_pool_follows_setlist_changes(self):
+		"""
+		Tests that adding and removing songs from a setlist, from either side
+		of the relation, and removing a song change the pool
+		"""
+		Setlist.objects.activate_setlist('two')
+		self.assertEqual(self.picked_titles(), set(['Song 2']))
+		self.setlists[1].associated_songs.add(self.songs[3])
+		self.assertEqual(self.picked_titles(), set(['Song 2', 'Song 3']))
+		self.songs[3].setlist_set.remove(self.setlists[1])
+		self.assertEqual(self.picked_titles(), set(['Song 2']))
+		self.songs[0].setlist_set.add(self.setlists[1])
+		Song.objects.filter(pk=self.songs[2].pk).update(removed=True)
+		self.assertEqual(self.picked_titles(), set(['Song 0']))
+
+class SetlistRuleTests(TestCase):
+	def setUp(self):
+		self.songs = {}
+		for title, year in (('Fast anime', '2012'), ('Fast ballad', '2012'),
+				('Old anime', '1999'), ('Ballad', '2011'), ('Nothing', '2013')):
+			self.songs[title] = Song.objects.create(title=title, year=year)
+		for setlist_name, titles in (('Fast', ('Fast anime', 'Fast ballad')),
+				('Anime', ('Fast anime', 'Old anime')),
+				('Ballads', ('Fast ballad', 'Ballad'))):
+			Setlist.add_setlist(setlist_name)
+			Setlist.objects.get(setlist=setlist_name).associated_songs.add(
+					*[self.songs[title] for title in titles])
+
+	def matching_titles(self, rule):
+		return set(Song.objects.get(pk=song_id).title
+				for song_id in setlistrules.song_ids_matching_rule(rule))
+
+	def test_bitmaps(self):
+		"""
+		Tests that ids survive the trip to a bitmap and back
+		"""
+		for ids in ([], [0], [1, 7, 8, 9], range(0, 5000, 3)):
+			bitmap = setlistrules.ids_to_bitmap(ids)
+			self.assertEqual(list(setlistrules.bitmap_to_ids(bitmap)), sorted(ids))
+		self.assertEqual(setlistrules.ids_to_bitmap([0, 3]), 9)
+
+	def test_parse_rule(self):
+		"""
+		Tests that intersection binds tighter than union and difference
+		"""
+		self.assertEqual(setlistrules.parse_rule(u'(Fast ∪ Anime) − Ballads ∩ year>=2010'),
+				('-', ('|', ('setlist', 'Fast'), ('setlist', 'Anime')),
+					('&', ('setlist', 'Ballads'), ('filter', 'year', '>=', '2010'))))
+		self.assertEqual(setlistrules.parse_rule('"My list" | genre="Drum & Bass"'),
+				('|', ('setlist', 'My list'), ('filter', 'genre', '=', 'Drum & Bass')))
+		for bad_rule in ('Fast |', '(Fast', 'Fast Anime', '| Fast', 'Fast ) Anime'):
+			with self.assertRaises(SetlistRuleError):
+				setlistrules.parse_rule(bad_rule)
+		with self.assertRaises(FieldNotFoundError):
+			setlistrules.parse_rule('filepath=x')
+		for bad_rule in ('playcount>abc', 'duration_secs=x', 'trackno!=1.5', 'year>=soon'):
+			with self.assertRaises(SetlistRuleError):
+				setlistrules.parse_rule(bad_rule)
+		self.assertEqual(setlistrules.parse_rule('year=unknown'),
+				('filter', 'year', '=', 'unknown'))
+
+	def test_rules(self):
+		"""
+		Tests union, intersection, difference and filters
+		"""
+		self.assertEqual(self.matching_titles('Fast | Anime'),
+				set(['Fast anime', 'Fast ballad', 'Old anime']))
+		self.assertEqual(self.matching_titles('(Fast | Anime) - Ballads'),
+				set(['Fast anime', 'Old anime']))
+		self.assertEqual(self.matching_titles('(Fast | Anime) & year>=2010'),
+				set(['Fast anime', 'Fast ballad']))
+		self.assertEqual(self.matching_titles('Ballads & year!=2012'), set(['Ballad']))
+		with self.assertRaises(SetlistNotFoundError):
+			setlistrules.song_ids_matching_rule('Missing')
+
+	def test_rule_years_compare_as_numbers(self):
+		"""
+		Tests that years are ordered as numbers, leaving out songs without
+		one, and that year can't be ordered against text
+		"""
+		Song.objects.create(title='Short year', year='999')
+		Song.objects.create(title='Dated', year='2014-05-01')
+		Song.objects.create(title='Unknown', year='unknown')
+		self.assertEqual(self.matching_titles('year<2000'), set(['Old anime', 'Short year']))
+		self.assertEqual(self.matching_titles('year>2012'), set(['Nothing', 'Dated']))
+		with self.assertRaises(SetlistRuleError):
+			setlistrules.song_ids_matching_rule('year>=soon')
+
+	def test_rule_duplicate_setlist_names(self):
+		"""
+		Tests that a name matches the songs of every setlist called that
+		"""
+		Setlist.objects.create(setlist='Fast').associated_songs.add(self.songs['Nothing'])
+		self.assertEqual(self.matching_titles('Fast'),
+				set(['Fast anime', 'Fast ballad', 'Nothing']))
+
+	def test_rules_follow_changes(self):
+		"""
+		Tests that setlist and song changes show up in the rule pools and
+		that random picks come from the pool
+		"""
+		self.assertEqual(self.matching_titles('Anime - Fast'), set(['Old anime']))
+		self.assertEqual(Song.objects.get_random_from_rule('Anime - Fast').title, 'Old anime')
+		Setlist.objects.get(setlist='Anime').associated_songs.add(self.songs['Nothing'])
+		self.assertEqual(self.matching_titles('Anime - Fast'),
+				set(['Old anime', 'Nothing']))
+		self.songs['Old anime'].removed = True
+		self.songs['Old anime'].save()
+		self.assertEqual(self.matching_titles('Anime - Fast'), set(['Nothing']))
+		self.songs['Nothing'].setlist_set.clear()
+		self.assertEqual(self.matching_titles('Anime - Fast'), set())
+		self.assertFalse(Song.objects.get_random_from_rule('Anime - Fast'))
+
+class SchedulerTests(TestCase):
+	def test_fenwick_tree(self):
+		"""
+		Tests prefix sums, updates and weighted lookups of the FenwickTree
+		"""
+		tree = scheduler.FenwickTree([1.0, 0.0, 2.0, 3.0, 0.5])
+		self.assertEqual(tree.total(), 6.5)
+		self.assertEqual([tree.find(position) for position in (0, 0.9, 1.0, 2.9, 3.0, 5.9, 6.2)],
+				[0, 0, 2, 2, 3, 3, 4])
+		tree.add(2, -2.0)
+		self.assertEqual(tree.total(), 4.5)
+		self.assertEqual(tree.find(1.0), 3)
+
+	def test_weighted_engine(self):
+		"""
+		Tests that the weighted engine leaves out recent songs and artists,
+		seeds its history from PlayHistory and favours favourited songs
+		"""
+		songs = [Song.objects.create(title='Song %d' % song_count,
+			artist='Artist %d' % (song_count % 3), favecount=song_count)
+			for song_count in range(6)]
+		PlayHistory.add_song(songs[0].pk, timezone.now())
+		engine = scheduler.WeightedEngine(song_history_size=2, artist_history_size=1)
+		song_ids = available_song_ids_array()
+		picked_ids = set(engine.pick(song_ids) for pick in range(200))
+		# Artist 0 (songs 0 and 3) was played last
+		self.assertEqual(picked_ids, set(song.pk for song in songs
+			if song.artist != 'Artist 0'))
+		engine.record_song(songs[1])
+		picked_ids = set(engine.pick(song_ids) for pick in range(200))
+		# Song 0 is still in the song history, artist 1 is now excluded
+		self.assertEqual(picked_ids, set([songs[2].pk, songs[3].pk, songs[5].pk]))
+		engine.record_song(songs[2])
+		engine.record_song(songs[2])
+		picked_counts = {}
+		for pick in range(2000):
+			song_id = engine.pick(song_ids)
+			picked_counts[song_id] = picked_counts.get(song_id, 0) + 1
+		self.assertEqual(set(picked_counts), set([songs[0].pk, songs[1].pk,
+			songs[3].pk, songs[4].pk]))
+		# Weights are 1, 2, 4 and 5
+		self.assertTrue(picked_counts[songs[4].pk] > 3 * picked_counts[songs[0].pk])
+
+	def test_untagged_artists(self):
+		"""
+		Tests that songs without an artist don't exclude each other
+		"""
+		songs = [Song.objects.create(title='Untagged %d' % song_count, artist='')
+				for song_count in range(3)]
+		engine = scheduler.WeightedEngine(song_history_size=1, artist_history_size=2)
+		engine.record_song(songs[0])
+		picked_ids = set(engine.pick(available_song_ids_array()) for pick in range(100))
+		self.assertEqual(picked_ids, set([songs[1].pk, songs[2].pk]))
+
+	def test_song_weights(self):
+		"""
+		Tests that pools are built from the shared weights without reading
+		the songs table, which follows saves and reads songs it hasn't seen
+		"""
+		weights = scheduler.SongWeights()
+		song = Song.objects.create(title='Song', artist='Artist', favecount=1)
+		song_ids = array('l', [song.pk])
+		self.assertEqual(weights.get(song_ids)[song.pk], ('Artist', 2.0))
+		with self.assertNumQueries(0):
+			weights.get(song_ids)
+		weights.song_saved(Song, Song(pk=song.pk, artist='Artist', favecount=3))
+		self.assertEqual(weights.get(song_ids)[song.pk], ('Artist', 4.0))
+		Song.objects.bulk_create([Song(title='Bulk', artist='Other', filepath='bulk.mp3')])
+		bulk_song = Song.objects.get(title='Bulk')
+		with self.assertNumQueries(1):
+			self.assertEqual(weights.get(array('l', [song.pk, bulk_song.pk]))[bulk_song.pk],
+					('Other', 1.0))
+
+	def test_everything_excluded(self):
+		"""
+		Tests that a pool smaller than the history still gives songs
+		"""
+		song = Song.objects.create(title='Only song', artist='Artist')
+		engine = scheduler.WeightedEngine()
+		engine.record_song(song)
+		self.assertEqual(engine.pick(available_song_ids_array()), song.pk)
+		self.assertEqual(engine.pick(array('l')), None)
+
+class QueueDiffTests(TestCase):
+	def test_request(self):
+		"""
+		Tests that swapping the last song of a long queue for a request is
+		one insert and one delete
+		"""
+		queue = ['song%d.mp3' % song_count for song_count in range(30)]
+		requested_queue = ['request.mp3'] + queue[:-1]
+		operations = queue_operations(queue, requested_queue, offset=1)
+		self.assertEqual(operations, [('delete', 31), ('insert', 2, ['request.mp3'])])
+		self.assertEqual(apply_operations(['playing.mp3'] + queue, operations),
+				['playing.mp3'] + requested_queue)
+
+	def test_move(self):
+		"""
+		Tests that a song that is already queued is moved, not added again
+		"""
+		queue = ['a', 'b', 'c', 'd', 'e']
+		self.assertEqual(queue_operations(queue, ['a', 'e', 'b', 'c', 'd']),
+				[('move', 5, 2)])
+
+	def test_operations(self):
+		"""
+		Tests that the operations turn one queue into the other for a mix
+		of repeats, inserts, deletes and moves
+		"""
+		for current_queue, desired_queue in (
+				([], ['a', 'b']),
+				(['a', 'b'], []),
+				(['a', 'b', 'a', 'c'], ['c', 'a', 'a', 'd', 'b']),
+				(['a', 'b', 'c', 'd'], ['d', 'c', 'b', 'a']),
+				(['x', 'a', 'y', 'b'], ['b', 'z', 'z', 'a', 'x'])):
+			operations = queue_operations(current_queue, desired_queue)
+			self.assertEqual(apply_operations(current_queue, operations), desired_queue)
+
+class CounterBufferTests(TestCase):
+	def test_buffered_counts(self):
+		"""
+		Tests that increments are held until the buffer is full and then
+		written with one UPDATE per field and amount
+		"""
+		songs = [Song.objects.create(title='Song %d' % song_count) for song_count in range(3)]
+		buffer = counters.CounterBuffer(flush_size=6, flush_seconds=60)
+		with self.assertNumQueries(0):
+			buffer.increment(songs[0].pk)
+			buffer.increment(songs[1].pk)
+			buffer.increment(songs[0].pk)
+			buffer.increment(songs[1].pk)
+			buffer.increment(songs[2].pk, 'favecount')
+		# Playcounts of songs 0 and 1 go up by 2 in one UPDATE
+		self.assertEqual(buffer.flush(), 2)
+		self.assertEqual([(song.playcount, song.favecount) for song in
+			Song.objects.order_by('pk')], [(2, 0), (2, 0), (0, 1)])
+		self.assertEqual(buffer.flush(), 0)
+		for increment in range(6):
+			buffer.increment(str(songs[2].pk))
+		self.assertEqual(buffer.pending, {})
+		self.assertEqual(Song.objects.get(pk=songs[2].pk).playcount, 6)
+		with self.assertRaises(FieldNotFoundError):
+			buffer.increment(songs[0].pk, 'title')
+
+	def test_failed_flush_keeps_counts(self):
+		"""
+		Tests that increments a failed flush took out go back in the buffer
+		"""
+		song = Song.objects.create(title='Song')
+		buffer = counters.CounterBuffer(flush_size=10, flush_seconds=60)
+		buffer.increment(song.pk)
+		buffer.increment(song.pk)
+		counters_song = counters.Song
+		class BrokenSong:
+			class objects:
+				@staticmethod
+				def filter(**kwargs):
+					raise DatabaseError('The database went away')
+		counters.Song = BrokenSong
+		try:
+			with self.assertRaises(DatabaseError):
+				buffer.flush()
+		finally:
+			counters.Song = counters_song
+		buffer.increment(song.pk)
+		self.assertEqual(buffer.flush(), 1)
+		self.assertEqual(Song.objects.get(pk=song.pk).playcount, 3)
+
+	def test_bursts_batched(self):
+		"""
+		Tests that a burst of favourites and plays through the public
+		functions is written with fewer UPDATEs than events, that pages show
+		the buffered favourites, and that rebuilding playcounts doesn't add
+		buffered plays twice
+		"""
+		songs = [Song.objects.create(title='Song %d' % song_count) for song_count in range(3)]
+		global_counters = counters._counters
+		counters._counters = counters.CounterBuffer(flush_seconds=60, timed=False)
+		try:
+			with self.assertNumQueries(0):
+				for song in songs:
+					Control.favourite_song(str(song.pk))
+					counters.count_play(song.pk)
+			self.assertEqual(Song.objects.get(pk=songs[0].pk).favecount, 0)
+			self.assertEqual(base_extra.favecount(songs[0]), 1)
+			# One UPDATE per field, six events
+			with CaptureQueriesContext(connection) as queries:
+				counters.flush_counters()
+			self.assertEqual(len([query for query in queries.captured_queries
+				if 'UPDATE ' in query['sql']]), 2)
+			self.assertEqual([(song.playcount, song.favecount) for song in
+				Song.objects.order_by('pk')], [(1, 1)] * 3)
+			song = songs[0]
+			Song.objects.filter(pk=song.pk).update(playcount=0)
+			PlayHistory.add_song(song.pk, timezone.now())
+			counters.count_play(song.pk)
+			Database.rebuild_playcounts()
+			self.assertEqual(Song.objects.get(pk=song.pk).playcount, 1)
+			counters.flush_counters()
+			self.assertEqual(Song.objects.get(pk=song.pk).playcount, 1)
+		finally:
+			counters._counters = global_counters
+
+	def test_timed_flush(self):
+		"""
+		Tests that the first increment into an empty buffer schedules a flush
+		flush_seconds later, and that flushing first cancels it
+		"""
+		buffer = counters.CounterBuffer(flush_seconds=0.05)
+		flushed = threading.Event()
+		buffer.flush = flushed.set
+		buffer.increment(1)
+		timer = buffer.flush_timer
+		buffer.increment(2)
+		self.assertIs(buffer.flush_timer, timer)
+		self.assertTrue(flushed.wait(5))
+		timer.join(5)
+		self.assertIsNone(buffer.flush_timer)
+		buffer = counters.CounterBuffer(flush_seconds=60)
+		buffer.increment(1)
+		timer = buffer.flush_timer
+		self.assertTrue(timer.is_alive())
+		buffer.pending = {}
+		counters.CounterBuffer.flush(buffer)
+		timer.join(5)
+		self.assertFalse(timer.is_alive())
+		self.assertIsNone(buffer.flush_timer)
+
+	def test_rebuild_playcounts(self):
+		"""
+		Tests that playcounts are rebuilt from PlayHistory
+		"""
+		songs = [Song.objects.create(title='Song %d' % song_count, playcount=9)
+				for song_count in range(3)]
+		for song in (songs[0], songs[1], songs[0]):
+			PlayHistory.add_song(song.pk, timezone.now())
+		self.assertEqual(Database.rebuild_playcounts(), 2)
+		self.assertEqual([song.playcount for song in Song.objects.order_by('pk')], [2, 1, 0])
+
+class PlayRollupTests(TestCase):
+	def setUp(self):
+		self.songs = [Song.objects.create(title='Song %d' % song_count)
+				for song_count in range(3)]
+		self.day = datetime.datetime(2014, 3, 10, tzinfo=timezone.utc)
+		rollups._last_rollup_hour = None
+
+	def play(self, song, hours, minutes=0):
+		PlayHistory.add_song(song.pk, self.day + datetime.timedelta(hours=hours, minutes=minutes))
+
+	def test_roll_up(self):
+		"""
+		Tests that complete hours are rolled up into hourly and daily buckets
+		and that the current hour is left for later
+		"""
+		self.play(self.songs[0], 1, 5)
+		self.play(self.songs[0], 1, 50)
+		self.play(self.songs[1], 2, 10)
+		self.play(self.songs[1], 3, 10)
+		self.assertEqual(rollups.roll_up(self.day + datetime.timedelta(hours=3, minutes=30)), 3)
+		self.assertEqual(rollups.song_plays(self.songs[0].pk, ROLLUP_HOUR),
+				[(self.day + datetime.timedelta(hours=1), 2)])
+		self.assertEqual(rollups.song_plays(self.songs[1].pk, ROLLUP_DAY), [(self.day, 1)])
+		self.assertEqual(rollups.rolled_up_through(),
+				PlayHistory.objects.get(played_time=self.day + datetime.timedelta(hours=2, minutes=10)).pk)
+		# Rolling up again in the same hour adds nothing
+		self.assertEqual(rollups.roll_up(self.day + datetime.timedelta(hours=3, minutes=40)), 0)
+		# The next hour is added to the same daily bucket
+		self.assertEqual(rollups.roll_up(self.day + datetime.timedelta(hours=5)), 1)
+		self.assertEqual(rollups.song_plays(self.songs[1].pk, ROLLUP_DAY), [(self.day, 2)])
+		self.assertEqual(PlayRollup.objects.filter(period=ROLLUP_DAY).count(), 2)
+
+	def test_roll_up_prunes(self):
+		"""
+		Tests that old raw plays are pruned only once rolled up, and that old
+		hourly rollups are pruned while daily ones are kept
+		"""
+		self.play(self.songs[0], 1)
+		self.play(self.songs[0], 2)
+		later = self.day + datetime.timedelta(days=rollups.HISTORY_RETENTION_DAYS, hours=1, minutes=30)
+		self.assertEqual(rollups.roll_up(later), 2)
+		self.assertEqual(PlayHistory.objects.count(), 1)
+		much_later = self.day + datetime.timedelta(days=rollups.HOURLY_ROLLUP_RETENTION_DAYS + 1)
+		rollups.roll_up(much_later)
+		self.assertEqual(PlayHistory.objects.count(), 0)
+		self.assertFalse(PlayRollup.objects.filter(period=ROLLUP_HOUR).exists())
+		self.assertEqual(rollups.song_plays(self.songs[0].pk, ROLLUP_DAY), [(self.day, 2)])
+
+	def test_late_plays(self):
+		"""
+		Tests that a play saved late into an hour that was rolled up already
+		is added, that plays of the current hour saved before it aren't
+		skipped, and that pruning every hourly rollup doesn't roll the
+		history up again
+		"""
+		self.play(self.songs[0], 1)
+		self.assertEqual(rollups.roll_up(self.day + datetime.timedelta(hours=2, minutes=30)), 1)
+		self.play(self.songs[0], 2, 40)
+		self.play(self.songs[0], 1, 30)
+		self.assertEqual(rollups.roll_up(self.day + datetime.timedelta(hours=2, minutes=50)), 0)
+		self.assertEqual(rollups.roll_up(self.day + datetime.timedelta(hours=3)), 2)
+		self.assertEqual(rollups.song_plays(self.songs[0].pk, ROLLUP_HOUR),
+				[(self.day + datetime.timedelta(hours=1), 2), (self.day + datetime.timedelta(hours=2), 1)])
+		PlayRollup.objects.filter(period=ROLLUP_HOUR).delete()
+		self.assertEqual(rollups.roll_up(self.day + datetime.timedelta(hours=4)), 0)
+		self.assertEqual(rollups.song_plays(self.songs[0].pk, ROLLUP_DAY), [(self.day, 3)])
+		self.assertEqual(rollups.total_plays(), {self.songs[0].pk: 3})
+
+	def test_roll_up_if_due(self):
+		"""
+		Tests that roll_up_if_due rolls up once per hour
+		"""
+		self.play(self.songs[0], 1)
+		self.assertEqual(rollups.roll_up_if_due(self.day + datetime.timedelta(hours=2)), 1)
+		self.play(self.songs[0], 1, 30)
+		self.assertEqual(rollups.roll_up_if_due(self.day + datetime.timedelta(hours=2, minutes=30)), 0)
+
+	def test_top_songs(self):
+		"""
+		Tests that top_songs sums the daily rollups of the last days
+		"""
+		for hours in (1, 2, 30):
+			self.play(self.songs[1], hours)
+		self.play(self.songs[2], 3)
+		self.play(self.songs[0], -50)
+		now = self.day + datetime.timedelta(days=2)
+		rollups.roll_up(now)
+		self.assertEqual(rollups.top_songs(7, now=now),
+				[(self.songs[1].pk, 3), (self.songs[0].pk, 1), (self.songs[2].pk, 1)])
+		self.assertEqual(rollups.top_songs(1, now=now), [])
+		self.assertEqual(rollups.top_songs(7, limit=1, now=now), [(self.songs[1].pk, 3)])
+
+	def test_total_plays(self):
+		"""
+		Tests that total_plays counts rolled up and raw plays
+		"""
+		self.play(self.songs[0], 1)
+		self.play(self.songs[1], 2)
+		rollups.roll_up(self.day + datetime.timedelta(hours=2))
+		self.play(self.songs[0], 2, 30)
+		self.assertEqual(rollups.total_plays(), {self.songs[0].pk: 2, self.songs[1].pk: 1})
+		Song.objects.update(playcount=9)
+		self.assertEqual(Database.rebuild_playcounts(), 2)
+		self.assertEqual([song.playcount for song in Song.objects.order_by('pk')], [2, 1, 0])
+
+def canned_mpd_client(responses):
+	"""
+	Returns an MPDClient attached to a socket whose other end greets it,
+	then answers each request with the next of responses, and the list
+	the requests it received are appended to
+	"""
+	client_sock, server_sock = socket.socketpair()
+	requests = []
+	def serve():
+		server_sock.sendall('OK MPD 0.19.0\n')
+		server_file = server_sock.makefile('rb')
+		for response in responses:
+			request = server_file.readline()
+			if request == 'command_list_ok_begin\n':
+				while not request.endswith('command_list_end\n'):
+					request += server_file.readline()
+			requests.append(request)
+			server_sock.sendall(response)
+		server_file.close()
+		server_sock.close()
+	server = threading.Thread(target=serve)
+	server.daemon = True
+	server.start()
+	client = mpd.MPDClient()
+	client.attach(client_sock)
+	return client, requests
+
+class MPDClientTests(TestCase):
+	def test_quote_arg(self):
+		"""
+		Tests that arguments are quoted with quotes and backslashes escaped
+		"""
+		self.assertEqual(mpd.quote_arg(3), '3')
+		self.assertEqual(mpd.quote_arg(u'a "b"\\c \u00e9.mp3'), '"a \\"b\\"\\\\c \xc3\xa9.mp3"')
+		self.assertEqual(mpd.command_line('move', (1, 2)), 'move 1 2\n')
+
+	def test_status(self):
+		"""
+		Tests that a status response is parsed into an MPDStatus
+		"""
+		client, requests = canned_mpd_client(['volume: -1\nrepeat: 1\nrandom: 0\n' + \
+				'playlistlength: 30\nstate: play\nsong: 2\nsongid: 7\n' + \
+				'time: 12:200\nelapsed: 12.5\nOK\n'])
+		self.assertEqual(client.version, '0.19.0')
+		status = client.status()
+		self.assertEqual(requests, ['status\n'])
+		self.assertEqual((status.state, status.volume, status.repeat, status.random),
+				('play', None, True, False))
+		self.assertEqual((status.playlist_length, status.song, status.song_id),
+				(30, 2, 7))
+		self.assertEqual((status.elapsed, status.duration), (12.5, 200.0))
+		self.assertFalse(status.is_stopped())
+
+	def test_execute_list(self):
+		"""
+		Tests that a command list is sent in one request and its responses
+		are split per command, songs included
+		"""
+		client, requests = canned_mpd_client([
+				'list_OK\nfile: a.mp3\nTitle: A\nArtist: X\nPos: 0\nId: 1\n' + \
+				'file: b.mp3\nPos: 1\nId: 2\nlist_OK\nOK\n',
+				'ACK [50@0] {play} No such song\n'])
+		add_response, queue_response = client.execute_list([('add', u'b.mp3'), ('playlistinfo',)])
+		self.assertEqual(requests[0], 'command_list_ok_begin\nadd "b.mp3"\n' + \
+				'playlistinfo\ncommand_list_end\n')
+		self.assertEqual(add_response, [])
+		songs = mpd.split_songs(queue_response)
+		self.assertEqual([(song.file, song.position, song.id) for song in songs],
+				[(u'a.mp3', 0, 1), (u'b.mp3', 1, 2)])
+		self.assertEqual([song.display_name() for song in songs], [u'X - A', u'b.mp3'])
+		with self.assertRaises(MPDCommandError):
+			client.execute('play', 99)
+		self.assertTrue(client.connected())
+		# The server has closed its end
+		with self.assertRaises(MPDConnectionError):
+			client.read_line()
+		self.assertFalse(client.connected())
+
+	def test_reconnect(self):
+		"""
+		Tests that a read-only command is sent again on a new connection
+		when the old one dropped, but a command that changes MPD isn't
+		"""
+		with FakeMPDServer() as fake:
+			client = fake.client()
+			client.execute('ping')
+			with fake.lock:
+				for session in list(fake.sessions):
+					session.disconnect()
+			self.assertEqual(client.status().state, 'stop')
+		# The server reads the add and closes without answering
+		client, requests = canned_mpd_client([''])
+		connects = []
+		client.connect = lambda: connects.append(True)
+		with self.assertRaises(MPDConnectionError):
+			client.execute('add', u'a.mp3')
+		self.assertEqual(requests, ['add "a.mp3"\n'])
+		self.assertEqual(connects, [])
+
+	def test_fake_argument_count(self):
+		"""
+		Tests that the fake MPD answers a wrong number of arguments with an
+		ACK, and doesn't mistake a TypeError of a command for one
+		"""
+		with FakeMPDServer() as fake:
+			client = fake.client()
+			with self.assertRaises(MPDCommandError):
+				client.execute('ping', 1)
+			with self.assertRaises(AckError):
+				fake.execute('ping', [1])
+			def broken_ping():
+				raise TypeError('Not an argument count')
+			fake.command_ping = broken_ping
+			with self.assertRaises(TypeError):
+				fake.execute('ping', [])
+
+	def test_pool(self):
+		"""
+		Tests that the pool hands back idle clients and drops clients whose
+		connection broke
+		"""
+		created = []
+		def client_factory():
+			created.append(mpd.MPDClient())
+			return created[-1]
+		pool = mpd.MPDConnectionPool(2, client_factory)
+		with pool.connection() as first_client:
+			with pool.connection() as second_client:
+				self.assertNotEqual(first_client, second_client)
+		with pool.connection() as client:
+			self.assertTrue(client in created)
+		with self.assertRaises(MPDConnectionError):
+			with pool.connection() as client:
+				raise MPDConnectionError('Test')
+		with pool.connection() as first_client:
+			with pool.connection() as second_client:
+				pass
+		self.assertEqual(len(created), 3)
+
+class ScriptedMPDClient:
+	"""
+	Stands in for an MPDClient: idle returns the next of changes and status
+	the next of statuses
+	"""
+	def __init__(self, changes, statuses):
+		self.changes = list(changes)
+		self.statuses = [mpd.MPDStatus(pairs) for pairs in statuses]
+
+	def idle(self, *subsystems):
+		return self.changes.pop(0)
+
+	def status(self):
+		return self.statuses.pop(0)
+
+	def close(self):
+		pass
+
+class StreamDaemonTests(TestCase):
+	def test_latency_metric(self):
+		"""
+		Tests that the latency metric keeps count, mean, max and percentiles
+		"""
+		metric = stream.LatencyMetric(window=10)
+		self.assertEqual(metric.snapshot()['mean'], None)
+		for sample in range(20):
+			metric.observe(sample / 10.0)
+		snapshot = metric.snapshot()
+		self.assertEqual((snapshot['count'], snapshot['max']), (20, 1.9))
+		self.assertAlmostEqual(snapshot['mean'], 0.95)
+		self.assertEqual((snapshot['p50'], snapshot['p95']), (1.5, 1.9))
+
+	def test_wait(self):
+		"""
+		Tests that only song changes are handed on as player events, and
+		that waiting ends once MPD stops
+		"""
+		client = ScriptedMPDClient(
+				[['player'], ['player', 'playlist'], ['mixer'], ['player']],
+				[[('state', 'pause'), ('songid', '1')],
+					[('state', 'play'), ('songid', '2')],
+					[('state', 'stop'), ('songid', '2')]])
+		daemon = stream.StreamDaemon(client=client)
+		daemon.song_id = 1
+		self.assertTrue(daemon.wait())
+		self.assertTrue(daemon.events.empty())
+		self.assertTrue(daemon.wait())
+		self.assertEqual([daemon.events.get()[0], daemon.events.get()[0]],
+				['player', 'playlist'])
+		self.assertEqual(daemon.song_id, 2)
+		self.assertTrue(daemon.wait())
+		self.assertTrue(daemon.events.empty())
+		self.assertFalse(daemon.wait())
+		self.assertTrue(daemon.events.empty())
+
+	def test_write_metrics(self):
+		"""
+		Tests that the metrics are written as JSON to the metrics file
+		"""
+		temp_dir = tempfile.mkdtemp()
+		try:
+			metrics_path = os.path.join(temp_dir, 'metrics.json')
+			daemon = stream.StreamDaemon(client=ScriptedMPDClient([], []),
+					metrics_file=metrics_path)
+			daemon.refill_latency.observe(0.25)
+			daemon.write_metrics()
+			with open(metrics_path) as metrics_file:
+				metrics = json.load(metrics_file)
+			self.assertEqual(metrics['refill_latency_seconds']['count'], 1)
+			self.assertEqual(metrics['refill_latency_seconds']['max'], 0.25)
+			self.assertEqual(metrics['prefetch']['hits'], 0)
+		finally:
+			shutil.rmtree(temp_dir)
+
+class PrefetcherTests(TestCase):
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		for file_name, size in (('a.mp3', 10000), ('b.mp3', 100), ('c.mp3', 5000)):
+			with open(os.path.join(self.root, file_name), 'wb') as song_file:
+				song_file.write('\0' * size)
+		self.prefetcher = prefetch.Prefetcher(self.root, byte_count=8192, song_count=2)
+
+	def tearDown(self):
+		shutil.rmtree(self.root)
+		prefetch._fadvise = None
+
+	def test_prefetch(self):
+		"""
+		Tests that files are prefetched up to byte_count bytes once each, and
+		that every probe is counted as a hit or a miss
+		"""
+		self.assertEqual(self.prefetcher.prefetch(['a.mp3', 'b.mp3', 'missing.mp3']), 2)
+		self.assertEqual(self.prefetcher.prefetched_bytes, 8192 + 100)
+		self.assertEqual(self.prefetcher.hits + self.prefetcher.misses, 2)
+		self.assertEqual(self.prefetcher.probe_latency.snapshot()['count'], 2)
+		self.assertEqual(self.prefetcher.prefetch(['b.mp3', 'c.mp3']), 1)
+
+	def test_prefetch_without_fadvise(self):
+		"""
+		Tests that files are read through where posix_fadvise is missing
+		"""
+		prefetch._fadvise = False
+		self.assertEqual(prefetch.get_fadvise(), None)
+		self.assertEqual(self.prefetcher.prefetch(['a.mp3']), 1)
+		self.assertEqual(self.prefetcher.prefetched_bytes, 8192)
+
+	def test_submit(self):
+		"""
+		Tests that submitted paths are prefetched on the prefetcher's thread,
+		only the first song_count of them
+		"""
+		self.prefetcher.start()
+		self.prefetcher.submit(['c.mp3', 'b.mp3', 'a.mp3'])
+		self.prefetcher.stop()
+		self.assertEqual(list(self.prefetcher.recent), ['c.mp3', 'b.mp3'])
+		self.assertEqual(self.prefetcher.prefetched_bytes, 5100)
+
+class ExiftoolPoolTests(TestCase):
+	def setUp(self):
+		self.pool = ExiftoolPool(2)
+
+	def tearDown(self):
+		self.pool.close()
+
+	def test_execute(self):
+		"""
+		Tests that commands sent to the pool return exiftool's output
+		without the {ready} sentinel
+		"""
+		version = self.pool.execute('-ver')
+		self.assertEqual(version, self.pool.execute('-ver'))
+		self.assertFalse('{ready' in version)
+		self.assertTrue(version.strip())
+
+	def test_execute_restarts_crashed_worker(self):
+		"""
+		Tests that a worker that died is restarted and the command is retried
+		"""
+		for worker in self.pool.workers:
+			worker.proc.kill()
+			worker.proc.wait()
+		self.assertTrue(self.pool.execute('-ver').strip())
+
+	def test_close(self):
+		"""
+		Tests that closing the pool stops every worker
+		"""
+		self.pool.close()
+		for worker in self.pool.workers:
+			self.assertFalse(worker.is_alive())
+		with self.assertRaises(ExiftoolError):
+			self.pool.execute('-ver')
+
+	def test_read_metadata(self):
+		"""
+		Tests that several files are read with one command into structured
+		metadata and that missing files are left out
+		"""
+		music_root = tempfile.mkdtemp()
+		try:
+			song_path = os.path.join(music_root, 'test.mp3')
+			write_test_mp3(song_path, title=u'Test_Title', trackno=u'3/12')
+			missing_path = os.path.join(music_root, 'missing.mp3')
+			metadata = read_metadata([song_path, missing_path])
+			self.assertEqual(metadata.keys(), [song_path])
+			self.assertEqual(metadata[song_path]['FileType'], 'MP3')
+			self.assertEqual(metadata[song_path]['Title'], 'Test_Title')
+			self.assertEqual(metadata[song_path]['Track'], '3/12')
+			self.assertTrue(isinstance(metadata[song_path]['Duration'], float))
+		finally:
+			shutil.rmtree(music_root)
+
+class TagReaderTests(TestCase):
+	def setUp(self):
+		self.music_root = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.music_root)
+
+	def test_read_tags_mp3(self):
+		"""
+		Tests reading ID3v2 frames and the CBR duration of an MP3, matching
+		what exiftool reports
+		"""
+		song_path = os.path.join(self.music_root, 'test.mp3')
+		write_test_mp3(song_path, frame_count=2000, title=u'Test_Title',
+				artist=u'Test_Artist', genre=u'(13)', trackno=u'3/12')
+		tags = tagreader.read_tags(song_path)
+		self.assertEqual(tags['FileType'], 'MP3')
+		self.assertEqual(tags['Title'], 'Test_Title')
+		self.assertEqual(tags['Artist'], 'Test_Artist')
+		self.assertEqual(tags['Genre'], 'Pop')
+		self.assertEqual(tags['Track'], '3/12')
+		self.assertAlmostEqual(tags['Duration'],
+				read_metadata([song_path])[song_path]['Duration'])
+
+	def test_read_tags_id3v1(self):
+		"""
+		Tests falling back to the ID3v1 tag when there is no ID3v2 tag
+		"""
+		song_path = os.path.join(self.music_root, 'test.mp3')
+		with open(song_path, 'wb') as mp3_file:
+			mp3_file.write(('\xff\xfb\x90\x64' + '\x00' * 413) * 100)
+			mp3_file.write('TAG' + 'V1 Title'.ljust(30, '\x00') + 'V1 Artist'.ljust(30, '\x00') + \
+					'V1 Album'.ljust(30, '\x00') + '1999' + '\x00' * 29 + '\x07' + '\x11')
+		tags = tagreader.read_tags(song_path)
+		self.assertEqual(tags['Title'], 'V1 Title')
+		self.assertEqual(tags['Year'], '1999')
+		self.assertEqual(tags['Track'], '7')
+		self.assertEqual(tags['Genre'], 'Rock')
+		self.assertAlmostEqual(tags['Duration'], 100 * 417 * 8 / 128000.0)
+
+	def test_read_tags_flac(self):
+		"""
+		Tests reading STREAMINFO, Vorbis comments and PICTURE from a FLAC
+		"""
+		song_path = os.path.join(self.music_root, 'test.flac')
+		write_test_flac(song_path, seconds=125, picture='\xff\xd8jpeg',
+				title=u'Test_Title', date=u'2010-05-01', tracknumber=u'4')
+		tags = tagreader.read_tags(song_path)
+		self.assertEqual(tags['FileType'], 'FLAC')
+		self.assertEqual(tags['Title'], 'Test_Title')
+		self.assertEqual(tags['Year'], '2010')
+		self.assertEqual(tags['Track'], '4')
+		self.assertEqual(tags['Duration'], 125.0)
+		self.assertEqual(tags['PictureMIMEType'], 'image/jpeg')
+		self.assertEqual(tags['Picture'], '\xff\xd8jpeg')
+
+	def test_read_tags_ogg(self):
+		"""
+		Tests reading Vorbis comments and the duration of an Ogg Vorbis file
+		"""
+		song_path = os.path.join(self.music_root, 'test.ogg')
+		write_test_ogg(song_path, seconds=200, title=u'Test_Title', artist=u'Test_Artist')
+		tags = tagreader.read_tags(song_path)
+		self.assertEqual(tags['FileType'], 'OGG')
+		self.assertEqual(tags['Artist'], 'Test_Artist')
+		self.assertEqual(tags['Duration'], 200.0)
+
+	def test_read_metadata_falls_back_to_exiftool(self):
+		"""
+		Tests that files the tag reader can't parse are handed to exiftool
+		and that missing files are left out
+		"""
+		song_path = os.path.join(self.music_root, 'test.mp3')
+		with open(song_path, 'w') as not_a_song:
+			not_a_song.write('not a song')
+		with self.assertRaises(TagReadError):
+			tagreader.read_tags(song_path)
+		missing_path = os.path.join(self.music_root, 'missing.mp3')
+		metadata = tagreader.read_metadata([song_path, missing_path])
+		self.assertEqual(metadata.keys(), [song_path])
+		self.assertFalse('Duration' in metadata[song_path])
+
+class AlbumArtWriterTests(TestCase):
+	def setUp(self):
+		self.static_root = tempfile.mkdtemp()
+		self.music_root = tempfile.mkdtemp()
+		self.writer = albumart._writer
+		albumart._writer = albumart.AlbumArtWriter(self.static_root)
+		self.mpd_db_root = afkradio.models.MPD_DB_ROOT
+		afkradio.models.MPD_DB_ROOT = self.music_root
+
+	def tearDown(self):
+		albumart._writer = self.writer
+		afkradio.models.MPD_DB_ROOT = self.mpd_db_root
+		shutil.rmtree(self.static_root)
+		shutil.rmtree(self.music_root)
+
+	def test_shared_album_art(self):
+		"""
+		Tests that the tracks of an album share one art file named after
+		its contents and that songs without art get no artpath
+		"""
+		for track in range(3):
+			write_test_flac(os.path.join(self.music_root, 'track%d.flac' % track),
+					picture='\xff\xd8cover', title=u'Track %d' % track)
+		write_test_flac(os.path.join(self.music_root, 'no_art.flac'), title=u'No Art')
+		LibraryScanner(self.music_root, workers=2).scan()
+		artpaths = set(Song.objects.exclude(title='No Art').values_list('artpath', flat=True))
+		self.assertEqual(len(artpaths), 1)
+		artpath = artpaths.pop()
+		self.assertTrue(artpath.endswith('.jpg'))
+		self.assertEqual(Song.objects.get(title='No Art').artpath, '')
+		art_dir = os.path.join(self.static_root, 'afkradio/album_art')
+		self.assertEqual(os.listdir(art_dir), [os.path.basename(artpath)])
+		with open(os.path.join(art_dir, os.path.basename(artpath)), 'rb') as art_file:
+			self.assertEqual(art_file.read(), '\xff\xd8cover')
+
 class ModelSetlistMethodTests(TestCase):
 	def test_add_setlist(self):
 		"""
@@ -172,20 +1225,20 @@ class ModelPlaylistMethodTests(TestCase):
 		Playlist.add_song('1')
 		Playlist.add_song('2')
 		Playlist.add_song('3')
-		self.assertEqual(Playlist.objects.current_song().song_id, '1')
+		self.assertEqual(Playlist.objects.current_song().song_id, 1)
 
 	def test_current_song_only_user_requested(self):
 		Playlist.add_song('1', True)
 		Playlist.add_song('2', True)
 		Playlist.add_song('3', True)
-		self.assertEqual(Playlist.objects.current_song().song_id, '1')
+		self.assertEqual(Playlist.objects.current_song().song_id, 1)
 
 	def test_current_song_both_non_requested_and_one_requested(self):
 		Playlist.add_song('1')
 		Playlist.add_song('2')
 		Playlist.add_song('3')
 		Playlist.add_song('4', True)
-		self.assertEqual(Playlist.objects.current_song().song_id, '4')
+		self.assertEqual(Playlist.objects.current_song().song_id, 4)
 
 	def test_current_song_both_non_requested_and_requested(self):
 		Playlist.add_song('1')
@@ -194,26 +1247,26 @@ class ModelPlaylistMethodTests(TestCase):
 		Playlist.add_song('4', True)
 		Playlist.add_song('5', True)
 		Playlist.add_song('6', True)
-		self.assertEqual(Playlist.objects.current_song().song_id, '4')
+		self.assertEqual(Playlist.objects.current_song().song_id, 4)
 
 	def test_next_song_no_user_requested(self):
 		Playlist.add_song('1')
 		Playlist.add_song('2')
 		Playlist.add_song('3')
-		self.assertEqual(Playlist.objects.next_song().song_id, '2')
+		self.assertEqual(Playlist.objects.next_song().song_id, 2)
 
 	def test_next_song_only_user_requested(self):
 		Playlist.add_song('1', True)
 		Playlist.add_song('2', True)
 		Playlist.add_song('3', True)
-		self.assertEqual(Playlist.objects.next_song().song_id, '2')
+		self.assertEqual(Playlist.objects.next_song().song_id, 2)
 
 	def test_next_song_both_non_requested_and_one_requested(self):
 		Playlist.add_song('1')
 		Playlist.add_song('2')
 		Playlist.add_song('3')
 		Playlist.add_song('4', True)
-		self.assertEqual(Playlist.objects.next_song().song_id, '1')
+		self.assertEqual(Playlist.objects.next_song().song_id, 1)
 
 	def test_next_song_both_non_requested_and_requested(self):
 		Playlist.add_song('1')
@@ -222,33 +1275,176 @@ class ModelPlaylistMethodTests(TestCase):
 		Playlist.add_song('4', True)
 		Playlist.add_song('5', True)
 		Playlist.add_song('6', True)
-		self.assertEqual(Playlist.objects.next_song().song_id, '5')
+		self.assertEqual(Playlist.objects.next_song().song_id, 5)
 
-# class UtilPlaybackMethodTests(TestCase):
-# 	def test_mpc_play(self):
-# 		"""
-# 		Test is mpc_play that plays a song in MPC works.
-# 		"""
-# 		Playback.mpc_play()
-# 
-# 	def test_mpc_stop(self):
-# 		"""
-# 		Test is mpc_stop that stops MPC works.
-# 		"""
-# 		Playback.mpc_stop()
-# 	def test_mpc_play_from_song_added_to_Songs(self):
-# 		"""
-# 		Clears the current playlist, adds test song /MPD_ROOT/Test Path/test.mp3
-# 		to models.Songs, adds the song to mpc, then plays it
-# 		"""
-# 		Songs.add_song_exiftool("Test Path/test.mp3")
-# 		test_song = Songs.objects.get(id=1)
-# 		Playback.mpc_clear()
-# 		Playback.mpc_add(test_song.filepath)
-# 		Playback.mpc_play()
-#		time.sleep(2)
-#		currently_playing = mpc_currently_playing()
-#		self.assertTrue(currently_playing, 'Test_Artist - Test_Title')
+	def test_request_positions(self):
+		"""
+		Tests that requests go after the other requests and before the
+		unrequested songs, and that running out of room renumbers the queue
+		"""
+		Playlist.add_songs(['1', '2', '3'])
+		for request_count in range(40):
+			Playlist.add_song(100 + request_count, True)
+		self.assertEqual(list(Playlist.objects.queue_sorted_song_id()),
+				[100 + request_count for request_count in range(40)] + [1, 2, 3])
+		self.assertEqual(Playlist.objects.last_song().song_id, 3)
+		Playlist.add_song('4')
+		self.assertEqual(Playlist.objects.last_song().song_id, 4)
+		self.assertEqual(Playlist.objects.next_song().song_id, 101)
+
+	def test_fill_playlist_positions(self):
+		"""
+		Tests that the queue of an old database keeps its order
+		"""
+		for song_id, requested in (('1', False), ('2', True), ('3', False), ('4', True)):
+			Playlist.objects.create(song_id=song_id, add_time=timezone.now(),
+					user_requested=requested)
+		self.assertEqual(Database.fill_playlist_positions(), 4)
+		self.assertEqual(list(Playlist.objects.queue_sorted_song_id()), [2, 4, 1, 3])
+
+	def test_add_songs(self):
+		"""
+		Tests that songs added in one batch keep their order in the queue
+		"""
+		Playlist.add_song('1')
+		Playlist.add_songs([5, 3, 5, 4])
+		self.assertEqual(list(Playlist.objects.queue_sorted_song_id()), [1, 5, 3, 5, 4])
+
+	def test_random_batch(self):
+		"""
+		Tests that a random batch has no repeats when there are enough
+		songs, only has active setlist songs when asked and fetches them
+		in one query
+		"""
+		songs = [Song.objects.create(title='Song %d' % song_count, artist='Artist %d' % song_count)
+				for song_count in range(6)]
+		Song.objects.get_random_batch(1)
+		with self.assertNumQueries(1):
+			random_songs = Song.objects.get_random_batch(6)
+		self.assertEqual(set(random_songs), set(songs))
+		self.assertEqual(len(Song.objects.get_random_batch(10)), 10)
+		self.assertEqual(Song.objects.get_random_batch_from_active_setlists(3), [])
+		Setlist.add_setlist('batch')
+		setlist = Setlist.objects.get(setlist='batch')
+		setlist.associated_songs.add(songs[0], songs[1])
+		Setlist.objects.activate_setlist('batch')
+		random_songs = Song.objects.get_random_batch_from_active_setlists(2)
+		self.assertEqual(set(random_songs), set(songs[:2]))
+		engine = scheduler.WeightedEngine(song_history_size=2, artist_history_size=0)
+		random_songs = Song.objects.get_random_batch(4, engine)
+		for index in range(1, 4):
+			self.assertNotEqual(random_songs[index], random_songs[index - 1])
+
+	def test_queue_duration(self):
+		"""
+		Tests that queue durations are added up from duration_secs, with
+		songs that have no duration counting as 0
+		"""
+		long_song = Song.objects.create(title='Long', duration='10:02:03',
+				duration_secs=36123)
+		short_song = Song.objects.create(title='Short', duration='0:03:30',
+				duration_secs=210)
+		unknown_song = Song.objects.create(title='Unknown')
+		Playlist.add_song(long_song.pk)
+		Playlist.add_song(short_song.pk)
+		Playlist.add_song(short_song.pk, True)
+		Playlist.add_song(unknown_song.pk)
+		self.assertEqual(Playlist.objects.song_durations(), {
+			long_song.pk : 36123,
+			short_song.pk : 210,
+			unknown_song.pk : 0,
+			})
+		with self.assertNumQueries(1):
+			for playlist_song in Playlist.objects.queue_sorted():
+				playlist_song.song_title()
+				playlist_song.song_duration_secs()
+		self.assertEqual(Playlist.objects.queue_duration(), 36543)
+
+	def test_timetable(self):
+		"""
+		Tests that the playlist timetable adds each song's duration to the
+		time the last song started, including songs of 10 hours or more
+		"""
+		long_song = Song.objects.create(title='Long', duration_secs=36123)
+		short_song = Song.objects.create(title='Short', duration_secs=210)
+		PlayHistory.add_song(short_song.pk,
+				timezone.make_aware(datetime.datetime(2014, 1, 1, 12, 0), timezone.utc))
+		Playlist.add_song(long_song.pk)
+		Playlist.add_song(short_song.pk)
+		node = PlaylistContentNode(2, 'playlist')
+		self.assertEqual(node.create_timetable(list(Playlist.objects.queue_sorted())),
+				['22:02', '22:05'])
+
+def playlist_paths():
+	return list(Playlist.objects.order_by('position').values_list('song__filepath', flat=True))
+
+class UtilPlaybackMethodTests(TestCase):
+	def setUp(self):
+		self.fake = FakeMPDServer(tags={'a.mp3': {'Artist': 'Test_Artist', 'Title': 'Test_Title'}})
+		self.fake.start()
+		self.installed = self.fake.installed()
+		self.installed.__enter__()
+
+	def tearDown(self):
+		self.installed.__exit__(None, None, None)
+		self.fake.close()
+
+	def test_mpc_play_stop(self):
+		"""
+		Tests that songs added with mpc_add play, and that
+		mpc_currently_playing shows them like mpc does
+		"""
+		self.assertEqual(Playback.mpc_currently_playing(), 'No song is currently playing')
+		Playback.mpc_add('a.mp3')
+		Playback.mpc_add_many(['b.mp3', 'c.mp3'])
+		self.assertEqual(Playback.mpc_queue(), ['a.mp3', 'b.mp3', 'c.mp3'])
+		Playback.mpc_play()
+		self.assertEqual(Playback.mpc_status().state, 'play')
+		self.assertEqual(Playback.mpc_currently_playing(), 'Test_Artist - Test_Title')
+		self.fake.advance()
+		self.assertEqual(Playback.mpc_currently_playing(), 'b.mp3')
+		Playback.mpc_stop()
+		self.assertTrue(Playback.mpc_status().is_stopped())
+		Playback.mpc_clear()
+		self.assertEqual(Playback.mpc_queue(), [])
+
+	def test_mpc_insert_many_move_delete(self):
+		"""
+		Tests inserting, moving and deleting songs by 1-based position
+		"""
+		Playback.mpc_add_many(['a.mp3', 'b.mp3'])
+		Playback.mpc_insert_many(['c.mp3', 'd.mp3'], 2, 2)
+		self.assertEqual(self.fake.queue_paths(), ['a.mp3', 'c.mp3', 'd.mp3', 'b.mp3'])
+		Playback.mpc_insert_many(['e.mp3'], 5, 4)
+		Playback.mpc_move(1, 5)
+		self.assertEqual(self.fake.queue_paths(), ['c.mp3', 'd.mp3', 'b.mp3', 'e.mp3', 'a.mp3'])
+		Playback.mpc_delete(2)
+		Playback.mpc_delete(1, 2)
+		self.assertEqual(self.fake.queue_paths(), ['e.mp3', 'a.mp3'])
+
+	def test_mpc_reconcile(self):
+		"""
+		Tests that mpc_reconcile brings the queue in line in one command list
+		"""
+		Playback.mpc_add_many(['a.mp3', 'b.mp3', 'c.mp3', 'd.mp3'])
+		commands_before = dict(self.fake.command_counts)
+		Playback.mpc_reconcile(['c.mp3', 'e.mp3', 'b.mp3', 'f.mp3'], start=2)
+		self.assertEqual(self.fake.queue_paths(), ['a.mp3', 'c.mp3', 'e.mp3', 'b.mp3', 'f.mp3'])
+		self.assertEqual(self.fake.command_counts['playlistinfo'],
+				commands_before.get('playlistinfo', 0) + 1)
+
+	def test_mpc_crop(self):
+		"""
+		Tests that mpc_crop leaves only the song that is playing
+		"""
+		Playback.mpc_add_many(['a.mp3', 'b.mp3', 'c.mp3', 'd.mp3'])
+		Playback.mpc_crop()
+		self.assertEqual(len(self.fake.queue_paths()), 4)
+		Playback.mpc_play()
+		self.fake.advance()
+		Playback.mpc_crop()
+		self.assertEqual(self.fake.queue_paths(), ['b.mp3'])
+		self.assertEqual(Playback.mpc_status().state, 'play')
 
 class UtilDatabaseMethodTests(TestCase):
 	def test_update_song_db(self):
@@ -264,6 +1460,36 @@ class UtilDatabaseMethodTests(TestCase):
 		self.assertEqual(Song.objects.count(), first_update_songs_count)
 
 
+	def test_fill_duration_secs(self):
+		"""
+		Tests that duration_secs is filled from the H:MM:SS duration of
+		existing songs, including durations of 10 hours or more
+		"""
+		Song.objects.create(title='Long', duration='10:02:03')
+		Song.objects.create(title='Short', duration='0:03:30')
+		Song.objects.create(title='Also short', duration='0:03:30')
+		Song.objects.create(title='Unknown', duration='')
+		Song.objects.create(title='Done', duration='0:01:00', duration_secs=61)
+		self.assertEqual(Database.fill_duration_secs(), 3)
+		self.assertEqual(Song.objects.get(title='Long').duration_secs, 36123)
+		self.assertEqual(Song.objects.get(title='Also short').duration_secs, 210)
+		self.assertEqual(Song.objects.get(title='Unknown').duration_secs, None)
+		self.assertEqual(Song.objects.get(title='Done').duration_secs, 61)
+		self.assertEqual(Database.fill_duration_secs(), 0)
+
+	def test_remove_orphaned_song_rows(self):
+		"""
+		Tests that queue and history rows of songs that don't exist are
+		removed and the others are kept
+		"""
+		song = Song.objects.create(title='Exists')
+		Playlist.add_song(song.pk)
+		Playlist.add_song(song.pk + 1)
+		PlayHistory.add_song(song.pk + 2, timezone.now())
+		self.assertEqual(Database.remove_orphaned_song_rows(), 2)
+		self.assertEqual(list(Playlist.objects.queue_sorted_song_id()), [song.pk])
+		self.assertEqual(PlayHistory.objects.count(), 0)
+
 	def test_associate_setlist_to_song(self):
 		Setlist.add_setlist('test_setlist')
 		test_setlist = Setlist.objects.get(setlist='test_setlist')
@@ -374,7 +1600,443 @@ class UtilDatabaseMethodTests(TestCase):
 		self.assertQuerysetEqual(
 			list(Song.objects.get(title='Test_Title').setlist_set.all()), [])
 
-# class UtilControlMethodTests(TestCase):
+class LibraryScannerTests(TestCase):
+	def setUp(self):
+		self.music_root = tempfile.mkdtemp()
+		self.mpd_db_root = afkradio.models.MPD_DB_ROOT
+		afkradio.models.MPD_DB_ROOT = self.music_root
+		for song_count in range(5):
+			write_test_mp3(
+					os.path.join(self.music_root, 'album', 'song%d.mp3' % song_count),
+					frame_count=400 + song_count,
+					title=u'Title %d' % song_count, artist=u'Artist',
+					trackno=u'%d/5' % (song_count + 1))
+		with open(os.path.join(self.music_root, 'album', 'cover.jpg'), 'wb') as cover:
+			cover.write('not a song')
+
+	def tearDown(self):
+		afkradio.models.MPD_DB_ROOT = self.mpd_db_root
+		shutil.rmtree(self.music_root)
+
+	def test_scan(self):
+		"""
+		Tests that a scan adds every supported file in batches and reports
+		files that are already in the database as duplicates
+		"""
+		dupe_list = LibraryScanner(self.music_root, workers=2, batch_size=2).scan()
+		self.assertEqual(dupe_list, [])
+		self.assertEqual(Song.objects.count(), 5)
+		song = Song.objects.get(filepath='album/song3.mp3')
+		self.assertEqual(song.title, 'Title 3')
+		self.assertEqual(song.trackno, 4)
+		self.assertEqual(song.duration_secs, 10)
+		dupe_list = LibraryScanner(self.music_root, workers=2).scan()
+		self.assertEqual(len(dupe_list), 5)
+		self.assertEqual(Song.objects.count(), 5)
+
+	def test_update_songs(self):
+		"""
+		Tests that update_songs writes every song's own values, over more
+		songs than fit in one UPDATE
+		"""
+		songs = [Song.objects.create(title='Old %d' % song_count, trackno=song_count,
+				filepath='Test Path/%d.mp3' % song_count) for song_count in range(101)]
+		untouched_song = songs.pop()
+		for song in songs:
+			song.title = u'New %d ä' % song.pk
+			song.duration_secs = song.pk
+			# Untagged: every value in the CASE is NULL
+			song.trackno = None
+		afkradio.scanner.update_songs(songs, ('title', 'duration_secs', 'trackno'))
+		for song in Song.objects.exclude(pk=untouched_song.pk):
+			self.assertEqual(song.title, u'New %d ä' % song.pk)
+			self.assertEqual(song.duration_secs, song.pk)
+			self.assertEqual(song.trackno, None)
+		self.assertEqual(Song.objects.get(pk=untouched_song.pk).title, 'Old 100')
+
+	def test_rescan_only_reads_changed_files(self):
+		"""
+		Tests that a rescan updates changed songs in place, leaves unchanged
+		ones alone and marks songs whose file is gone as removed
+		"""
+		LibraryScanner(self.music_root, workers=2).scan()
+		changed_song = Song.objects.get(filepath='album/song1.mp3')
+		changed_song.playcount = 7
+		changed_song.save()
+		write_test_mp3(os.path.join(self.music_root, 'album', 'song1.mp3'),
+				frame_count=500, title=u'New Title')
+		os.remove(os.path.join(self.music_root, 'album', 'song2.mp3'))
+		scanner = LibraryScanner(self.music_root, workers=2)
+		dupe_list = scanner.scan()
+		self.assertEqual(len(dupe_list), 3)
+		self.assertEqual((scanner.added_count, scanner.updated_count,
+			scanner.removed_count), (0, 1, 1))
+		changed_song = Song.objects.get(pk=changed_song.pk)
+		self.assertEqual(changed_song.title, 'New Title')
+		self.assertEqual(changed_song.playcount, 7)
+		self.assertTrue(Song.objects.get(filepath='album/song2.mp3').removed)
+		self.assertEqual(Song.objects.available().count(), 4)
+
+	def test_rescan_moved_files(self):
+		"""
+		Tests that a moved and retagged file keeps its song (and counters)
+		instead of being added again
+		"""
+		LibraryScanner(self.music_root, workers=2).scan()
+		moved_song = Song.objects.get(filepath='album/song1.mp3')
+		moved_song.playcount = 3
+		moved_song.save()
+		os.makedirs(os.path.join(self.music_root, 'moved'))
+		os.rename(os.path.join(self.music_root, 'album', 'song1.mp3'),
+				os.path.join(self.music_root, 'moved', 'renamed.mp3'))
+		os.remove(os.path.join(self.music_root, 'album', 'song2.mp3'))
+		scanner = LibraryScanner(self.music_root, workers=2)
+		scanner.scan()
+		self.assertEqual((scanner.added_count, scanner.moved_count,
+			scanner.removed_count), (0, 1, 1))
+		moved_song = Song.objects.get(pk=moved_song.pk)
+		self.assertEqual(moved_song.filepath, 'moved/renamed.mp3')
+		self.assertEqual(moved_song.title, 'Title 1')
+		self.assertEqual(moved_song.playcount, 3)
+		self.assertFalse(moved_song.removed)
+		self.assertEqual(Song.objects.count(), 5)
+
+	def test_new_files_fingerprinted_once(self):
+		"""
+		Tests that the audio of a new file is hashed once, when there are
+		missing songs it could be a move of and when there are none
+		"""
+		LibraryScanner(self.music_root, workers=2).scan()
+		fingerprinted_paths = []
+		def counting_fingerprint(abs_song_path, fingerprint=tagreader.audio_fingerprint):
+			fingerprinted_paths.append(abs_song_path)
+			return fingerprint(abs_song_path)
+		write_test_mp3(os.path.join(self.music_root, 'album', 'new.mp3'), frame_count=450,
+				title=u'New', artist=u'Artist', trackno=u'6/6')
+		os.remove(os.path.join(self.music_root, 'album', 'song2.mp3'))
+		scanner_fingerprint = afkradio.scanner.audio_fingerprint
+		models_fingerprint = afkradio.models.audio_fingerprint
+		afkradio.scanner.audio_fingerprint = counting_fingerprint
+		afkradio.models.audio_fingerprint = counting_fingerprint
+		try:
+			LibraryScanner(self.music_root, workers=2).scan()
+			write_test_mp3(os.path.join(self.music_root, 'album', 'newer.mp3'),
+					frame_count=460, title=u'Newer', artist=u'Artist', trackno=u'7/7')
+			LibraryScanner(self.music_root, workers=2).scan()
+		finally:
+			afkradio.scanner.audio_fingerprint = scanner_fingerprint
+			afkradio.models.audio_fingerprint = models_fingerprint
+		self.assertEqual(sorted(os.path.basename(path) for path in fingerprinted_paths),
+				['new.mp3', 'newer.mp3'])
+		self.assertTrue(Song.objects.get(filepath='album/new.mp3').fingerprint)
+
+	def test_fingerprint_ignores_tags(self):
+		"""
+		Tests that retagging a file doesn't change its fingerprint
+		"""
+		song_path = os.path.join(self.music_root, 'album', 'song0.mp3')
+		fingerprint = tagreader.audio_fingerprint(song_path)
+		write_test_mp3(song_path, title=u'A much longer title than before')
+		self.assertEqual(tagreader.audio_fingerprint(song_path), fingerprint)
+		write_test_mp3(song_path, frame_count=500)
+		self.assertNotEqual(tagreader.audio_fingerprint(song_path), fingerprint)
+
+	def test_interrupted_scan_resumes(self):
+		"""
+		Tests that songs read before a scan is interrupted are saved and that
+		scanning again only reads the rest
+		"""
+		def interrupt(scanner):
+			progress.append((scanner.done_count, scanner.total_count))
+			raise KeyboardInterrupt()
+		progress = []
+		extract_batch_size = afkradio.scanner.EXTRACT_BATCH_SIZE
+		afkradio.scanner.EXTRACT_BATCH_SIZE = 2
+		try:
+			with self.assertRaises(KeyboardInterrupt):
+				LibraryScanner(self.music_root, workers=1, progress=interrupt).scan()
+		finally:
+			afkradio.scanner.EXTRACT_BATCH_SIZE = extract_batch_size
+		self.assertEqual(progress, [(2, 5)])
+		self.assertEqual(Song.objects.count(), 2)
+		scanner = LibraryScanner(self.music_root, workers=2)
+		self.assertEqual(len(scanner.scan()), 2)
+		self.assertEqual((scanner.added_count, scanner.total_count), (3, 3))
+		self.assertEqual(Song.objects.count(), 5)
+
+	def test_sync(self):
+		"""
+		Tests that syncing single paths adds new files, follows moved
+		directories and marks deleted files as removed
+		"""
+		LibraryScanner(self.music_root, workers=2).scan()
+		write_test_mp3(os.path.join(self.music_root, 'album', 'song5.mp3'),
+				frame_count=405, title=u'Title 5')
+		os.remove(os.path.join(self.music_root, 'album', 'song0.mp3'))
+		os.rename(os.path.join(self.music_root, 'album'),
+				os.path.join(self.music_root, 'renamed'))
+		scanner = LibraryScanner(self.music_root, workers=2)
+		scanner.sync(['album', 'renamed'])
+		self.assertEqual((scanner.added_count, scanner.moved_count,
+			scanner.removed_count), (1, 4, 1))
+		self.assertEqual(Song.objects.get(title='Title 3').filepath, 'renamed/song3.mp3')
+		self.assertTrue(Song.objects.get(filepath='album/song0.mp3').removed)
+		self.assertEqual(Song.objects.available().count(), 5)
+
+class LibraryWatcherTests(TestCase):
+	def test_debounce(self):
+		"""
+		Tests that events are only flushed once their path has been quiet
+		for the debounce period and that paths inside a due directory are
+		folded into it
+		"""
+		watcher = LibraryWatcher('/music', debounce=2)
+		watcher.add_event('/music/album/song.mp3', event_time=10)
+		watcher.add_event('/music/album/cover.jpg', event_time=10)
+		watcher.add_event('/music/album', is_dir=True, event_time=11)
+		watcher.add_event('/music/other/song.ogg', event_time=12)
+		self.assertEqual(watcher.next_timeout(now=11), 1)
+		self.assertEqual(watcher.due_paths(now=11), [])
+		self.assertEqual(watcher.due_paths(now=13), ['album'])
+		self.assertEqual(watcher.due_paths(now=14), ['other/song.ogg'])
+		self.assertEqual(watcher.pending, {})
+		watcher.add_event('/music/other/song.ogg', event_time=20)
+		watcher.add_event(None, event_time=20)
+		self.assertEqual(watcher.due_paths(now=22), [''])
+
+	def test_mpd_update_path(self):
+		"""
+		Tests that MPD is asked to update the folder of a changed file, or
+		the file itself at the root rather than the whole library
+		"""
+		music_root = tempfile.mkdtemp()
+		try:
+			os.makedirs(os.path.join(music_root, 'album'))
+			watcher = LibraryWatcher(music_root)
+			self.assertEqual(watcher.mpd_update_path('album/song.mp3'), 'album')
+			self.assertEqual(watcher.mpd_update_path('album'), 'album')
+			self.assertEqual(watcher.mpd_update_path('song.mp3'), 'song.mp3')
+			self.assertEqual(watcher.mpd_update_path(''), '')
+		finally:
+			shutil.rmtree(music_root)
+
+	def test_inotify_follows_renames(self):
+		"""
+		Tests that events under a renamed directory report its new path and
+		that a directory moved out of the tree isn't watched any more
+		"""
+		music_root = tempfile.mkdtemp()
+		outside = tempfile.mkdtemp()
+		watcher = inotify.Inotify()
+		try:
+			os.makedirs(os.path.join(music_root, 'album', 'disc 1'))
+			watcher.add_tree(music_root)
+			def event_paths():
+				return set(path for path, mask in watcher.read_events(1))
+			os.rename(os.path.join(music_root, 'album'), os.path.join(music_root, 'renamed'))
+			event_paths()
+			open(os.path.join(music_root, 'renamed', 'disc 1', 'song.mp3'), 'w').close()
+			self.assertIn(os.path.join(music_root, 'renamed', 'disc 1', 'song.mp3'),
+					event_paths())
+			os.rename(os.path.join(music_root, 'renamed'), os.path.join(outside, 'gone'))
+			event_paths()
+			self.assertEqual(watcher.watch_paths.values(), [music_root])
+			open(os.path.join(outside, 'gone', 'disc 1', 'other.mp3'), 'w').close()
+			self.assertEqual(event_paths(), set())
+		finally:
+			watcher.close()
+			shutil.rmtree(music_root)
+			shutil.rmtree(outside)
+
+class StationTests(TestCase):
+	def setUp(self):
+		self.songs = [Song.objects.create(title='Song %d' % song_count,
+				filepath='Test Path/%d.mp3' % song_count, duration_secs=180)
+				for song_count in range(40)]
+		self.setlist = Setlist.objects.create(setlist='Station setlist')
+		self.setlist.associated_songs.add(*self.songs[:10])
+
+	def station(self, name, fake):
+		return Station.objects.create(name=name, mpd_host='127.0.0.1', mpd_port=fake.port)
+
+	def test_playlist_for_station(self):
+		"""
+		Tests that every station has a queue of its own, which the default
+		station's doesn't see
+		"""
+		station = Station.objects.create(name='Station', mpd_port=6601)
+		Playlist.add_songs([song.pk for song in self.songs[:3]])
+		Playlist.add_songs([song.pk for song in self.songs[3:5]], station=station)
+		Playlist.add_song(self.songs[5].pk, True, station)
+		self.assertEqual(Playlist.objects.count(), 6)
+		self.assertEqual(list(Playlist.objects.for_station(None).queue_sorted_song_id()),
+				[song.pk for song in self.songs[:3]])
+		self.assertEqual(list(Playlist.objects.for_station(station).queue_sorted_song_id()),
+				[self.songs[5].pk, self.songs[3].pk, self.songs[4].pk])
+		self.assertEqual(Playlist.objects.for_station(None).current_song().song, self.songs[0])
+		self.assertEqual(Playlist.objects.for_station(station).last_song().song, self.songs[4])
+		PlayHistory.add_song(self.songs[0].pk, timezone.now())
+		PlayHistory.add_song(self.songs[3].pk, timezone.now(), station)
+		self.assertEqual(PlayHistory.objects.for_station(station).get().song, self.songs[3])
+
+	def test_add_random_songs_station(self):
+		"""
+		Tests that a station's songs come from its own setlists and go to its
+		own MPD, and a request only changes that station's queue
+		"""
+		with FakeMPDServer() as default_fake, default_fake.installed(), \
+				FakeMPDServer() as station_fake:
+			station = self.station('Station', station_fake)
+			station.setlists.add(self.setlist)
+			Control.add_random_songs(6)
+			Control.add_random_songs(6, station=station)
+			station_song_ids = set(song.pk for song in self.songs[:10])
+			self.assertTrue(set(Playlist.objects.for_station(station)
+					.values_list('song_id', flat=True)) <= station_song_ids)
+			self.assertEqual(station_fake.queue_paths(), Control.queue_paths(station=station))
+			self.assertEqual(default_fake.queue_paths(), Control.queue_paths())
+			with station.mpd():
+				Playback.mpc_play()
+			requested_song = Song.objects.exclude(playlist__isnull=False)[0]
+			default_paths = default_fake.queue_paths()
+			Control.request_song(requested_song.pk, station)
+			self.assertEqual(default_fake.queue_paths(), default_paths)
+			self.assertEqual(station_fake.queue_paths()[1], requested_song.filepath)
+			self.assertEqual(len(station_fake.queue_paths()), 6)
+
+	def test_run_stream_station(self):
+		"""
+		Tests that the stream of a station plays on its MPD and records its
+		plays as the station's
+		"""
+		with FakeMPDServer() as default_fake, default_fake.installed(), \
+				FakeMPDServer(speed=3600) as station_fake:
+			station = self.station('Station', station_fake)
+			daemon = stream.StreamDaemon(metrics_file='', station=station)
+			def stop_after_track_changes():
+				station_fake.wait_for(lambda: station_fake.track_changes >= 5)
+				client = station_fake.client()
+				client.execute('stop')
+				client.close()
+			stopper = threading.Thread(target=stop_after_track_changes)
+			stopper.daemon = True
+			stopper.start()
+			daemon.run_inline()
+			stopper.join()
+			self.assertEqual(PlayHistory.objects.for_station(station).count(),
+					station_fake.track_changes + 1)
+			self.assertEqual(PlayHistory.objects.for_station(None).count(), 0)
+			self.assertEqual(station_fake.queue_paths(), Control.queue_paths(station=station))
+			self.assertEqual(Playlist.objects.for_station(station).count(), stream.PLAYLIST_SIZE)
+			self.assertEqual(default_fake.queue_paths(), [])
+
+class UtilControlMethodTests(TestCase):
+	def setUp(self):
+		self.songs = [Song.objects.create(title='Song %d' % song_count,
+				filepath='Test Path/%d.mp3' % song_count, duration_secs=180)
+				for song_count in range(100)]
+
+	def test_request_song(self):
+		"""
+		Tests that a requested song replaces the last song, in MPD's queue too
+		"""
+		with FakeMPDServer() as fake, fake.installed():
+			Control.add_random_songs(6)
+			Playback.mpc_play()
+			requested_song = Song.objects.exclude(playlist__isnull=False)[0]
+			playing_path = fake.queue_paths()[0]
+			Control.request_song(requested_song.pk)
+			self.assertEqual(fake.queue_paths(), Control.queue_paths(playing_path))
+			self.assertEqual(fake.queue_paths()[:2], [playing_path, requested_song.filepath])
+			self.assertEqual(len(fake.queue_paths()), 6)
+			# Once MPD moves on, the request plays and the played song leaves the playlist
+			fake.advance()
+			daemon = stream.StreamDaemon(client=fake.client(), metrics_file='')
+			daemon.handle_player(time.time())
+			self.assertEqual(fake.queue_paths(), playlist_paths())
+			self.assertEqual(fake.queue_paths()[0], requested_song.filepath)
+			self.assertEqual(PlayHistory.objects.get().song, requested_song)
+
+	def test_handle_player_unknown_song(self):
+		"""
+		Tests that a song another MPD client queued, which isn't in the
+		database, isn't recorded and the queue is refilled all the same
+		"""
+		with FakeMPDServer() as fake, fake.installed():
+			Control.add_random_songs(6)
+			Playback.mpc_play()
+			client = fake.client()
+			client.execute('addid', 'Elsewhere/unknown.mp3', 1)
+			client.close()
+			fake.advance()
+			daemon = stream.StreamDaemon(client=fake.client(), metrics_file='')
+			daemon.handle_player(time.time())
+			self.assertEqual(fake.queue_paths()[0], 'Elsewhere/unknown.mp3')
+			self.assertEqual(fake.queue_paths()[1:], playlist_paths())
+			self.assertEqual(Playlist.objects.count(), 6)
+			self.assertEqual(PlayHistory.objects.count(), 0)
+
+	def test_start_records_playing_song(self):
+		"""
+		Tests that starting on the existing queue records the song MPD is
+		playing, not a request that sorts before it
+		"""
+		with FakeMPDServer() as fake, fake.installed():
+			Control.add_random_songs(6)
+			Playback.mpc_play()
+			playing_path = fake.queue_paths()[0]
+			Control.request_song(Song.objects.exclude(playlist__isnull=False)[0].pk)
+			daemon = stream.StreamDaemon(client=fake.client(), metrics_file='')
+			daemon.start(init=False)
+			daemon.prefetcher.stop()
+			daemon.client.close()
+			self.assertEqual(PlayHistory.objects.get().song.filepath, playing_path)
+
+	def test_run_stream(self):
+		"""
+		Tests that the stream records every song MPD plays and keeps MPD's
+		queue full and in line with the playlist, with songs playing in
+		accelerated time
+		"""
+		with FakeMPDServer(speed=3600) as fake, fake.installed():
+			daemon = stream.StreamDaemon(client=fake.client(), metrics_file='')
+			def stop_after_track_changes():
+				fake.wait_for(lambda: fake.track_changes >= 10)
+				client = fake.client()
+				client.execute('stop')
+				client.close()
+			stopper = threading.Thread(target=stop_after_track_changes)
+			stopper.daemon = True
+			stopper.start()
+			daemon.run_inline()
+			stopper.join()
+			self.assertTrue(fake.track_changes >= 10)
+			self.assertEqual(PlayHistory.objects.count(), fake.track_changes + 1)
+			self.assertEqual(fake.queue_paths(), playlist_paths())
+			self.assertEqual(Playlist.objects.count(), stream.PLAYLIST_SIZE)
+			self.assertTrue(daemon.refill_latency.snapshot()['count'] >= 1)
+
+	def test_benchmark_stream(self):
+		"""
+		Tests that benchmark_stream leaves no plays behind, neither in the
+		database nor in the process' counter buffer, and leaves the hourly
+		roll up as it was
+		"""
+		rollups._last_rollup_hour = None
+		global_counters = counters._counters
+		counters._counters = counters.CounterBuffer(timed=False)
+		try:
+			output = StringIO()
+			call_command('benchmark_stream', tracks=5, speed=3600, stdout=output)
+			self.assertTrue('track changes in' in output.getvalue())
+			self.assertEqual(counters._counters.pending, {})
+			counters.flush_counters()
+		finally:
+			counters._counters = global_counters
+		self.assertEqual(sum(Song.objects.values_list('playcount', flat=True)), 0)
+		self.assertFalse(PlayHistory.objects.exists())
+		self.assertIsNone(rollups._last_rollup_hour)
+
 # 	def test_update_db(self):
 # 		"""
 # 		Tests the update_database method that finds all .mp3, .ogg, .flac
@@ -1,13 +1,17 @@
-from afkradio.models import Song, Setlist, PlayHistory, Playlist
+from afkradio.models import Song, Setlist, PlayHistory, Playlist, parse_duration, \
+	QUEUE_POSITION_GAP
 from afkradio.errors import *
-from django.utils import timezone
-from django.utils.encoding import smart_str, smart_unicode
-from time import sleep
+from afkradio.scanner import LibraryScanner
+from afkradio.scheduler import get_engine
+from afkradio.queuediff import queue_operations
+from afkradio.counters import count_favourite, flush_counters
+from afkradio.rollups import total_plays
+from afkradio.mpd import MPDStatus, mpd_connection, split_songs
+from contextlib import contextmanager
+from django.db import transaction
 import logging
 import json
-import fnmatch
 import os
-import subprocess
 
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 with open(os.path.join(APP_ROOT,'config.json')) as config_file:
@@ -15,89 +19,251 @@ with open(os.path.join(APP_ROOT,'config.json')) as config_file:
 	MPD_DB_ROOT = config_data['MPD DB root']
 	PLAYLIST_SIZE = config_data['Playlist size']
 
-check_os = os.name
-if check_os == 'posix':
-	NULL_DEVICE = open('/dev/null', 'w')
-elif check_os == 'nt':
-	NULL_DEVICE = open('nul', 'w')
-else:
-	print 'Not a supported system'
-	exit()
-		
-
+# station_mpd
+# with station_mpd(station): Playback in this thread talks to the station's
+# MPD, or to the one in config.json for the default station (None)
+@contextmanager
+def station_mpd(station):
+	if station is None:
+		yield
+	else:
+		with station.mpd():
+			yield
 
 class Playback:
 
 	@staticmethod
 	def mpc_play():
-		proc = subprocess.Popen(["mpc", "play"], stdout=NULL_DEVICE).wait()
+		with mpd_connection() as client:
+			client.execute('play')
 		return "Played mpc"
 
 	@staticmethod
 	def mpc_stop():
-		proc = subprocess.Popen(["mpc", "stop"], stdout=NULL_DEVICE).wait()
+		with mpd_connection() as client:
+			client.execute('stop')
 		return "Stopped mpc"
 
 	@staticmethod 
 	def mpc_clear():
-		proc = subprocess.Popen(["mpc", "clear"], stdout=NULL_DEVICE).wait()
+		with mpd_connection() as client:
+			client.execute('clear')
 		return "Cleared mpc playlist"
 
+	# MPD has no crop command, so this deletes the songs after and before
+	# the current one in one command list, as mpc crop does
 	@staticmethod 
 	def mpc_crop():
-		proc = subprocess.Popen(["mpc", "crop"], stdout=NULL_DEVICE).wait()
+		with mpd_connection() as client:
+			status = client.status()
+			if status.is_stopped() or status.song is None:
+				return "Cleared mpc playlist except currently playing song"
+			commands = []
+			if status.song + 1 < status.playlist_length:
+				commands.append(('delete', '%d:%d' % (status.song + 1, status.playlist_length)))
+			if status.song > 0:
+				commands.append(('delete', '0:%d' % status.song))
+			client.execute_list(commands)
 		return "Cleared mpc playlist except currently playing song"
 
+	# Pass a path relative to the MPD root to only rescan that file or folder
 	@staticmethod
-	def mpc_update():
-		proc = subprocess.Popen(["mpc", "update"], stdout=NULL_DEVICE).wait()
+	def mpc_update(song_path=None):
+		with mpd_connection() as client:
+			if song_path:
+				client.execute('update', song_path)
+				return "Scanned " + song_path + " and updated MPD db (NOT models.Song DB)"
+			client.execute('update')
 		return "Scanned MPD root and updated MPD db (NOT models.Song DB)"
 
 	@staticmethod
 	def mpc_add(song_path):
-		proc = subprocess.Popen(["mpc", "add", smart_str(song_path)], stdout=NULL_DEVICE).wait()
+		with mpd_connection() as client:
+			client.execute('add', song_path)
 		return "Added " + song_path + " to the playlist"
 
+	# mpc_add_many
+	# Adds every path in song_paths in a single command list
+	@staticmethod
+	def mpc_add_many(song_paths):
+		song_paths = list(song_paths)
+		if not song_paths:
+			return "Added no songs to the playlist"
+		with mpd_connection() as client:
+			client.execute_list(('add', song_path) for song_path in song_paths)
+		return "Added " + str(len(song_paths)) + " songs to the playlist"
+
+	# mpc_insert_many
+	# Inserts song_paths at position (1-based) of a queue that currently has
+	# queue_length songs, in a single command list
+	@staticmethod
+	def mpc_insert_many(song_paths, position, queue_length):
+		song_paths = list(song_paths)
+		with mpd_connection() as client:
+			client.execute_list(insert_commands(song_paths, position, queue_length))
+		return "Inserted " + str(len(song_paths)) + " songs at position " + str(position)
+
+	@staticmethod
+	def mpc_move(from_position, to_position):
+		with mpd_connection() as client:
+			client.execute('move', from_position - 1, to_position - 1)
+		return "Moved the song in position " + str(from_position) + " to " + str(to_position)
+
+	# mpc_queue
+	# Returns the file paths in MPD's queue, in order
+	@staticmethod
+	def mpc_queue():
+		with mpd_connection() as client:
+			return [song.file for song in client.playlistinfo()]
+
+	# mpc_status
+	# Returns MPD's status as an MPDStatus
+	@staticmethod
+	def mpc_status():
+		with mpd_connection() as client:
+			return client.status()
+
+	# mpc_reconcile
+	# Brings MPD's queue, from position start on, in line with song_paths
+	# using only the deletes, moves and inserts queue_operations finds, all
+	# sent in one command list.  Returns the number of operations
 	@staticmethod
-	def mpc_delete(song_position=1):
-		proc = subprocess.Popen(["mpc", "del", str(song_position)], stdout=NULL_DEVICE).wait()
+	def mpc_reconcile(song_paths, start=1):
+		with mpd_connection() as client:
+			queue_paths = [song.file for song in client.playlistinfo()]
+			operations = queue_operations(queue_paths[start-1:], list(song_paths), start - 1)
+			queue_length = len(queue_paths)
+			commands = []
+			for operation in operations:
+				if operation[0] == 'delete':
+					commands.append(('delete', operation[1] - 1))
+					queue_length -= 1
+				elif operation[0] == 'move':
+					commands.append(('move', operation[1] - 1, operation[2] - 1))
+				else:
+					commands.extend(insert_commands(operation[2], operation[1], queue_length))
+					queue_length += len(operation[2])
+			client.execute_list(commands)
+		return len(operations)
+
+	# Pass count to delete that many songs from song_position on
+	@staticmethod
+	def mpc_delete(song_position=1, count=1):
+		with mpd_connection() as client:
+			if count > 1:
+				client.execute('delete', '%d:%d' % (song_position - 1, song_position - 1 + count))
+				return "Deleted " + str(count) + " songs from position " + \
+						str(song_position) + " of the playlist"
+			client.execute('delete', song_position - 1)
 		return "Deleted the song in position " + str(song_position) + " of the playlist"
 
+	# mpc_current_path
+	# Returns the path of the song MPD is playing, or None
+	@staticmethod
+	def mpc_current_path():
+		with mpd_connection() as client:
+			status, current_song = client.execute_list([('status',), ('currentsong',)])
+		current_song = split_songs(current_song)
+		if MPDStatus(status).is_stopped() or not current_song:
+			return None
+		return current_song[0].file
+
 	@staticmethod
 	def mpc_currently_playing():
-		proc = subprocess.Popen(["mpc"], stdout=subprocess.PIPE)
-		line = proc.stdout.readline()
-		if line.startswith("volume: n/a"):
+		with mpd_connection() as client:
+			status, current_song = client.execute_list([('status',), ('currentsong',)])
+		current_song = split_songs(current_song)
+		if MPDStatus(status).is_stopped() or not current_song:
 			return "No song is currently playing"
 		else:
-			return line[0:-1].decode('utf-8')
+			return current_song[0].display_name()
+
+# insert_commands
+# MPD commands inserting song_paths at position (1-based) of a queue of
+# queue_length songs.  addid takes the 0-based position to insert at
+def insert_commands(song_paths, position, queue_length):
+	if position > queue_length:
+		return [('add', song_path) for song_path in song_paths]
+	return [('addid', song_path, position - 1 + index)
+			for index, song_path in enumerate(song_paths)]
 
 class Database:
 	# update_song_db
 	# First runs mpc_update to update the mpd music database
 	# Then it will read from the mpd music root defined in afkradio.models for any
 	# .mp3, .ogg, and .flac music files and add them with their respective metadata
-	# to the Songs model
+	# to the Songs model.  The scan itself is done by scanner.LibraryScanner
 
 	@staticmethod
 	def update_song_db():
-		dupe_list = []
-		matches = []
-		supported_file_types = ('mp3', 'ogg', 'flac')
 		if MPD_DB_ROOT == '':
 			raise MPDRootNotFound()
 			return []
-		for root, dirs, files in os.walk(MPD_DB_ROOT):
-			for extension in supported_file_types:
-				for filename in fnmatch.filter(files, '*.' + extension):
-					# Get relative path of song from MPD_DB_ROOT
-					song_path = os.path.relpath(os.path.join(root, filename), MPD_DB_ROOT)
-					try:
-						Song.add_song_exiftool(song_path, None)
-					except DuplicateEntryError:
-						dupe_list.append(os.path.join(root, filename))
-		return dupe_list
-		
+		return LibraryScanner(MPD_DB_ROOT).scan()
+
+	# fill_duration_secs
+	# Fills Song.duration_secs from the H:MM:SS duration of songs added before
+	# the field existed.  Songs are updated per distinct duration, so this
+	# takes one query per duration rather than per song.  Returns the number
+	# of songs updated
+	@staticmethod
+	def fill_duration_secs():
+		updated_count = 0
+		durations = Song.objects.filter(duration_secs__isnull=True) \
+				.exclude(duration='').values_list('duration', flat=True).distinct()
+		for duration in list(durations):
+			duration_secs = parse_duration(duration)
+			if duration_secs is None:
+				continue
+			updated_count += Song.objects.filter(duration_secs__isnull=True,
+					duration=duration).update(duration_secs=duration_secs)
+		return updated_count
+
+	# fill_playlist_positions
+	# Numbers the queue of a database from before Playlist.position existed,
+	# in the order it used to be sorted in
+	@staticmethod
+	def fill_playlist_positions():
+		playlist_pks = Playlist.objects.order_by('-user_requested', 'add_time') \
+				.values_list('pk', flat=True)
+		for index, playlist_pk in enumerate(playlist_pks):
+			Playlist.objects.filter(pk=playlist_pk).update(
+					position=(index + 1) * QUEUE_POSITION_GAP)
+		return len(playlist_pks)
+
+	# remove_orphaned_song_rows
+	# Deletes Playlist and PlayHistory rows that point at songs that don't
+	# exist, which the song foreign keys don't allow.  Run it on a database
+	# from before they were foreign keys.  Returns the number of rows deleted
+	@staticmethod
+	def remove_orphaned_song_rows():
+		removed_count = 0
+		for model in (Playlist, PlayHistory):
+			orphaned_rows = model.objects.exclude(song_id__in=Song.objects.values('pk'))
+			removed_count += orphaned_rows.count()
+			orphaned_rows.delete()
+		return removed_count
+
+	# rebuild_playcounts
+	# Sets every Song.playcount to the number of times the song was played,
+	# from the daily rollups plus the plays not rolled up yet, with one
+	# UPDATE per distinct count.  favecount has no history to rebuild from.
+	# This process' buffered plays are written first, they are in the
+	# history already and would be added on top of the rebuilt counts
+	@staticmethod
+	def rebuild_playcounts():
+		flush_counters()
+		play_counts = {}
+		for song_pk, play_count in total_plays().items():
+			play_counts.setdefault(play_count, []).append(song_pk)
+		with transaction.atomic():
+			Song.objects.exclude(playcount=0).update(playcount=0)
+			for play_count, song_pks in play_counts.items():
+				for index in range(0, len(song_pks), 500):
+					Song.objects.filter(pk__in=song_pks[index:index+500]) \
+							.update(playcount=play_count)
+		return sum(len(song_pks) for song_pks in play_counts.values())
+
 	@staticmethod
 	# associate_setlist_to_song
 	# Associates a Song in Song.models to a Setlist in Setlist.models
@@ -132,10 +298,17 @@ class Database:
 class Control:
 	# Gets a random song from any song that has a setlist that's active
 	# Can be set to False which will get a song from complete random
+	# A station with setlists of its own gets a song from those instead
 	@staticmethod
-	def add_random_song(from_setlists=True):
-		if from_setlists:
-			random_song = Song.objects.get_random_from_active_setlists()
+	def add_random_song(from_setlists=True, station=None):
+		engine = get_engine(station)
+		setlist_pks = station.setlist_pks() if station is not None else None
+		if from_setlists and setlist_pks:
+			random_songs = Song.objects.get_random_batch_from_setlists(setlist_pks, 1, engine)
+			random_song = random_songs[0] if random_songs else Song.objects.get_random(engine)
+			log_setlisted = 'from setlists ' if random_songs else ''
+		elif from_setlists:
+			random_song = Song.objects.get_random_from_active_setlists(engine)
 			log_setlisted = 'from setlists '
 			if not random_song:
 				try:
@@ -146,14 +319,16 @@ class Control:
 						raise SongNotFoundError('No songs associated to set active ' + \
 							'setlists.  Ignoring setlists and playing a random song instead')
 				except (SetlistNotFoundError, SongNotFoundError):
-					random_song = Song.objects.get_random()
+					random_song = Song.objects.get_random(engine)
 					log_setlisted = ''
 		else:
-			random_song = Song.objects.get_random()
+			random_song = Song.objects.get_random(engine)
 			log_setlisted = ''
 		if random_song:
-			Playlist.add_song(random_song.id)
-			Playback.mpc_add(random_song.filepath)
+			engine.record_song(random_song)
+			Playlist.add_song(random_song.id, station=station)
+			with station_mpd(station):
+				Playback.mpc_add(random_song.filepath)
 			logging.info('Random song ' + log_setlisted + random_song.title + \
 					' (Song ID: ' + str(random_song.id) + ') has been added ' + \
 					'to the playlist.  Filepath: ' + random_song.filepath)
@@ -161,6 +336,36 @@ class Control:
 			# No songs in the database
 			exit()
 	
+	# add_random_songs
+	# Queues count random songs at once: one pick from the selection engine
+	# for all of them, one Playlist insert and one mpc add.  Falls back to all
+	# songs like add_random_song.  Returns the songs that were added
+	@staticmethod
+	def add_random_songs(count, from_setlists=True, station=None):
+		engine = get_engine(station)
+		random_songs = []
+		log_setlisted = ''
+		setlist_pks = station.setlist_pks() if station is not None else None
+		if from_setlists and setlist_pks:
+			random_songs = Song.objects.get_random_batch_from_setlists(setlist_pks, count, engine)
+			log_setlisted = 'from setlists '
+		elif from_setlists:
+			random_songs = Song.objects.get_random_batch_from_active_setlists(count, engine)
+			log_setlisted = 'from setlists '
+		if len(random_songs) < count:
+			log_setlisted = ''
+			random_songs.extend(Song.objects.get_random_batch(
+					count - len(random_songs), engine))
+		if not random_songs:
+			# No songs in the database
+			exit()
+		Playlist.add_songs([random_song.id for random_song in random_songs], station=station)
+		with station_mpd(station):
+			Playback.mpc_add_many(random_song.filepath for random_song in random_songs)
+		logging.info(str(len(random_songs)) + ' random songs ' + log_setlisted + \
+				'have been added to the playlist')
+		return random_songs
+
 	@staticmethod
 	def scan_for_songs():
 		Playback.mpc_update()
@@ -168,52 +373,50 @@ class Control:
 		logging.info('Scanned MPC root and updated Songs model and MPC playlist')
 		return dupe_list
 
+	# request_song
+	# Swaps the last auto-picked song for the requested one.  MPD's queue
+	# after the song that is playing is then reconciled with the playlist,
+	# which only inserts the request and deletes the song it replaced
 	@staticmethod
-	def request_song(song_id):
-		Playlist.objects.last_song().delete()
-		Playlist.add_song(song_id, True)
-		Playback.mpc_crop()
-		sorted_playlist_song_ids = Playlist.objects.queue_sorted_song_id()[1:]
-		for playlist_song_id in sorted_playlist_song_ids:
-			song_path = Song.objects.get(pk=playlist_song_id).filepath
-			Playback.mpc_add(song_path)
-
-	# run_stream is the main stream method that will run mpc and keep it
-	# persistently listening to commands with mpc idle.  It plays songs in
-	# activated setlists by default, but if no setlists are active, then it will
-	# play from all songs
-	@staticmethod
-	def run_stream(init=True, from_setlists=True):
-		logging.info('Stream has been initiated')
-		if init:
-			Playback.mpc_clear()
-			Playlist.objects.clear_playlist_full()
-			for song_count in range(int(PLAYLIST_SIZE)):
-				Control.add_random_song(from_setlists)
-		Playback.mpc_play()
-		# Add played song to PlayHistory
-		PlayHistory.add_song(Playlist.objects.current_song().song_id, timezone.now())
-		while True:
-			proc = subprocess.Popen(["mpc", "idle"], stdout=subprocess.PIPE)
-			sleep(0.5)
-			line = proc.stdout.readline()
-			while True:
-				if line[0:-1] == 'player':
-					check_state = subprocess.Popen(["mpc"], stdout=subprocess.PIPE)
-					state_line = check_state.stdout.readline()
-					if state_line.startswith('volume: n/a   repeat:'):
-						return
-					else:
-						Playlist.objects.current_song().delete()
-						new_song_id = Playlist.objects.current_song().song_id
-						logging.info('Played ' + Playback.mpc_currently_playing() + \
-								'(Song ID: ' + new_song_id + ')')
-						PlayHistory.add_song(new_song_id, timezone.now())
-						Control.add_random_song()
-						Playback.mpc_delete(1)
-						break
-				else:
-					continue
+	def request_song(song_id, station=None):
+		Playlist.objects.for_station(station).last_song().delete()
+		Playlist.add_song(song_id, True, station)
+		with station_mpd(station):
+			playing_path = Playback.mpc_current_path()
+			if playing_path is None:
+				Playback.mpc_reconcile(Control.queue_paths(station=station))
+			else:
+				Playback.mpc_reconcile(Control.queue_paths(playing_path, station)[1:], start=2)
+
+	# queue_paths
+	# The paths of the Playlist in play order.  Requests sort before every
+	# other song, the one playing included, so the song MPD is playing is
+	# moved back to the front, where MPD has it
+	@staticmethod
+	def queue_paths(playing_path=None, station=None):
+		song_paths = list(Playlist.objects.for_station(station).order_by('position')
+				.values_list('song__filepath', flat=True))
+		if playing_path in song_paths:
+			song_paths.remove(playing_path)
+			song_paths.insert(0, playing_path)
+		return song_paths
+
+	# favourite_song
+	# Counts a favourite for the song.  The count is buffered, see
+	# afkradio.counters
+	@staticmethod
+	def favourite_song(song_id):
+		count_favourite(song_id)
+
+	# run_stream is the main stream method that will run MPD and keep it
+	# persistently listening for changes with idle, see
+	# afkradio.stream.StreamDaemon.  It plays songs in activated setlists by
+	# default, but if no setlists are active, then it will play from all songs.
+	# Each station runs a stream of its own, see the run_stations command
+	@staticmethod
+	def run_stream(init=True, from_setlists=True, station=None):
+		from afkradio.stream import StreamDaemon
+		StreamDaemon(from_setlists, station=station).run(init)
 	
 class Config:
 	# Edits config.json file with new values. Takes a list that has values that
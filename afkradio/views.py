@@ -6,7 +6,7 @@ from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.views import generic
 from django.db.models import Q
 
-from afkradio.models import Song, Playlist, PlayHistory, Setlist
+from afkradio.models import Song, Playlist, PlayHistory, Setlist, Station
 from afkradio.utils import Control
 import logging
 
@@ -15,7 +15,13 @@ GLOBAL_PAGINATION = 20
 # View Utility Functions #
 def song_request(request):
 	if(request.POST.get('req_button')):
-		Control.request_song( str(request.POST.get('req_song_id')) )
+		# Requests go to the default station unless a station is named
+		station = None
+		if(request.POST.get('req_station')):
+			station = get_object_or_404(Station, name=request.POST.get('req_station'))
+		Control.request_song( str(request.POST.get('req_song_id')), station )
+	if(request.POST.get('fave_button')):
+		Control.favourite_song( str(request.POST.get('fave_song_id')) )
 
 def pagination(request, songs_list, entries_per_page):
 	if songs_list.count() <= entries_per_page:
@@ -38,7 +44,7 @@ class HomeView(generic.ListView):
 	context_object_name = 'songs_list'
 
 	def get_queryset(self):
-		return Song.objects.all()
+		return Song.objects.available()
 
 class SongView(generic.ListView):
 	# Check song request
@@ -52,7 +58,7 @@ class SongView(generic.ListView):
 		return HttpResponseRedirect(reverse('afkradio:songs'))
 
 	def get_queryset(self):
-		return Song.objects.all().order_by('-pk')
+		return Song.objects.available().order_by('-pk')
 
 class SingleSongView(generic.DetailView):
 	template_name = 'afkradio/singlesong.html'
@@ -63,7 +69,7 @@ def SearchView(request):
 	song_request(request)
 	if 'query' in request.GET and request.GET['query']:
 		query = request.GET['query']
-		songs_list = Song.objects.filter(
+		songs_list = Song.objects.available().filter(
 				Q(title__icontains=query) | Q(artist__icontains=query) | \
 				Q(extra__icontains=query) | Q(album__icontains=query) \
 				).order_by('title','artist','extra','album')
@@ -81,7 +87,7 @@ def ArtistView(request):
 	song_request(request)
 	if 'name' in request.GET and request.GET['name']:
 		artist_query = request.GET['name']
-		songs_list = Song.objects.filter(artist=artist_query).order_by( \
+		songs_list = Song.objects.available().filter(artist=artist_query).order_by( \
 				'year','album','trackno','title')
 		contents = pagination(request, songs_list, GLOBAL_PAGINATION)
 		return render_to_response('afkradio/artist.html', \
@@ -96,7 +102,7 @@ def AlbumView(request):
 	song_request(request)
 	if 'name' in request.GET and request.GET['name']:
 		album_query = request.GET['name']
-		songs_list = Song.objects.filter(album=album_query).order_by( \
+		songs_list = Song.objects.available().filter(album=album_query).order_by( \
 				'trackno','title','artist')
 		contents = pagination(request, songs_list, GLOBAL_PAGINATION)
 		return render_to_response('afkradio/album.html', \
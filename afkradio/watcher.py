@@ -0,0 +1,116 @@
+from afkradio.scanner import LibraryScanner, is_supported
+from afkradio.utils import Playback
+from afkradio.inotify import Inotify, IN_ISDIR
+import logging
+import os
+import time
+
+# Seconds a path has to be quiet before it is ingested.  Copying an album
+# in produces a burst of events per file, this turns them into one sync
+DEBOUNCE_SECONDS = 2.0
+
+
+# LibraryWatcher
+# Follows the MPD root with inotify and keeps the Song table in step with
+# it.  Events are debounced per path, then the quiet paths are handed to
+# LibraryScanner.sync in one go, which adds, updates, moves or removes the
+# songs involved.  MPD is asked to rescan only the folders that changed.
+class LibraryWatcher:
+	def __init__(self, root, debounce=DEBOUNCE_SECONDS, update_mpd=True):
+		self.root = root
+		self.debounce = debounce
+		self.update_mpd = update_mpd
+		# {path relative to the root: time of its last event}
+		self.pending = {}
+
+	# add_event
+	# Records an event for the file or directory at abs_path
+	def add_event(self, abs_path, is_dir=False, event_time=None):
+		if event_time is None:
+			event_time = time.time()
+		if abs_path is None:
+			# Events were lost, so fall back to syncing the whole root
+			rel_path = ''
+		else:
+			rel_path = os.path.relpath(abs_path, self.root)
+			if rel_path == '.':
+				rel_path = ''
+			elif not is_dir and not is_supported(rel_path):
+				return
+		self.pending[rel_path] = event_time
+
+	# due_paths
+	# Removes and returns the pending paths that have been quiet for the
+	# debounce period.  Paths inside a due directory are folded into it
+	def due_paths(self, now=None):
+		if now is None:
+			now = time.time()
+		due = [rel_path for rel_path, event_time in self.pending.items()
+				if now - event_time >= self.debounce]
+		for rel_path in due:
+			del self.pending[rel_path]
+		if '' in due:
+			return ['']
+		due_set = set(due)
+		return sorted(rel_path for rel_path in due
+				if not any(parent in due_set for parent in parent_paths(rel_path)))
+
+	# flush
+	# Syncs the songs at the due paths.  Returns the paths that were synced
+	def flush(self, now=None):
+		rel_paths = self.due_paths(now)
+		if not rel_paths:
+			return rel_paths
+		if self.update_mpd:
+			for mpd_path in sorted(set(self.mpd_update_path(rel_path) for rel_path in rel_paths)):
+				Playback.mpc_update(mpd_path)
+		scanner = LibraryScanner(self.root)
+		if rel_paths == ['']:
+			scanner.scan()
+		else:
+			scanner.sync(rel_paths)
+		logging.info('Synced ' + ', '.join(rel_paths))
+		return rel_paths
+
+	# mpd_update_path
+	# The folder MPD should rescan for a changed path: the path itself for
+	# directories, the containing folder for files (which may be gone).
+	# Files at the root are updated on their own, the root's folder is the
+	# whole library
+	def mpd_update_path(self, rel_path):
+		if not rel_path or os.path.isdir(os.path.join(self.root, rel_path)):
+			return rel_path
+		return os.path.dirname(rel_path) or rel_path
+
+	# next_timeout
+	# Seconds until the next pending path becomes due, or None
+	def next_timeout(self, now=None):
+		if not self.pending:
+			return None
+		if now is None:
+			now = time.time()
+		return max(0, min(self.pending.values()) + self.debounce - now)
+
+	# run
+	# Watches the root until interrupted
+	def run(self):
+		inotify = Inotify()
+		try:
+			inotify.add_tree(self.root)
+			logging.info('Watching ' + self.root)
+			while True:
+				for abs_path, mask in inotify.read_events(self.next_timeout()):
+					self.add_event(abs_path, bool(mask & IN_ISDIR))
+				self.flush()
+		finally:
+			inotify.close()
+
+# parent_paths
+# 'a/b/c.mp3' -> ['a/b', 'a']
+def parent_paths(rel_path):
+	parents = []
+	rel_path = os.path.dirname(rel_path)
+	while rel_path:
+		parents.append(rel_path)
+		rel_path = os.path.dirname(rel_path)
+	return parents